@@ -8,6 +8,7 @@ def main():
         # "filter_by_density_v1": "filter_density", \
         "filter_by_boundary": "filter_boundary", \
         "make_spatial_minibatch": "make_spatial_minibatch",\
+        "convert_columnar": "convert_columnar", \
         "make_dge": "make_dge_univ", \
         "make_sge_by_hexagon": "make_sge_by_hexagon", \
         "fit_model": "init_model_selection", \
@@ -0,0 +1,188 @@
+### Chunked binary columnar store for pixel/unit level data
+### A directory of .npz row groups, string (and id) columns are dictionary
+### coded to integers, numeric columns are stored as float32/int32/int64.
+### Float columns record their decimal precision so values read back are
+### exactly those parsed from text. The type of each column is chosen from the
+### first chunk, a row group it cannot hold exactly is stored as float64 (int64).
+
+import os, json, logging
+import numpy as np
+import pandas as pd
+
+def is_columnar(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, "schema.json"))
+
+def columnar_header(path):
+    with open(os.path.join(path, "schema.json"), 'r') as rf:
+        return [x[0] for x in json.load(rf)['columns']]
+
+class ColumnarWriter:
+
+    def __init__(self, path, row_group_size=1000000, code_columns=[], float_columns=['X','Y'], compress=False) -> None:
+        self.path = path
+        self.row_group_size = row_group_size
+        self.code_columns = set(code_columns)
+        self.float_columns = set(float_columns)
+        self.compress = compress
+        self.columns = None # [name, kind, decimals], kind is code, float32/64, int32, or int64
+        self.dicts = {}     # Column name -> {value: code}
+        self.buff = []
+        self.n_buff = 0
+        self.row_groups = []
+        os.makedirs(self.path, exist_ok=True)
+
+    def _set_schema(self, df):
+        self.columns = []
+        for x in df.columns:
+            v = df[x]
+            dec = None
+            if x in self.code_columns or not pd.api.types.is_numeric_dtype(v):
+                kind = "code"
+                self.dicts[x] = {}
+            elif x in self.float_columns or pd.api.types.is_float_dtype(v):
+                kind = "float32"
+                v = v.values.astype(float)
+                dec = next((d for d in range(7) if np.allclose(np.round(v, d), v, rtol=0, atol=1e-9)), None)
+                # Leave headroom for larger values in later chunks, row groups
+                # that still do not fit fall back to float64 (see _flush)
+                if dec is None or (len(v) > 0 and np.abs(v).max() * 10**dec >= 2**22):
+                    kind = "float64"
+                    dec = None
+            elif len(v) > 0 and np.abs(v.values).max() >= 2**31 // 4:
+                kind = "int64"
+            else:
+                kind = "int32"
+            self.columns.append([x, kind, dec])
+
+    def _encode(self, x, v):
+        codes, uniq = pd.factorize(v)
+        assert (codes >= 0).all(), f"Column {x} contains missing values"
+        d = self.dicts[x]
+        lut = np.array([d.setdefault(u, len(d)) for u in uniq], dtype=np.int32)
+        return lut[codes]
+
+    def _flush(self, n):
+        df = pd.concat(self.buff) if len(self.buff) > 1 else self.buff[0]
+        out = df.iloc[:n]
+        self.buff = [df.iloc[n:]] if n < df.shape[0] else []
+        self.n_buff = df.shape[0] - n
+        arrays = {}
+        for x, kind, dec in self.columns:
+            if kind == "code":
+                arrays[x] = self._encode(x, out[x].values)
+                continue
+            u = out[x].values
+            v = u.astype(kind)
+            if kind == "float32":
+                if not np.array_equal(np.round(v.astype(float), dec), u):
+                    logging.info(f"Column {x} in row group {len(self.row_groups)} is not exactly representable as float32 with {dec} decimals, stored as float64")
+                    v = u.astype(np.float64)
+            else:
+                if kind == "int32" and not np.array_equal(v, u):
+                    v = u.astype(np.int64)
+                assert np.array_equal(v, u), f"Column {x} does not fit in {kind}"
+            arrays[x] = v
+        f = f"rg_{len(self.row_groups):06d}.npz"
+        if self.compress:
+            np.savez_compressed(os.path.join(self.path, f), **arrays)
+        else:
+            np.savez(os.path.join(self.path, f), **arrays)
+        self.row_groups.append({'file':f, 'n':out.shape[0]})
+
+    def write(self, df):
+        if self.columns is None:
+            self._set_schema(df)
+        self.buff.append(df)
+        self.n_buff += df.shape[0]
+        while self.n_buff >= self.row_group_size:
+            self._flush(self.row_group_size)
+
+    def close(self):
+        if self.columns is None:
+            return
+        if self.n_buff > 0:
+            self._flush(self.n_buff)
+        for x, d in self.dicts.items():
+            np.save(os.path.join(self.path, f"dict.{x}.npy"), np.array(list(d.keys()), dtype=str))
+        with open(os.path.join(self.path, "schema.json"), 'w') as wf:
+            json.dump({'columns':self.columns, 'row_groups':self.row_groups}, wf)
+        logging.info(f"Wrote {sum([x['n'] for x in self.row_groups])} rows in {len(self.row_groups)} row groups to {self.path}")
+
+class ColumnarReader:
+    """
+    Iterate over a columnar store in DataFrame chunks, a drop-in replacement
+    for pd.read_csv(..., chunksize=) in the loaders.
+    names: rename all columns (positional, like read_csv)
+    Dictionary coded columns are returned as pd.Categorical sharing the
+    store's (sorted) categories, numeric columns as float64/int64
+    """
+    def __init__(self, path, chunksize=None, usecols=None, names=None, categorical=True) -> None:
+        self.path = path
+        with open(os.path.join(path, "schema.json"), 'r') as rf:
+            schema = json.load(rf)
+        src = [x[0] for x in schema['columns']]
+        kind = {x[0]:x[1] for x in schema['columns']}
+        decimals = {x[0]:x[2] for x in schema['columns']}
+        if names is None:
+            names = src
+        assert len(names) == len(src), "Length of names does not match the number of columns in the store"
+        self.name_map = {y:x for x,y in zip(src, names)}
+        self.usecols = list(names) if usecols is None else [x for x in names if x in usecols]
+        self.kind = {x:kind[self.name_map[x]] for x in self.usecols}
+        self.decimals = {x:decimals[self.name_map[x]] for x in self.usecols}
+        self.categories = {}
+        self.rank = {} # Recode so categories are sorted, as groupby orders by category
+        for x in self.usecols:
+            if self.kind[x] == "code":
+                v = np.load(os.path.join(path, f"dict.{self.name_map[x]}.npy"))
+                order = np.argsort(v, kind='stable')
+                self.rank[x] = np.empty(len(v), dtype=np.int32)
+                self.rank[x][order] = np.arange(len(v), dtype=np.int32)
+                self.categories[x] = pd.Index(v[order], dtype=object)
+        self.categorical = categorical
+        self.row_groups = schema['row_groups']
+        self.chunksize = chunksize
+        self._it = self._chunks()
+
+    def _read_row_group(self, rg):
+        data = {}
+        with np.load(os.path.join(self.path, rg['file'])) as arrays:
+            for x in self.usecols:
+                v = arrays[self.name_map[x]]
+                if self.kind[x] == "code":
+                    v = self.rank[x][v]
+                    if self.categorical:
+                        data[x] = pd.Categorical.from_codes(v, categories=self.categories[x])
+                    else:
+                        data[x] = self.categories[x].values[v]
+                elif v.dtype == np.float32:
+                    data[x] = np.round(v.astype(float), self.decimals[x])
+                elif v.dtype == np.float64:
+                    data[x] = v
+                else:
+                    data[x] = v.astype(np.int64)
+        return pd.DataFrame(data)
+
+    def _chunks(self):
+        buff = []
+        n_buff = 0
+        for rg in self.row_groups:
+            df = self._read_row_group(rg)
+            if self.chunksize is None:
+                yield df
+                continue
+            buff.append(df)
+            n_buff += df.shape[0]
+            while n_buff >= self.chunksize:
+                df = pd.concat(buff) if len(buff) > 1 else buff[0]
+                yield df.iloc[:self.chunksize].reset_index(drop=True)
+                buff = [df.iloc[self.chunksize:]]
+                n_buff = df.shape[0] - self.chunksize
+        if n_buff > 0:
+            yield (pd.concat(buff) if len(buff) > 1 else buff[0]).reset_index(drop=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._it)
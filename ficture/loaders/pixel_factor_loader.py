@@ -1,8 +1,10 @@
-import sys, os, gzip, copy, re, logging, warnings
+import sys, os, gzip, copy, re, logging, warnings, io
 import numpy as np
 import pandas as pd
 import subprocess as sp
 
+from ficture.utils.bgzf import TabixReader
+
 class BlockIndexedLoader:
 
     def __init__(self, input, xmin = -np.inf, xmax = np.inf, ymin = -np.inf, ymax = np.inf, full = False, offseted = True, filter_cmd = "", idtype={}, chunksize=1000000) -> None:
@@ -58,17 +60,56 @@ class BlockIndexedLoader:
                 block = [int(x / self.meta['BLOCK_SIZE']) for x in [self.xmin, self.xmax - 1] ]
                 pos_range = [int(x*self.meta['SCALE']) for x in [self.ymin, self.ymax]]
             block = np.arange(block[0], block[1]+1) * self.meta['BLOCK_SIZE']
-            query = []
-            pos_range = '-'.join([str(x) for x in pos_range])
-            for i,b in enumerate(block):
-                query.append( str(b)+':'+pos_range )
+            if filter_cmd == "" and (os.path.isfile(input+".tbi") or os.path.isfile(input+".csi")):
+                # Query the index in process
+                self.reader = self._region_reader(input, block, pos_range, dty, chunksize)
+            else:
+                query = []
+                pos_range = '-'.join([str(x) for x in pos_range])
+                for i,b in enumerate(block):
+                    query.append( str(b)+':'+pos_range )
 
-            cmd = " ".join( ["tabix", input] + query )
-            if filter_cmd != "":
-                cmd = cmd + " | " + filter_cmd
-            logging.info(cmd)
-            process = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, shell=True)
-            self.reader = pd.read_csv(process.stdout,sep='\t',chunksize=chunksize,names=self.header, dtype=dty)
+                cmd = " ".join( ["tabix", input] + query )
+                if filter_cmd != "":
+                    cmd = cmd + " | " + filter_cmd
+                logging.info(cmd)
+                process = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, shell=True)
+                self.reader = pd.read_csv(process.stdout,sep='\t',chunksize=chunksize,names=self.header, dtype=dty)
+
+    def _region_reader(self, input, block, pos_range, dty, chunksize):
+        """
+        Same records as tabix input block:pos_range[0]-pos_range[1] for each block
+        """
+        reader = TabixReader(input)
+        logging.info(f"Query {len(block)} blocks in {input}")
+        buff = []
+        n_buff = 0
+        for b in block:
+            mtx = reader.fetch_array(str(b), pos_range[0], pos_range[1], len(self.header))
+            if mtx is None: # Non-numeric columns
+                data = reader.query_bytes(str(b), max(pos_range[0] - 1, 0), pos_range[1])
+                df = pd.read_csv(io.BytesIO(data), sep='\t', names=self.header, dtype=dty)
+                c_beg, c_end = [self.header[x - 1] for x in reader.conf[2:4]]
+                df = df.loc[reader.overlap(df[c_beg].values, df[c_end].values, pos_range[0], pos_range[1])]
+            else:
+                df = pd.DataFrame(mtx, columns=self.header)
+                for k, v in dty.items():
+                    if k not in df.columns:
+                        continue
+                    if v == str:
+                        df[k] = df[k].astype(int).astype(str)
+                    else:
+                        df[k] = df[k].astype(v)
+            buff.append(df)
+            n_buff += df.shape[0]
+            while n_buff >= chunksize:
+                df = pd.concat(buff, ignore_index=True)
+                yield df.iloc[:chunksize]
+                buff = [df.iloc[chunksize:]]
+                n_buff -= chunksize
+        reader.close()
+        if n_buff > 0:
+            yield pd.concat(buff, ignore_index=True)
 
     def __iter__(self):
         return self
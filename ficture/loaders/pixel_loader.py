@@ -1,26 +1,52 @@
 ### Read a batched pixel file, construct slda minibatch
 
 import sys, os, gzip, copy, re, logging
+import multiprocessing as mp
 import numpy as np
 import pandas as pd
 
-from scipy.sparse import coo_array
+from scipy.sparse import coo_array, csr_array, issparse
 import sklearn.neighbors
 import sklearn.preprocessing
 from joblib.parallel import Parallel, delayed
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from sklearn.decomposition._online_lda_fast import _dirichlet_expectation_2d
 
 from ficture.utils import utilt
+from ficture.utils.spatial_index import GridIndex
 from ficture.models.slda_minibatch import minibatch
+from ficture.models.online_slda import OnlineLDA
+
+_worker = {}
+
+def _init_decode_worker(shm_name, shape, dtype, param):
+    """
+    Attach to the shared Elog_beta and set up a decoder in a worker process
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name, track=False)
+    except TypeError: # python < 3.13
+        shm = shared_memory.SharedMemory(name=shm_name)
+    slda = OnlineLDA(vocab=np.arange(shape[1]), K=param['K'], N=1e6, alpha=param['alpha'], eta=param['eta'], zeta=param['zeta'], iter_gamma=param['iter_gamma'], iter_inner=param['iter_inner'], tol=param['tol'], verbose=param['verbose'], active_set=param['active_set'], active_tol=param['active_tol'], active_patience=param['active_patience'], max_factor=param['max_factor'], dtype=param['dtype'])
+    slda._Elog_beta = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    _worker['shm'] = shm
+    _worker['slda'] = slda
+
+def _decode_batch_worker(args):
+    b, local, init_bound = args
+    local.pixel_index = GridIndex(local.brc[['X','Y']].values, local.radius)
+    return local._decode_batch(b, _worker['slda'], init_bound)
 
 class PixelMinibatch:
 
-    def __init__(self, reader, ft_dict, batch_id, key, mu_scale, radius, halflife, adj_penal=-1, precision=0.1, thread=1, verbose=0) -> None:
+    def __init__(self, reader, ft_dict, batch_id, key, mu_scale, radius, halflife, adj_penal=-1, precision=0.1, thread=1, backend='threading', verbose=0, dtype=None) -> None:
         self.df_full = pd.DataFrame()
         self.pixel_reader = reader
         self.batch_id = batch_id
         self.mu_scale = mu_scale
         self.file_is_open = True
+        self.last_chunk = False
         self.ft_dict = ft_dict
         self.M = len(self.ft_dict)
         self.key = key
@@ -30,7 +56,11 @@ class PixelMinibatch:
         self.nu = np.log(.5) / np.log(halflife)
         self.out_buff = self.radius * halflife
         self.thread = thread
+        self.backend = backend
+        self.pool = None
+        self.shm = None
         self.verbose = verbose
+        self.dtype = dtype # Of the count matrix and the anchor initialization, default is that of the input
 
     def load_anchor(self, anchor_file, anchor_in_um = True):
         self.grid_info = pd.read_csv(anchor_file,sep='\t')
@@ -48,6 +78,7 @@ class PixelMinibatch:
         self.n = self.grid_info.shape[0]
         self.grid_info.index = range(self.n)
         self.ref = sklearn.neighbors.BallTree(np.array(self.grid_info.loc[:, ['x','y']]))
+        self.anchor_index = GridIndex(self.grid_info[['x','y']].values, 2 * self.radius)
         self.factor_header.sort()
         self.factor_header = [str(x) for x in self.factor_header]
         self.K = len(self.factor_header)
@@ -56,9 +87,25 @@ class PixelMinibatch:
     def _anchor_adj(self):
         if self.adj_penal < 0:
             self.adj_penal = self.radius * 2
-        self.adj_mtx = sklearn.neighbors.radius_neighbors_graph(self.ref, self.adj_penal, mode='connectivity', include_self=True) # Do we want to include diagonal?
+        self.adj_mtx = sklearn.neighbors.radius_neighbors_graph(self.grid_info[['x','y']].values, self.adj_penal, mode='connectivity', include_self=True) # Do we want to include diagonal?
 
     def read_chunk(self, nbatch):
+        return self.set_chunk(self.parse_chunk(nbatch))
+
+    def set_chunk(self, chunk):
+        """
+        Make a chunk returned by parse_chunk the current one to decode
+        """
+        for k, v in chunk.items():
+            setattr(self, k, v)
+        return len(self.batch_index)
+
+    def parse_chunk(self, nbatch):
+        """
+        Read pixels for at least nbatch minibatches, return the parsed
+        chunk without modifying the data currently being decoded
+        (so the next chunk can be parsed while the current one is decoded)
+        """
         batch_ids = set()
         while len(batch_ids) <= nbatch:
             try:
@@ -73,11 +120,12 @@ class PixelMinibatch:
             if self.precision > 0:
                 chunk.X = (chunk.X / self.precision).astype(int)
                 chunk.Y = (chunk.Y / self.precision).astype(int)
-                chunk = chunk.groupby(by=[self.batch_id,"gene","X","Y"]).agg({self.key: "sum"}).reset_index()
+                chunk = chunk.groupby(by=[self.batch_id,"gene","X","Y"], observed=True).agg({self.key: "sum"}).reset_index()
                 chunk.X *= self.precision
                 chunk.Y *= self.precision
-            random_pref = chunk[self.batch_id].map(lambda x : x[-5:]).values
-            chunk['j'] = random_pref + '_' + (chunk.X*100).astype(int).astype(str) + '_' + (chunk.Y*100).astype(int).astype(str)
+            if chunk.shape[0] == 0:
+                continue
+            chunk['j'] = self._pixel_key(chunk) # Local to this chunk
             # Keep pixels close enough to at least one anchor
             pts = chunk[["j", "X", "Y"]].drop_duplicates(subset="j")
             dist, indx = self.ref.query(X = np.array(pts[['X','Y']]), k = 1, return_distance = True)
@@ -98,166 +146,324 @@ class PixelMinibatch:
             self.df_full = self.df_full.loc[~self.df_full[self.batch_id].eq(last_indx), :]
 
         ### Process chunk of data
-        self.batch_index = list(self.df_full[self.batch_id].unique() )
-        self.brc = self.df_full[[self.batch_id,"j","X","Y"]].drop_duplicates(subset=["j"])
-        self.N0 = self.brc.shape[0]
-        self.brc.index = range(self.N0)
-        self.df_full = self.df_full.groupby(by = [self.batch_id, "j", "gene"]).agg({self.key:"sum"}).reset_index()
-        logging.info(f"Read {self.N0} pixels, forming {len(self.batch_index)} batches.")
-        self.bt = sklearn.neighbors.BallTree(np.asarray(self.brc[['X','Y']]))
-        # Make DGE
-        barcode_kept = list(self.brc['j'])
-        bc_dict = {x:i for i,x in enumerate( barcode_kept ) }
-        indx_row = [ bc_dict[x] for x in self.df_full['j']]
-        indx_col = [ self.ft_dict[x] for x in self.df_full['gene']]
-        self.dge_mtx = coo_array((self.df_full[self.key], (indx_row, indx_col)), shape=(self.N0, self.M)).tocsr()
+        df = self.df_full
         self.df_full = left
-        return len(self.batch_index)
+        if len(df) > 0: # Keys of the pixels across all chunks read
+            df['j'] = self._pixel_key(df)
+        batch_index = list(df[self.batch_id].unique() )
+        brc = df[[self.batch_id,"j","X","Y"]].drop_duplicates(subset=["j"])
+        N0 = brc.shape[0]
+        brc.index = range(N0)
+        logging.info(f"Read {N0} pixels, forming {len(batch_index)} batches.")
+        pixel_index = GridIndex(brc[['X','Y']].values, self.radius)
+        # Make DGE, rows in the same (first appearance) order as brc
+        indx_row = pd.factorize(df.j.values)[0]
+        indx_col = df.gene.map(self.ft_dict).values.astype(int)
+        dge_mtx = coo_array((df[self.key].values, (indx_row, indx_col)), shape=(N0, self.M), dtype=self.dtype).tocsr()
+        dge_mtx.sum_duplicates()
+        # Pixels of each minibatch are batch_order[st:ed]
+        codes, uniq = pd.factorize(brc[self.batch_id])
+        batch_order = np.argsort(codes, kind='stable')
+        ptr = np.searchsorted(codes[batch_order], np.arange(len(uniq) + 1))
+        batch_range = {x:(ptr[i], ptr[i+1]) for i,x in enumerate(uniq)}
+        return {'batch_index':batch_index, 'brc':brc, 'N0':N0, 'pixel_index':pixel_index,\
+                'dge_mtx':dge_mtx, 'batch_order':batch_order,\
+                'batch_range':batch_range, 'last_chunk':not self.file_is_open}
+
+    def _pixel_key(self, chunk):
+        """
+        Integer pixel keys identifying (minibatch, X, Y) within chunk, with
+        coordinates in 0.01um. The minibatch code and the coordinates
+        (offset by their minimum) are packed into one int64 when their
+        ranges fit, otherwise the tuples are factorized
+        """
+        codes = pd.factorize(chunk[self.batch_id])[0].astype(np.int64)
+        xq = (chunk.X.values * 100).astype(np.int64)
+        yq = (chunk.Y.values * 100).astype(np.int64)
+        xq -= xq.min()
+        yq -= yq.min()
+        bx, by = int(xq.max()).bit_length(), int(yq.max()).bit_length()
+        if int(codes.max()).bit_length() + bx + by > 63:
+            return pd.MultiIndex.from_arrays([codes, xq, yq]).factorize()[0]
+        return (codes << (bx + by)) | (xq << by) | yq
+
+    def _pixel_label(self, b_indx):
+        """
+        Pixel identifiers in the output, minibatch suffix and coordinates
+        """
+        tmp = self.brc.loc[b_indx, [self.batch_id, 'X', 'Y']]
+        j = tmp[self.batch_id].astype(str).str[-5:] + '_' + (tmp.X*100).astype(int).astype(str) + '_' + (tmp.Y*100).astype(int).astype(str)
+        return pd.DataFrame({'j':j.values, 'X':tmp.X.values, 'Y':tmp.Y.values})
+
+    def _batch_pixel(self, b):
+        st, ed = self.batch_range[b]
+        return self.batch_order[st:ed]
 
     def _prepare_batch(self, b, init_bound):
 
-        indx = self.brc[self.batch_id].eq(b)
-        x_min, x_max = self.brc.loc[indx, 'X'].min(), self.brc.loc[indx, 'X'].max()
-        y_min, y_max = self.brc.loc[indx, 'Y'].min(), self.brc.loc[indx, 'Y'].max()
-        grid_indx = (self.grid_info.x >= x_min - self.radius) &\
-                    (self.grid_info.x <= x_max + self.radius) &\
-                    (self.grid_info.y >= y_min - self.radius) &\
-                    (self.grid_info.y <= y_max + self.radius)
-        grid_pt = self.grid_info.loc[grid_indx, ["x","y"]]
+        indx = self._batch_pixel(b)
+        x, y = self.brc.X.values[indx], self.brc.Y.values[indx]
+        grid_indx = self.anchor_index.query_box(x.min() - self.radius, x.max() + self.radius,\
+                                                y.min() - self.radius, y.max() + self.radius)
+        grid_pt = self.grid_info.iloc[grid_indx][["x","y"]]
         if grid_pt.shape[0] < 10:
             return None, None, None, None
 
         # Initilize anchor
-        theta = np.array(self.grid_info.loc[grid_indx, self.factor_header])
+        theta = np.array(self.grid_info.iloc[grid_indx][self.factor_header])
         theta = sklearn.preprocessing.normalize(np.clip(theta, init_bound, 1.-init_bound), norm='l1', axis=1)
-        n = theta.shape[0]
-
-        # Pixel to anchor weight
-        indx, dist = self.bt.query_radius(X = np.array(grid_pt), r = self.radius, return_distance = True)
-        r_indx = [i for i,x in enumerate(indx) for y in range(len(x))] # anchor
-        c_indx = [x for y in indx for x in y] # pixel
-        wij = np.array([x for y in dist for x in y])
-        wij = 1-(wij / self.radius)**self.nu
-        wij = coo_array((wij, (r_indx,c_indx)),shape=(n,self.N0)).tocsc().T
-        wij.eliminate_zeros()
-        nchoice=(wij != 0).sum(axis = 1)
-        b_indx = np.arange(self.N0)[nchoice > 0]
-        wij = wij[b_indx, :]
-        wij.data = np.clip(wij.data, .05, .95)
+
+        b_indx, wij = self._pixel_weight(grid_pt.values)
+        if self.dtype is not None:
+            wij = wij.astype(self.dtype)
+            theta = theta.astype(self.dtype)
         return b_indx, grid_pt, wij, theta
 
-    def one_batch(self, batch_index, slda, init_bound):
+    def _pixel_weight(self, grid_pt):
+        """
+        Pixel to anchor weights 1-(d/radius)^nu, clipped to [.05, .95],
+        for pixels (indices into self.brc) with any nonzero weight
+        """
+        c_indx, r_indx, dist = self.pixel_index.query_radius(grid_pt, self.radius)
+        wij = 1-(dist / self.radius)**self.nu
+        kept = wij != 0
+        r_indx, c_indx, wij = r_indx[kept], c_indx[kept], np.clip(wij[kept], .05, .95)
+        b_indx, nchoice = np.unique(r_indx, return_counts=True)
+        wij = csr_array((wij, c_indx, np.r_[0, np.cumsum(nchoice)]), shape=(len(b_indx), grid_pt.shape[0]))
+        return b_indx, wij
+
+    def _decode_batch(self, b, slda, init_bound):
+        """
+        Decode one minibatch, return compact numpy results
+        (pixel indices into self.brc, phi, anchor coordinates, anchor size, anchor theta)
+        """
+        b_indx, grid_pt, wij, theta = self._prepare_batch(b, init_bound)
+        if b_indx is None:
+            return None
+        N = len(b_indx)
+        grid_pt = np.array(grid_pt)
+        x_min, y_min = grid_pt.min(axis = 0)
+        x_max, y_max = grid_pt.max(axis = 0)
+        psi_org = sklearn.preprocessing.normalize(wij, norm='l1', axis=1)
+        batch = minibatch()
+        batch.init_from_matrix(self.dge_mtx[b_indx, :], grid_pt, wij, psi = psi_org, m_gamma = theta)
+        _ = slda.do_e_step(batch)
+
+        expElog_theta = np.exp(_dirichlet_expectation_2d(batch.gamma))
+        expElog_theta/= expElog_theta.sum(axis = 1).reshape((-1, 1))
+        asum = np.asarray(batch.psi.T @ batch.mtx.sum(axis = 1).reshape((-1, 1))).reshape(-1)
+        phi = batch.phi
+        if not self.last_chunk:
+            xy = np.asarray(self.brc.loc[b_indx, ['X','Y']])
+            v = np.arange(N)[(xy[:, 0] > x_min+self.out_buff) &\
+                             (xy[:, 0] < x_max-self.out_buff) &\
+                             (xy[:, 1] > y_min+self.out_buff) &\
+                             (xy[:, 1] < y_max-self.out_buff)]
+            b_indx = b_indx[v]
+            phi = phi[v, :]
+            u = (grid_pt[:, 0] > x_min+self.out_buff) & \
+                (grid_pt[:, 0] < x_max-self.out_buff) & \
+                (grid_pt[:, 1] > y_min+self.out_buff) & \
+                (grid_pt[:, 1] < y_max-self.out_buff)
+            grid_pt = grid_pt[u, :]
+            asum = asum[u]
+            expElog_theta = expElog_theta[u, :]
+        return b_indx, phi, grid_pt, asum, expElog_theta
 
-        pixel_result = pd.DataFrame()
-        anchor_result = pd.DataFrame()
+    def _format_batch(self, b, result):
+        b_indx, phi, grid_pt, asum, expElog_theta = result
+        tmp = self._pixel_label(b_indx)
+        if issparse(phi):
+            phi = phi.toarray()
+        pixel = pd.concat([tmp, pd.DataFrame(phi, \
+                           columns = self.factor_header)], axis = 1)
+        anchor = pd.DataFrame({'minibatch':b,'X':grid_pt[:,0],'Y':grid_pt[:,1]})
+        anchor['avg_size'] = asum
+        for v in range(self.K):
+            anchor[str(v)] = expElog_theta[:, v]
+        return pixel, anchor
+
+    def _decode_batches(self, batch_index, slda, init_bound):
+        results = []
         post_count = np.zeros((self.K, self.M))
         for b in batch_index:
-            b_indx, grid_pt, wij, theta = self._prepare_batch(b, init_bound)
-            if b_indx is None:
+            result = self._decode_batch(b, slda, init_bound)
+            if result is None:
                 continue
-            N = len(b_indx)
-            grid_pt = np.array(grid_pt)
-            x_min, y_min = grid_pt.min(axis = 0)
-            x_max, y_max = grid_pt.max(axis = 0)
-            psi_org = sklearn.preprocessing.normalize(wij, norm='l1', axis=1)
-            batch = minibatch()
-            batch.init_from_matrix(self.dge_mtx[b_indx, :], grid_pt, wij, psi = psi_org, m_gamma = theta)
-            _ = slda.do_e_step(batch)
-
-            tmp = copy.copy(self.brc.loc[b_indx, ['j','X','Y']] )
-            tmp.index = range(tmp.shape[0])
-            tmp = pd.concat([tmp, pd.DataFrame(batch.phi, \
-                             columns = self.factor_header)], axis = 1)
-            if self.file_is_open:
-                v = np.arange(N)[(tmp.X > x_min+self.out_buff) &\
-                                (tmp.X < x_max-self.out_buff) &\
-                                (tmp.Y > y_min+self.out_buff) &\
-                                (tmp.Y < y_max-self.out_buff)]
-                post_count += batch.phi[v, :].T @ batch.mtx[v, :]
-                tmp = tmp.iloc[v, :]
-            else:
-                post_count += batch.phi.T @ batch.mtx
-            pixel_result = pd.concat([pixel_result, tmp], axis = 0)
-
-            expElog_theta = np.exp(_dirichlet_expectation_2d(batch.gamma))
-            expElog_theta/= expElog_theta.sum(axis = 1).reshape((-1, 1))
-            tmp = pd.DataFrame({'minibatch':b,'X':grid_pt[:,0],'Y':grid_pt[:,1]})
-            asum = batch.psi.T @ batch.mtx.sum(axis = 1).reshape((-1, 1))
-            tmp['avg_size'] = np.array(asum).reshape(-1)
-            for v in range(self.K):
-                tmp[str(v)] = expElog_theta[:, v]
-            if self.file_is_open:
-                tmp = tmp.loc[(tmp.X > x_min+self.out_buff) & \
-                            (tmp.X < x_max-self.out_buff) & \
-                            (tmp.Y > y_min+self.out_buff) & \
-                            (tmp.Y < y_max-self.out_buff), :]
-            anchor_result = pd.concat([anchor_result, tmp], axis = 0)
-        return post_count, pixel_result, anchor_result
+            post_count += result[1].T @ self.dge_mtx[result[0], :]
+            results.append((b, result))
+        return post_count, results
 
-    def run_chunk(self, slda, init_bound):
+    def one_batch(self, batch_index, slda, init_bound):
+        post_count, results = self._decode_batches(batch_index, slda, init_bound)
+        return (post_count,) + self._format_chunk(results)
+
+    def _format_chunk(self, results):
+        pixel_result = []
+        anchor_result = []
+        for b, result in results:
+            tmp_pixel, tmp_anchor = self._format_batch(b, result)
+            pixel_result.append(tmp_pixel)
+            anchor_result.append(tmp_anchor)
+        if len(pixel_result) == 0:
+            return pd.DataFrame(), pd.DataFrame()
+        return pd.concat(pixel_result, axis = 0), pd.concat(anchor_result, axis = 0)
+
+    def pixel_output(self, b_indx):
+        """
+        Minibatch id suffix (used in output pixel identifiers) and coordinates of pixels
+        """
+        codes, uniq = pd.factorize(self.brc[self.batch_id].values[b_indx])
+        suffix = np.array([str(x)[-5:] for x in uniq], dtype=object)[codes]
+        xy = np.column_stack([self.brc.X.values[b_indx], self.brc.Y.values[b_indx]])
+        return suffix, xy
+
+    def _local_copy(self, b):
+        """
+        A minimal copy of the current chunk containing everything needed
+        to decode minibatch b: anchors within radius of the minibatch and
+        pixels within radius of those anchors
+        """
+        indx = self._batch_pixel(b)
+        x, y = self.brc.X.values, self.brc.Y.values
+        x_min, x_max = x[indx].min() - 2 * self.radius, x[indx].max() + 2 * self.radius
+        y_min, y_max = y[indx].min() - 2 * self.radius, y[indx].max() + 2 * self.radius
+        pix_indx = np.arange(self.N0)[(x >= x_min) & (x <= x_max) &\
+                                     (y >= y_min) & (y <= y_max)]
+        grid_indx = self.anchor_index.query_box(x_min + self.radius, x_max - self.radius,\
+                                                y_min + self.radius, y_max - self.radius)
+        local = copy.copy(self)
+        local.pixel_reader = None
+        local.pool = None
+        local.shm = None
+        local.ft_dict = None
+        local.df_full = None
+        local.adj_mtx = None
+        local.ref = None
+        local.pixel_index = None
+        local.batch_index = [b]
+        local.grid_info = self.grid_info.iloc[grid_indx][['x','y'] + self.factor_header]
+        local.anchor_index = GridIndex(local.grid_info[['x','y']].values, 2 * self.radius)
+        local.batch_order = np.sort(np.searchsorted(pix_indx, indx))
+        local.batch_range = {b:(0, len(indx))}
+        local.brc = self.brc.loc[pix_indx, [self.batch_id, 'X', 'Y']]
+        local.brc.index = range(len(pix_indx))
+        local.N0 = len(pix_indx)
+        local.dge_mtx = self.dge_mtx[pix_indx, :]
+        return local, pix_indx
+
+    def _process_pool(self, slda):
+        if self.pool is not None:
+            return self.pool
+        Elog_beta = np.ascontiguousarray(slda._Elog_beta)
+        self.shm = shared_memory.SharedMemory(create=True, size=Elog_beta.nbytes)
+        np.ndarray(Elog_beta.shape, dtype=Elog_beta.dtype, buffer=self.shm.buf)[:] = Elog_beta
+        param = {'K':slda._K, 'alpha':slda._alpha, 'tol':slda._tol,\
+                 'eta':slda._eta, 'zeta':slda._zeta, 'iter_gamma':slda._max_iter_gamma,\
+                 'iter_inner':slda._max_iter_inner, 'verbose':slda._verbose,\
+                 'active_set':slda._active_set, 'active_tol':slda._active_tol,\
+                 'active_patience':slda._active_patience,\
+                 'max_factor':slda._max_factor, 'dtype':slda._dtype.str}
+        # Spawn, the caller may have other threads running (see slda_decode)
+        self.pool = ProcessPoolExecutor(max_workers=self.thread, \
+            mp_context=mp.get_context("spawn"), initializer=_init_decode_worker, \
+            initargs=(self.shm.name, Elog_beta.shape, Elog_beta.dtype.str, param))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def decode_chunk(self, slda, init_bound):
+        """
+        Decode all minibatches in the current chunk, return the posterior
+        count and a list of (minibatch, result) (see _decode_batch)
+        """
+        if self.thread > 1 and self.backend == 'process':
+            pool = self._process_pool(slda)
+            tasks = [self._local_copy(b) for b in self.batch_index]
+            results = pool.map(_decode_batch_worker, [(b, x[0], init_bound) for b, x in zip(self.batch_index, tasks)])
+            output = []
+            post_count = np.zeros((self.K, self.M))
+            for b, (_, pix_indx), result in zip(self.batch_index, tasks, results):
+                if result is None:
+                    continue
+                result = (pix_indx[result[0]],) + result[1:]
+                post_count += result[1].T @ self.dge_mtx[result[0], :]
+                output.append((b, result))
+            return post_count, output
         if self.thread > 1:
             idx_slices = [[ self.batch_index[x] for x in y ] for y in utilt.gen_even_slices(len(self.batch_index), self.thread)]
             with Parallel( n_jobs=self.thread, backend='threading', verbose=self.verbose) as parallel:
-                result_list = parallel(delayed(self.one_batch)(idx, slda, init_bound) for idx in idx_slices)
-            pixel_result = pd.DataFrame()
-            anchor_result = pd.DataFrame()
+                result_list = parallel(delayed(self._decode_batches)(idx, slda, init_bound) for idx in idx_slices)
+            output = []
             post_count = np.zeros((self.K, self.M))
             for obj in result_list:
                 post_count += obj[0]
-                pixel_result = pd.concat([pixel_result, obj[1]], axis = 0)
-                anchor_result = pd.concat([anchor_result, obj[2]], axis = 0)
-            return post_count, pixel_result, anchor_result
+                output += obj[1]
+            return post_count, output
         else:
-            return self.one_batch(self.batch_index, slda, init_bound)
+            return self._decode_batches(self.batch_index, slda, init_bound)
+
+    def run_chunk(self, slda, init_bound):
+        post_count, results = self.decode_chunk(slda, init_bound)
+        return (post_count,) + self._format_chunk(results)
+
+
 
+    def _penalized_batch(self, b, slda, init_bound):
+        """
+        Decode one minibatch with the proximal contamination penalty and
+        update the global parameters of slda.
+        Return a result as in _decode_batch
+        """
+        b_indx, grid_pt, wij, theta = self._prepare_batch(b, init_bound)
+        if b_indx is None:
+            return None
+        N = len(b_indx)
+        anchor_index = grid_pt.index.to_list()
+        grid_pt = np.array(grid_pt)
+        psi_org = sklearn.preprocessing.normalize(wij, norm='l1', axis=1)
+        batch = minibatch()
+        batch.init_from_matrix(self.dge_mtx[b_indx, :], grid_pt, wij, psi = psi_org, m_gamma = theta, anchor_adj = self.adj_mtx[anchor_index, :][:, anchor_index])
+        _ = slda.update_lambda_penalized(batch)
 
+        expElog_theta = np.exp(_dirichlet_expectation_2d(batch.gamma))
+        expElog_theta/= expElog_theta.sum(axis = 1).reshape((-1, 1))
+        asum = np.asarray(batch.psi.T @ batch.mtx.sum(axis = 1).reshape((-1, 1))).reshape(-1)
+        xy = np.asarray(self.brc.loc[b_indx, ['X','Y']])
+        x_min, y_min = xy.min(axis = 0)
+        x_max, y_max = xy.max(axis = 0)
+        v = np.arange(N)[(xy[:, 0] > x_min+self.out_buff) &\
+                         (xy[:, 0] < x_max-self.out_buff) &\
+                         (xy[:, 1] > y_min+self.out_buff) &\
+                         (xy[:, 1] < y_max-self.out_buff)]
+        u = (grid_pt[:, 0] > x_min+self.out_buff) & \
+            (grid_pt[:, 0] < x_max-self.out_buff) & \
+            (grid_pt[:, 1] > y_min+self.out_buff) & \
+            (grid_pt[:, 1] < y_max-self.out_buff)
+        return (b_indx[v], batch.phi[v, :], grid_pt[u, :], asum[u], expElog_theta[u, :])
 
     def run_chunk_penalized(self, slda, init_bound):
+        """
+        Decode the current chunk with the proximal contamination penalty,
+        updating the global parameters after each minibatch. Minibatches
+        are decoded in order (each depends on the previous update)
+        """
         assert slda._zeta > 0 and slda._zeta < 1, "To run slda with penalized likelihood, please set slda.zeta within (0,1)"
         if self.adj_mtx is None:
             self._anchor_adj()
-        pixel_result = pd.DataFrame()
-        anchor_result = pd.DataFrame()
         post_count = np.zeros((self.K, self.M))
+        output = []
         for b in self.batch_index:
-            b_indx, grid_pt, wij, theta = self._prepare_batch(b, init_bound)
-            if b_indx is None:
+            result = self._penalized_batch(b, slda, init_bound)
+            if result is None:
                 continue
-            N = len(b_indx)
-            anchor_index = grid_pt.index.to_list()
-            grid_pt = np.array(grid_pt)
-            psi_org = sklearn.preprocessing.normalize(wij, norm='l1', axis=1)
-            batch = minibatch()
-            batch.init_from_matrix(self.dge_mtx[b_indx, :], grid_pt, wij, psi = psi_org, m_gamma = theta, anchor_adj = self.adj_mtx[anchor_index, :][:, anchor_index])
-
-            _ = slda.update_lambda_penalized(batch)
-
-            tmp = self.brc.iloc[b_indx, :]
-            x_min, x_max = tmp.X.min(), tmp.X.max()
-            y_min, y_max = tmp.Y.min(), tmp.Y.max()
-            v = np.arange(N)[(tmp.X > x_min+self.out_buff) &\
-                             (tmp.X < x_max-self.out_buff) &\
-                             (tmp.Y > y_min+self.out_buff) &\
-                             (tmp.Y < y_max-self.out_buff)]
-            post_count += batch.phi[v, :].T @ batch.mtx[v, :]
-
-            tmp = copy.copy(self.brc.loc[b_indx, ['j','X','Y']] )
-            tmp.index = range(tmp.shape[0])
-            tmp = pd.concat([tmp, pd.DataFrame(batch.phi, \
-                             columns = self.factor_header)], axis = 1)
-            tmp = tmp.iloc[v, :]
-            pixel_result = pd.concat([pixel_result, tmp], axis = 0)
-
-            expElog_theta = np.exp(_dirichlet_expectation_2d(batch.gamma))
-            expElog_theta/= expElog_theta.sum(axis = 1).reshape((-1, 1))
-            tmp = pd.DataFrame({'minibatch':b,'X':grid_pt[:,0],'Y':grid_pt[:,1]})
-            asum = batch.psi.T @ batch.mtx.sum(axis = 1).reshape((-1, 1))
-            tmp['avg_size'] = np.array(asum).reshape(-1)
-            for v in range(self.K):
-                tmp[str(v)] = expElog_theta[:, v]
-            tmp = tmp.loc[(tmp.X > x_min+self.out_buff) & \
-                          (tmp.X < x_max-self.out_buff) & \
-                          (tmp.Y > y_min+self.out_buff) & \
-                          (tmp.Y < y_max-self.out_buff), :]
-            anchor_result = pd.concat([anchor_result, tmp], axis = 0)
-        return post_count, pixel_result, anchor_result
+            post_count += result[1].T @ self.dge_mtx[result[0], :]
+            output.append((b, result))
+        return (post_count,) + self._format_chunk(output)
@@ -7,13 +7,13 @@ If input contains a column provided by region_id, each region is processed separ
 import sys, os
 import numpy as np
 import pandas as pd
-from scipy.sparse import coo_array, vstack
+from scipy.sparse import csr_array, vstack
 
 from ficture.utils.hexagon_fn import *
 
 class PixelToUnit:
 
-    def __init__(self, reader, ft_dict, key, radius, scale=1, region_id=None, min_ct_per_unit=1, sliding_step=1, major_axis=None, xy_lattice=False) -> None:
+    def __init__(self, reader, ft_dict, key, radius, scale=1, region_id=None, min_ct_per_unit=1, sliding_step=1, major_axis=None, xy_lattice=False, dtype=np.float64) -> None:
         self.reader = reader
         self.ft_dict = ft_dict
         self.M = len(self.ft_dict)
@@ -31,6 +31,7 @@ class PixelToUnit:
         self.brc = None
         self.mtx = None
         self.lattice = xy_lattice
+        self.dtype = dtype
         self.n_batch = 0
         self.bound = self.radius * np.sqrt(3)/2
 
@@ -89,40 +90,14 @@ class PixelToUnit:
             region_list = region_list[:-1]
         elif self.Y is not None:
             left = self.df.loc[self.df[self.region_id].eq(region_list[-1]) & (self.df[self.mj] > mj_range[1])]
-        self.df['hex_id'] = ''
-        self.brc = pd.DataFrame()
-        self.mtx = coo_array(([], ([], [])), shape = (0, self.M))
+        brc_list, mtx_list = [], []
         for reg in region_list:
-            indx = self.df[self.region_id].eq(reg)
-            for offs_x in range(self.n_move):
-                for offs_y in range(self.n_move):
-                    offs_iden = str(offs_x) + '_' + str(offs_y)
-                    x, y = pixel_to_hex(self.df.loc[indx, ['X', 'Y']].values, self.radius, offs_x/self.n_move, offs_y/self.n_move)
-                    self.df.loc[indx, "hex_id"] = list(zip(x, y))
-                    ct = self.df[indx].groupby('hex_id').agg({self.key: "sum"}).reset_index()
-                    ct.drop(index = ct.index[ct[self.key] < self.min_ct_per_unit], inplace=True)
-                    if len(ct) < 1:
-                        continue
-                    bt_dict = {x:i for i,x in enumerate(ct.hex_id.values)}
-                    N = len(bt_dict)
-                    brc = self.df[indx & self.df.hex_id.isin(bt_dict)].groupby(by = ['hex_id', 'gene']).agg({self.key: "sum"}).reset_index()
-                    self.mtx = vstack([self.mtx, coo_array((brc[self.key].values, (brc.hex_id.map(bt_dict).values, brc.gene.map(self.ft_dict).values) ), shape = (N, self.M))])
-                    if self.lattice:
-                        ct['x'], ct['y'] = \
-                            hex_to_pixel([v[0] for v in ct.hex_id.values],\
-                                         [v[1] for v in ct.hex_id.values],\
-                            self.radius, offs_x/self.n_move, offs_y/self.n_move)
-                    else:
-                        ct = brc.groupby(by = ['hex_id']).agg({self.key: sum,\
-                            'X': np.median, 'Y':np.median}).reset_index()
-                        ct.rename(columns = {'X':'x', 'Y':'y'}, inplace=True)
-                    ct.index = ct.hex_id.map(bt_dict)
-                    ct.sort_index(inplace=True)
-                    ct['hex_id'] = ct.hex_id.map(lambda x : '_'.join([str(u) for u in x]))
-                    ct.hex_id = offs_iden + '_' + ct.hex_id.values
-                    ct[self.region_id] = reg
-                    self.brc = pd.concat([self.brc, ct])
-        self.mtx = self.mtx.tocsr()
+            brc, mtx = self._hex_bin(self.df[self.df[self.region_id].eq(reg)])
+            brc[self.region_id] = reg
+            brc_list.append(brc)
+            mtx_list.append(mtx)
+        self.brc = pd.concat(brc_list) if len(brc_list) > 0 else pd.DataFrame()
+        self.mtx = vstack(mtx_list, format='csr') if len(mtx_list) > 0 else csr_array((0, self.M), dtype=self.dtype)
         self.df = left
         self.brc.index = range(self.brc.shape[0])
         return self.brc.shape[0]
@@ -156,41 +131,64 @@ class PixelToUnit:
             mj_size = mj_range[0] - mj_range[1]
             mi_size = mi_range[0] - mi_range[1]
             self.df = pd.concat([self.df, chunk])
-        self.df['hex_id'] = ''
-        self.brc = pd.DataFrame()
-        self.mtx = coo_array(([], ([], [])), shape = (0, self.M))
-        for offs_x in range(self.n_move):
-            for offs_y in range(self.n_move):
-                offs_iden = str(offs_x) + '_' + str(offs_y)
-                x, y = pixel_to_hex(self.df[['X', 'Y']].values, self.radius, offs_x/self.n_move, offs_y/self.n_move)
-                self.df.hex_id = list(zip(x, y))
-                ct = self.df.groupby('hex_id').agg({self.key: "sum"}).reset_index()
-                ct['X'], ct['Y'] = \
-                        hex_to_pixel([v[0] for v in ct.hex_id.values],\
-                                     [v[1] for v in ct.hex_id.values],\
-                        self.radius, offs_x/self.n_move, offs_y/self.n_move)
-                # Drop hexagons with centers within sqrt(3)*raidus/2 from each boundary
-                ct.drop(index = ct.index[\
-                    (ct[self.mj].lt(mj_range[1] + self.bound) ) | \
-                    (ct[self.mj].gt(mj_range[0] - self.bound) ) ], inplace=True)
-                ct.drop(index = ct.index[ct[self.key] < self.min_ct_per_unit], inplace=True)
-                if len(ct) < 1:
-                    continue
-                bt_dict = {x:i for i,x in enumerate(ct.hex_id.values)}
-                N = len(bt_dict)
-                brc = self.df[self.df.hex_id.isin(bt_dict)].groupby(by = ['hex_id', 'gene']).agg({self.key: "sum"}).reset_index()
-                self.mtx = vstack([self.mtx, coo_array((brc[self.key].values, (brc.hex_id.map(bt_dict).values, brc.gene.map(self.ft_dict).values) ), shape = (N, self.M))])
-                if not self.lattice:
-                    ct = brc.groupby(by = ['hex_id']).agg({self.key: sum, 'X': np.median, 'Y':np.median}).reset_index()
-                ct.rename(columns = {'X':'x', 'Y':'y'}, inplace=True)
-                ct.index = ct.hex_id.map(bt_dict)
-                ct.sort_index(inplace=True)
-                ct['hex_id'] = ct.hex_id.map(lambda x : '_'.join([str(u) for u in x]))
-                ct.hex_id = offs_iden + '_' + ct.hex_id.values
-                self.brc = pd.concat([self.brc, ct])
+        self.brc, self.mtx = self._hex_bin(self.df, mj_range)
         self.df = self.df[self.df[self.mj] >= mj_range[0] - 2 * self.radius]
-        self.df.drop(columns = ['hex_id'], inplace = True)
-        self.mtx = self.mtx.tocsr()
         self.brc.index = range(self.brc.shape[0])
         self.n_batch += 1
         return self.brc.shape[0]
+
+    def _hex_bin(self, df, mj_range = None):
+        """
+        Group pixels in df into hexagons under all n_move x n_move offsets
+        in one pass. Each (offset, hexagon) is encoded as an int64 key,
+        counts are aggregated by sorting (key, gene) pairs.
+        If mj_range is provided, drop hexagons with centers within
+        sqrt(3)*radius/2 from its ends.
+        Return a data frame of units (hex_id, count, x, y) and their CSR count matrix
+        """
+        if df.shape[0] == 0:
+            return pd.DataFrame(columns = ['hex_id', self.key, 'x', 'y']), csr_array((0, self.M), dtype=self.dtype)
+        n_off = self.n_move ** 2
+        pts = df[['X', 'Y']].values
+        hx = np.empty((n_off, len(pts)), dtype=np.int64)
+        hy = np.empty((n_off, len(pts)), dtype=np.int64)
+        for o in range(n_off):
+            hx[o], hy[o] = pixel_to_hex(pts, self.radius, (o // self.n_move)/self.n_move, (o % self.n_move)/self.n_move)
+        x0, y0 = hx.min(), hy.min()
+        nx, ny = int(hx.max() - x0 + 1), int(hy.max() - y0 + 1)
+        assert n_off * nx * ny * self.M < 2**63, "Too many hexagons in one chunk, try a smaller chunk size"
+        # Key sorts by offset, then by hexagon (x, y)
+        key = (np.arange(n_off).reshape((-1, 1)) * nx + hx - x0) * ny + hy - y0
+        del hx, hy
+        full = (key * self.M + df.gene.map(self.ft_dict).values.astype(np.int64)).reshape(-1)
+        order = np.argsort(full)
+        full = full[order]
+        st = np.flatnonzero(np.r_[True, full[1:] != full[:-1]])
+        val = np.add.reduceat(np.tile(df[self.key].values, n_off)[order], st)
+        unit, gene = np.divmod(full[st], self.M)
+        del full, order
+        ust = np.flatnonzero(np.r_[True, unit[1:] != unit[:-1]])
+        nnz = np.diff(np.r_[ust, len(unit)])
+        unit = unit[ust]
+        unit_ct = np.add.reduceat(val, ust)
+        o, u = np.divmod(unit, nx * ny)
+        ux, uy = np.divmod(u, ny)
+        offs_x, offs_y = np.divmod(o, self.n_move)
+        ux += x0
+        uy += y0
+        x, y = hex_to_pixel(ux, uy, self.radius, offs_x/self.n_move, offs_y/self.n_move)
+        kept = unit_ct >= self.min_ct_per_unit
+        if mj_range is not None:
+            c = x if self.mj == 'X' else y
+            kept &= (c >= mj_range[1] + self.bound) & (c <= mj_range[0] - self.bound)
+        entry = np.repeat(kept, nnz)
+        mtx = csr_array((val[entry].astype(self.dtype), gene[entry], np.r_[0, np.cumsum(nnz[kept])]), shape = (kept.sum(), self.M))
+        hex_id = pd.Series(offs_x[kept]).astype(str) + '_' + pd.Series(offs_y[kept]).astype(str) + '_' +\
+                 pd.Series(ux[kept]).astype(str) + '_' + pd.Series(uy[kept]).astype(str)
+        brc = pd.DataFrame({'hex_id':hex_id.values, self.key:unit_ct[kept], 'x':x[kept], 'y':y[kept]})
+        if not self.lattice:
+            # Median of pixel coordinates in each hexagon
+            med = pd.DataFrame({'unit':key.reshape(-1), 'x':np.tile(pts[:, 0], n_off), 'y':np.tile(pts[:, 1], n_off)}).groupby('unit').median()
+            brc['x'] = med.x.loc[unit[kept]].values
+            brc['y'] = med.y.loc[unit[kept]].values
+        return brc, mtx
@@ -0,0 +1,145 @@
+### Parsed unit x feature counts of a DGE (sorted by unit), kept in memory
+### or saved to a directory and memory-mapped, so that later passes over
+### the same input slice batches from the matrix instead of parsing text
+import os, json, hashlib
+import numpy as np
+from scipy.sparse import csr_array
+
+def cache_path(root, signature):
+    """
+    Subdirectory of root for the cache of the input and parameters
+    described by signature (a json serializable dict)
+    """
+    sig = json.dumps(signature, sort_keys=True, default=str)
+    path = os.path.join(root, hashlib.sha1(sig.encode()).hexdigest()[:16])
+    os.makedirs(path, exist_ok=True)
+    f = os.path.join(path, "signature.json")
+    if not os.path.exists(f):
+        with open(f, 'w') as wf:
+            wf.write(sig)
+    return path
+
+def file_signature(file):
+    """Path, size and modification time of an input file"""
+    st = os.stat(file)
+    return {"file":os.path.abspath(file), "size":st.st_size, "mtime":st.st_mtime_ns}
+
+def save_csr(path, name, x):
+    for k in ["data", "indices", "indptr"]:
+        np.save(os.path.join(path, f"{name}.{k}.npy"), getattr(x, k))
+    with open(os.path.join(path, f"{name}.json"), 'w') as wf:
+        json.dump({"shape":list(x.shape)}, wf)
+
+def has_csr(path, name):
+    return os.path.exists(os.path.join(path, f"{name}.json"))
+
+def load_csr(path, name, mmap=True):
+    """Load a CSR matrix saved by save_csr, memory-mapped (read only) by default"""
+    with open(os.path.join(path, f"{name}.json"), 'r') as rf:
+        shape = tuple(json.load(rf)["shape"])
+    mode = 'r' if mmap else None
+    data, indices, indptr = [np.load(os.path.join(path, f"{name}.{k}.npy"), mmap_mode=mode) for k in ["data", "indices", "indptr"]]
+    return csr_array((data, indices, indptr), shape=shape, copy=False)
+
+class UnitCache:
+    """
+    Units read by a UnitLoader, stored as one CSR matrix with the batch
+    boundaries and the epoch labels seen after each batch, so that
+    CachedUnitLoader replays exactly the batches of the original pass
+    """
+
+    def __init__(self, data, indices, indptr, shape, batch_ptr, batch_epoch, epoch_label, complete):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = tuple(shape)
+        self.batch_ptr = batch_ptr # Row offset of each batch, length n_batch + 1
+        self.batch_epoch = batch_epoch # Number of epoch labels seen after each batch
+        self.epoch_label = list(epoch_label)
+        self.complete = complete # False if reading stopped before the end of the file
+
+    @property
+    def n_epoch(self):
+        return len(self.epoch_label)
+
+    @property
+    def n_batch(self):
+        return len(self.batch_ptr) - 1
+
+    @classmethod
+    def from_loader(cls, loader, bsize, max_epoch=None):
+        """
+        Read all batches from loader (a UnitLoader), or until more than
+        max_epoch epoch labels are seen
+        """
+        data, indices, nnz, batch_ptr, batch_epoch = [], [], [], [0], []
+        while loader.update_batch(bsize):
+            mtx = loader.mtx
+            data.append(mtx.data)
+            indices.append(mtx.indices)
+            nnz.append(np.diff(mtx.indptr))
+            batch_ptr.append(batch_ptr[-1] + mtx.shape[0])
+            batch_epoch.append(len(loader.batch_id_list))
+            if max_epoch is not None and len(loader.batch_id_list) > max_epoch:
+                break
+        dtype = loader.dtype if loader.dtype is not None else (data[0].dtype if len(data) > 0 else np.float64)
+        data = np.concatenate(data) if len(data) > 0 else np.zeros(0, dtype=dtype)
+        indices = np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=np.int32)
+        indptr = np.r_[0, np.cumsum(np.concatenate(nnz))] if len(nnz) > 0 else np.zeros(1, dtype=np.int64)
+        return cls(data, indices, indptr, (batch_ptr[-1], loader.M),\
+                   np.array(batch_ptr, dtype=np.int64), np.array(batch_epoch, dtype=np.int64),\
+                   loader.batch_id_list, not loader.file_is_open)
+
+    def save(self, path):
+        for k in ["data", "indices", "indptr", "batch_ptr", "batch_epoch"]:
+            np.save(os.path.join(path, f"unit.{k}.npy"), getattr(self, k))
+        # Written last, marks the cache as usable
+        with open(os.path.join(path, "unit.json"), 'w') as wf:
+            json.dump({"shape":list(self.shape), "epoch_label":self.epoch_label, "complete":self.complete}, wf)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "unit.json"))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, "unit.json"), 'r') as rf:
+            meta = json.load(rf)
+        mode = 'r' if mmap else None
+        arr = {k:np.load(os.path.join(path, f"unit.{k}.npy"), mmap_mode=mode) for k in ["data", "indices", "indptr", "batch_ptr", "batch_epoch"]}
+        return cls(arr["data"], arr["indices"], arr["indptr"], meta["shape"],\
+                   np.array(arr["batch_ptr"]), np.array(arr["batch_epoch"]),\
+                   meta["epoch_label"], meta["complete"])
+
+    def rows(self, st, ed):
+        """Rows st to ed-1 as an in-memory CSR matrix"""
+        a, b = self.indptr[st], self.indptr[ed]
+        return csr_array((np.array(self.data[a:b]), np.array(self.indices[a:b]), np.array(self.indptr[st:ed+1]) - a), shape=(ed - st, self.shape[1]))
+
+    def loader(self, epoch=2**15):
+        return CachedUnitLoader(self, epoch=epoch)
+
+class CachedUnitLoader:
+    """
+    Replays the batches of a UnitCache with the interface used by
+    fit_model of UnitLoader (update_batch, mtx, batch_id_list)
+    """
+
+    def __init__(self, cache, epoch=2**15) -> None:
+        self.cache = cache
+        self.epoch = epoch
+        self.mtx = None
+        self.batch_id_list = []
+        self.file_is_open = cache.n_batch > 0
+        self.b = 0
+
+    def update_batch(self, bsize=None):
+        """Next cached batch, bsize was fixed when the cache was built"""
+        if len(self.batch_id_list) > self.epoch or not self.file_is_open:
+            return 0
+        st, ed = self.cache.batch_ptr[self.b], self.cache.batch_ptr[self.b+1]
+        self.mtx = self.cache.rows(st, ed)
+        self.batch_id_list = self.cache.epoch_label[:self.cache.batch_epoch[self.b]]
+        self.b += 1
+        self.file_is_open = self.b < self.cache.n_batch
+        return ed - st
@@ -2,7 +2,7 @@
 import sys, os, gzip, copy, re
 import numpy as np
 import pandas as pd
-from scipy.sparse import coo_array
+from scipy.sparse import coo_array, csr_array
 
 from ficture.models.lda_minibatch import PairedMinibatch
 
@@ -43,7 +43,7 @@ class UnitLoaderAugmented:
             left = self.df[self.df.unit == last_indx]
             self.df = self.df[self.df.unit != last_indx]
         self.brc = self.df[['unit']+self.unit_attr].drop_duplicates(subset=['unit'])
-        self.brc = self.brc.merge(right = self.df.groupby(by='unit').agg({self.key:"sum", self.bkey:"sum"}).reset_index(), on = 'unit', how = 'inner' )
+        self.brc = self.brc.merge(right = self.df.groupby(by='unit', observed=True).agg({self.key:"sum", self.bkey:"sum"}).reset_index(), on = 'unit', how = 'inner' )
         self.brc = self.brc[self.brc[self.key] >= self.min_ct_per_unit]
         buffer_weight = self.brc[self.bkey].values / (self.brc[self.bkey].values + self.brc[self.key].values)
         barcode_kept=list(self.brc.unit)
@@ -54,12 +54,12 @@ class UnitLoaderAugmented:
             self.batch_id_list.update(set(self.df.unit.map(lambda x : x[:self.prefix]).values))
         self.batch = PairedMinibatch(\
             mtx_focal = coo_array((self.df[self.key].values, \
-                            (self.df.unit.map(bt_dict).values, \
-                             self.df.gene.map(self.ft_dict).values) ), \
+                            (self.df.unit.map(bt_dict).values.astype(int), \
+                             self.df.gene.map(self.ft_dict).values.astype(int)) ), \
                             shape=(N, self.M)).tocsr(),
             mtx_buffer = coo_array((self.df[self.bkey].values, \
-                            (self.df.unit.map(bt_dict).values, \
-                             self.df.gene.map(self.ft_dict).values) ), \
+                            (self.df.unit.map(bt_dict).values.astype(int), \
+                             self.df.gene.map(self.ft_dict).values.astype(int)) ), \
                             shape=(N, self.M)).tocsr(),
             buffer_weight = buffer_weight)
         self.df = copy.copy(left)
@@ -69,7 +69,7 @@ class UnitLoaderAugmented:
 
 class UnitLoader:
 
-    def __init__(self, reader, ft_dict, key, batch_id_prefix=0, min_ct_per_unit=1, unit_id='unit', unit_attr=['x','y'], train_key=None, epoch = 2**15, skip_epoch=[], debug=False) -> None:
+    def __init__(self, reader, ft_dict, key, batch_id_prefix=0, min_ct_per_unit=1, unit_id='unit', unit_attr=['x','y'], train_key=None, epoch = 2**15, skip_epoch=[], debug=False, dtype=None) -> None:
         self.reader = reader
         self.ft_dict = ft_dict
         self.key = key
@@ -88,39 +88,63 @@ class UnitLoader:
         self.skip_epoch = set(skip_epoch)
         self.train_key = key if train_key is None else train_key
         self.test_mtx = None
+        self.dtype = dtype # Of the count matrices, default is that of the input
+        self.ft_index = pd.Index(list(self.ft_dict.keys()))
+        self.ft_code = np.array(list(self.ft_dict.values()), dtype=int)
 
     def _make_matrix(self):
-        self.brc = self.df[['unit']+self.unit_attr].drop_duplicates(subset=['unit'])
+        """
+        Make the count matrices from self.df, rows of the same unit
+        have to be consecutive (input sorted by unit)
+        """
+        if len(self.df) == 0:
+            self.brc = pd.DataFrame(columns = ['unit']+self.unit_attr+[self.train_key])
+            self.mtx = csr_array((0, self.M), dtype=self.dtype)
+            return 0
+        u = self.df.unit.to_numpy(dtype=object) # faster to compare than pandas strings
+        st = np.flatnonzero(np.r_[True, u[1:] != u[:-1]])
+        nnz = np.diff(np.r_[st, len(u)])
+        self.brc = self.df.iloc[st][['unit']+self.unit_attr]
+        self.brc.index = range(len(st))
         if self.prefix > 0:
             lab = self.brc.unit.str[:self.prefix].unique()
             self.batch_id_list += [x for x in lab if x not in self.batch_id_list]
-        self.brc = self.brc.merge(right = self.df.groupby(by='unit').agg({self.train_key:"sum"}).reset_index(), on = 'unit', how = 'inner' )
+        self.brc[self.train_key] = np.add.reduceat(self.df[self.train_key].values, st)
         if self.key != self.train_key:
-            self.brc = self.brc.merge(right = self.df.groupby(by='unit').agg({self.key:"sum"}).reset_index(), on = 'unit', how = 'inner' )
-        self.brc = self.brc[self.brc[self.key] >= self.min_ct_per_unit]
-        barcode_kept=list(self.brc.unit)
-        bt_dict={x:i for i,x in enumerate(barcode_kept)}
-        N = len(bt_dict)
-        self.df = self.df[self.df.unit.isin(bt_dict)]
-        self.mtx = coo_array((self.df[self.train_key].values, \
-                            (self.df.unit.map(bt_dict).values, \
-                             self.df.gene.map(self.ft_dict).values) ), \
-                            shape=(N, self.M)).tocsr()
+            self.brc[self.key] = np.add.reduceat(self.df[self.key].values, st)
+        kept = self.brc[self.key].values >= self.min_ct_per_unit
+        self.brc = self.brc[kept]
+        N = self.brc.shape[0]
+        entry = np.repeat(kept, nnz)
+        indptr = np.r_[0, np.cumsum(nnz[kept])]
+        indices = self.ft_code[self.ft_index.get_indexer(self.df.gene.values[entry])]
+        data = self.df[self.train_key].values[entry]
         if self.key != self.train_key:
-            self.test_mtx = coo_array(( \
-                (self.df[self.key] - self.df[self.train_key]).values, \
-                            (self.df.unit.map(bt_dict).values, \
-                             self.df.gene.map(self.ft_dict).values) ), \
-                            shape=(N, self.M)).tocsr()
+            # Index arrays are modified in place by sum_duplicates and eliminate_zeros
+            test = self.df[self.key].values[entry] - data
+            self.test_mtx = csr_array((test if self.dtype is None else test.astype(self.dtype), indices.copy(), indptr.copy()), shape=(N, self.M))
+            self.test_mtx.sum_duplicates()
             self.test_mtx.eliminate_zeros()
+        self.mtx = csr_array((data if self.dtype is None else data.astype(self.dtype), indices, indptr), shape=(N, self.M))
+        self.mtx.sum_duplicates()
         return N
 
+    def _count_unit(self, df):
+        if len(df) == 0:
+            return 0
+        u = df.unit.to_numpy(dtype=object)
+        return 1 + np.count_nonzero(u[1:] != u[:-1])
+
     def update_batch(self, bsize):
-        n_unit = 0
-        if len(self.df) > 0:
-            n_unit = len(self.df.unit.unique())
+        """
+        Read until there are more than bsize units, make the count matrices
+        of all but the last unit, which may continue in the next chunk.
+        Input has to be sorted by unit (as the output of make_dge and sort)
+        """
         if len(self.batch_id_list) > self.epoch or not self.file_is_open:
             return 0
+        chunks = [self.df] if len(self.df) > 0 else []
+        n_unit = self._count_unit(self.df)
         while n_unit <= bsize:
             try:
                 chunk = next(self.reader)
@@ -136,13 +160,18 @@ class UnitLoader:
                 continue
             if self.debug:
                 print(f"Read {chunk.shape[0]} lines from file")
-            self.df = pd.concat([self.df, chunk])
-            n_unit = len(self.df.unit.unique())
+            n_unit += self._count_unit(chunk)
+            if len(chunks) > 0 and chunk.unit.values[0] == chunks[-1].unit.values[-1]:
+                n_unit -= 1
+            chunks.append(chunk)
+        self.df = pd.concat(chunks) if len(chunks) > 1 else (chunks[0] if len(chunks) == 1 else pd.DataFrame())
         left = pd.DataFrame()
-        if self.file_is_open:
-            last_indx = self.df.unit.iloc[-1]
-            left = self.df[self.df.unit == last_indx]
-            self.df = self.df[self.df.unit != last_indx]
+        if self.file_is_open and len(self.df) > 0:
+            u = self.df.unit.to_numpy(dtype=object)
+            st = np.flatnonzero(u != u[-1])
+            st = st[-1] + 1 if len(st) > 0 else 0
+            left = self.df.iloc[st:]
+            self.df = self.df.iloc[:st]
         N = self._make_matrix()
         self.df = copy.copy(left)
         return N
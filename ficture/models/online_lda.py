@@ -11,7 +11,9 @@ Link: https://github.com/blei-lab/onlineldavb
 # Author: Chyi-Kwei Yau
 # Author: Matthew D. Hoffman (original onlineldavb implementation)
 from numbers import Integral, Real
-import sys, os, copy
+import sys, os, copy, weakref
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import scipy.sparse as sp
 from joblib import effective_n_jobs
@@ -27,6 +29,10 @@ from sklearn.utils import check_random_state, gen_batches, gen_even_slices
 from sklearn.utils._param_validation import Interval, StrOptions
 from sklearn.utils.parallel import Parallel, delayed
 from sklearn.utils.validation import check_is_fitted, check_non_negative
+try:
+    from sklearn.utils.validation import validate_data
+except ImportError: # scikit-learn < 1.6
+    validate_data = None
 from sklearn.decomposition._online_lda_fast import (
     _dirichlet_expectation_1d as cy_dirichlet_expectation_1d,
 )
@@ -38,8 +44,61 @@ from sklearn.decomposition._online_lda_fast import (
 )
 
 from ficture.utils.utilt import gen_even_slices_from_list
+from ficture.utils.shared_array import SharedBuffer, attach, detach
 
 EPS = np.finfo(float).eps
+BATCH_MIN_DOCS = 32     # Use the per-document loop for fewer documents
+BATCH_MAX_NNZ = 2**16   # Number of nonzero entries updated together
+
+def _update_doc_block(
+    X,
+    exp_elog_beta_t,
+    doc_topic_prior,
+    max_doc_update_iter,
+    mean_change_tol,
+    gamma,
+    exp_elog_theta,
+    eps,
+):
+    """E-step for a block of documents at once, in place.
+
+    Same updates as the per-document loop in `_update_doc_distribution`
+    in matrix form, each document leaves the active set once its own
+    mean change in gamma is below `mean_change_tol`.
+
+    Parameters
+    ----------
+    X               : N x M CSR
+    exp_elog_beta_t : M x K `exp(E[log(beta)])`, transposed.
+    gamma, exp_elog_theta : N x K, updated in place
+
+    Returns
+    -------
+    norm_phi : length nnz(X), normalizer of phi for each entry of X at convergence
+    """
+    active = np.arange(X.shape[0])
+    sub = X
+    cnt = np.diff(X.indptr)
+    # exp(E[log(beta)]) of the feature of each nonzero entry, nnz x K
+    exp_elog_beta_d = exp_elog_beta_t[X.indices]
+    beta_a = exp_elog_beta_d
+    for _ in range(0, max_doc_update_iter):
+        exp_elog_theta_a = exp_elog_theta[active]
+        norm_phi = np.einsum("ij,ij->i", np.repeat(exp_elog_theta_a, cnt[active], axis=0), beta_a) + eps
+        w = sp.csr_matrix((sub.data / norm_phi, sub.indices, sub.indptr), shape=sub.shape)
+        gamma_a = exp_elog_theta_a * (w @ exp_elog_beta_t)
+        gamma_a += doc_topic_prior
+        last = gamma[active]
+        gamma[active] = gamma_a
+        exp_elog_theta[active] = np.exp(_dirichlet_expectation_2d(gamma_a))
+        kept = np.abs(last - gamma_a).mean(axis=1) >= mean_change_tol
+        if not kept.any():
+            break
+        if not kept.all():
+            beta_a = beta_a[np.repeat(kept, cnt[active])]
+            active = active[kept]
+            sub = sub[kept]
+    return np.einsum("ij,ij->i", np.repeat(exp_elog_theta, cnt, axis=0), exp_elog_beta_d) + eps
 
 def _update_doc_distribution(
     X,
@@ -49,6 +108,7 @@ def _update_doc_distribution(
     mean_change_tol,
     cal_sstats,
     random_state,
+    batch_min_docs=BATCH_MIN_DOCS,
 ):
     """E-step: update document-topic distribution.
 
@@ -61,6 +121,8 @@ def _update_doc_distribution(
     mean_change_tol : float. Stopping tolerance for updating q(theta)
     cal_sstats      : bool. Indicate whether to calculate sufficient statistics
     random_state    : RandomState/Generator instance or None
+    batch_min_docs  : int. Update documents in blocks (`_update_doc_block`)
+                      if there are at least this many, otherwise one by one
 
     Returns
     -------
@@ -106,6 +168,25 @@ def _update_doc_distribution(
     dirichlet_expectation_1d = cy_dirichlet_expectation_1d[ctype]
     eps = np.finfo(X.dtype).eps
 
+    if n_samples >= batch_min_docs:
+        if not is_sparse_x:
+            X = sp.csr_matrix(X)
+        exp_elog_beta_t = np.ascontiguousarray(exp_elog_beta.T)
+        nnz = np.diff(X.indptr).cumsum()
+        st = 0
+        while st < n_samples:
+            # Rows with at most BATCH_MAX_NNZ nonzero entries, at least one row
+            ed = max(st + 1, np.searchsorted(nnz, (nnz[st - 1] if st > 0 else 0) + BATCH_MAX_NNZ, side='right'))
+            X_b = X[st:ed]
+            norm_phi = _update_doc_block(X_b, exp_elog_beta_t, doc_topic_prior,
+                max_doc_update_iter, mean_change_tol,
+                gamma[st:ed], exp_elog_theta[st:ed], eps)
+            if cal_sstats:
+                w = sp.csr_matrix((X_b.data / norm_phi, X_b.indices, X_b.indptr), shape=X_b.shape)
+                suff_stats += (w.T @ exp_elog_theta[st:ed]).T
+            st = ed
+        return (gamma, suff_stats)
+
     for idx_d in range(n_samples):
         if is_sparse_x:
             ids = X_indices[X_indptr[idx_d] : X_indptr[idx_d + 1]] # col index for row idx_d
@@ -144,6 +225,78 @@ def _update_doc_distribution(
     return (gamma, suff_stats)
 
 
+### Persistent worker pool for the E-step. The topic matrix, the documents
+### (CSR), and the per-worker sufficient statistics live in shared memory,
+### tasks only carry segment names and row ranges
+
+_limits = []
+
+def _init_worker():
+    from threadpoolctl import threadpool_limits
+    _limits.append(threadpool_limits(limits=1))
+
+def _update_doc_distribution_shared(
+    beta_spec,
+    csr_spec,
+    rows,
+    sstats_spec,
+    slot,
+    doc_topic_prior,
+    max_doc_update_iter,
+    mean_change_tol,
+    cal_sstats,
+    random_state,
+):
+    """_update_doc_distribution on rows [st, ed) of the shared CSR matrix,
+    sufficient statistics are written to slot `slot` of the shared buffer"""
+    # Close segments replaced by the parent
+    detach({beta_spec[0], sstats_spec[0]} | {x[0] for x in csr_spec[:3]})
+    data, indices, indptr = [attach(x) for x in csr_spec[:3]]
+    st, ed = rows
+    ip = indptr[st:ed + 1]
+    X = sp.csr_matrix(
+        (data[ip[0]:ip[-1]], indices[ip[0]:ip[-1]], ip - ip[0]),
+        shape=(ed - st, csr_spec[3]),
+    )
+    gamma, suff_stats = _update_doc_distribution(
+        X,
+        attach(beta_spec),
+        doc_topic_prior,
+        max_doc_update_iter,
+        mean_change_tol,
+        cal_sstats,
+        random_state,
+    )
+    if cal_sstats:
+        attach(sstats_spec)[slot] = suff_stats
+    return gamma
+
+_executor = {"pool": None, "n_jobs": 0}
+
+def _get_executor(n_jobs):
+    """The worker pool, started on first use and reused by all models in
+    the process (e.g. random restarts) until shutdown_pool"""
+    if _executor["pool"] is None or _executor["n_jobs"] != n_jobs:
+        shutdown_pool()
+        _executor["pool"] = ProcessPoolExecutor(
+            max_workers=n_jobs,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+        )
+        _executor["n_jobs"] = n_jobs
+    return _executor["pool"]
+
+def shutdown_pool():
+    if _executor["pool"] is not None:
+        _executor["pool"].shutdown(wait=True, cancel_futures=True)
+        _executor["pool"] = None
+
+def _close_shared(buffers):
+    for x in buffers.values():
+        x.close()
+    buffers.clear()
+
+
 class LDA(
     ClassNamePrefixFeaturesOutMixin, TransformerMixin, BaseEstimator
 ):
@@ -172,6 +325,7 @@ class LDA(
         "intercept": [None, "array-like"],
         "penalty": [None, Interval(Real, 0, 1, closed="left")],
         "debug" : [None, Integral],
+        "persistent_pool": ["boolean"],
     }
 
     def __init__(
@@ -197,6 +351,7 @@ class LDA(
         penalty=0,
         penalize_ambian_only = False,
         debug = 0,
+        persistent_pool = True,
     ):
         self.n_components = n_components
         self.doc_topic_prior = doc_topic_prior
@@ -218,6 +373,7 @@ class LDA(
         self.penalty = penalty
         self.penalize_ambian_only = penalize_ambian_only
         self.debug = debug
+        self.persistent_pool = persistent_pool
 
     def _init_latent_vars(self, n_features, dtype=np.float64, lambda_=None):
         """Initialize latent variables."""
@@ -330,7 +486,102 @@ class LDA(
 
         return (gamma, suff_stats)
 
-    def _em_step(self, X, total_samples, batch_update, parallel=None):
+    def _pool(self):
+        """The persistent worker pool and the shared buffers of this model"""
+        if self.__dict__.get("_pool_state") is None:
+            self._pool_state = {}
+            self._pool_finalizer = weakref.finalize(self, _close_shared, self._pool_state)
+        return _get_executor(effective_n_jobs(self.n_jobs))
+
+    def _shared(self, key, shape, dtype, reserve=1.):
+        """A view of the named shared buffer, replaced if too small"""
+        buffers = self._pool_state
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if key not in buffers or buffers[key].shm.size < nbytes:
+            if key in buffers:
+                buffers.pop(key).close()
+            buffers[key] = SharedBuffer(nbytes * reserve)
+        return buffers[key].view(shape, dtype)
+
+    def _share_docs(self, X):
+        """Copy the documents to the shared CSR buffer read by the workers"""
+        self._pool()
+        X = sp.csr_matrix(X)
+        specs = []
+        for key, v in zip(["data", "indices", "indptr"], [X.data, X.indices, X.indptr]):
+            arr, spec = self._shared(key, v.shape, v.dtype, reserve=1.5)
+            arr[:] = v
+            specs.append(spec)
+        self._shared_docs = tuple(specs) + (X.shape[1],)
+
+    def _e_step_shared(self, rows, cal_sstats, random_init):
+        """E-step on rows [st, ed) of the shared documents, run by the
+        persistent worker pool. Same result as _e_step on X[st:ed, :]"""
+        pool = self._pool()
+        random_state = self.random_state_ if random_init else None
+        n_jobs = effective_n_jobs(self.n_jobs)
+        # Update the topic matrix in place
+        beta, beta_spec = self._shared("beta", self.exp_elog_beta.shape, self.exp_elog_beta.dtype)
+        beta[:] = self.exp_elog_beta
+        sstats, sstats_spec = self._shared("sstats", (n_jobs,) + self.exp_elog_beta.shape, self.exp_elog_beta.dtype)
+        st, ed = rows
+        futures = [
+            pool.submit(
+                _update_doc_distribution_shared,
+                beta_spec,
+                self._shared_docs,
+                (st + idx_slice.start, st + idx_slice.stop),
+                sstats_spec,
+                i,
+                self.doc_topic_prior_,
+                self.max_doc_update_iter,
+                self.mean_change_tol,
+                cal_sstats,
+                random_state,
+            )
+            for i, idx_slice in enumerate(gen_even_slices(ed - st, n_jobs))
+        ]
+        gamma = np.vstack([f.result() for f in futures])
+
+        if cal_sstats:
+            suff_stats = np.zeros(self.exp_elog_beta.shape, dtype=self.exp_elog_beta.dtype)
+            for i in range(len(futures)):
+                suff_stats += sstats[i]
+            suff_stats *= self.exp_elog_beta
+        else:
+            suff_stats = None
+        del beta, sstats
+        return (gamma, suff_stats)
+
+    def close_pool(self, shutdown=False):
+        """Release the shared memory of this model, with shutdown=True
+        also stop the worker processes (shared by all models)"""
+        if self.__dict__.get("_pool_finalizer") is not None:
+            self._pool_finalizer()
+        if shutdown:
+            shutdown_pool()
+        self.__dict__.pop("_pool_state", None)
+        self.__dict__.pop("_pool_finalizer", None)
+        self.__dict__.pop("_shared_docs", None)
+
+    @property
+    def exp_dirichlet_component_(self):
+        """exp(E[log(beta)]) of the factors, named as in sklearn's LatentDirichletAllocation"""
+        return self.exp_elog_beta[:self.n_components, :]
+
+    @exp_dirichlet_component_.setter
+    def exp_dirichlet_component_(self, value):
+        if self.intercept:
+            value = np.vstack((value, self.intercept_))
+        self.exp_elog_beta = value
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        for key in ["_pool_state", "_pool_finalizer", "_shared_docs"]:
+            state.pop(key, None)
+        return state
+
+    def _em_step(self, X, total_samples, batch_update, parallel=None, rows=None):
         """EM update for 1 iteration.
 
         update `_component` by batch VB or online VB.
@@ -351,6 +602,10 @@ class LDA(
         parallel : joblib.Parallel, default=None
             Pre-initialized instance of joblib.Parallel
 
+        rows : (start, end), default=None
+            Use rows [start, end) of the documents shared with the
+            persistent worker pool instead of X.
+
         Returns
         -------
         gamma : ndarray of shape (n_samples, n_components)
@@ -358,9 +613,16 @@ class LDA(
         """
 
         # E-step
-        _, suff_stats = self._e_step(
-            X, cal_sstats=True, random_init=True, parallel=parallel
-        )
+        if rows is None:
+            _, suff_stats = self._e_step(
+                X, cal_sstats=True, random_init=True, parallel=parallel
+            )
+            n_samples = X.shape[0]
+        else:
+            _, suff_stats = self._e_step_shared(
+                rows, cal_sstats=True, random_init=True
+            )
+            n_samples = rows[1] - rows[0]
         if self.intercept:
             suff_stats = suff_stats[:-1, :]
 
@@ -373,7 +635,7 @@ class LDA(
             weight = np.power(
                 self.learning_offset + self.n_batch_iter_, -self.learning_decay
             )
-            doc_ratio = float(total_samples) / X.shape[0]
+            doc_ratio = float(total_samples) / n_samples
             if self.penalty > 0 and self.n_batch_iter_ > 3:
                 korder = np.arange(self.n_components)
                 self.random_state_.shuffle(korder)
@@ -432,12 +694,21 @@ class LDA(
         """
         dtype = [np.float64, np.float32] if reset_n_features else self.components_.dtype
 
-        X = self._validate_data( # from sklearn.base.BaseEstimator
-            X,
-            reset=reset_n_features,
-            accept_sparse="csr",
-            dtype=dtype,
-        )
+        if validate_data is not None:
+            X = validate_data(
+                self,
+                X,
+                reset=reset_n_features,
+                accept_sparse="csr",
+                dtype=dtype,
+            )
+        else:
+            X = self._validate_data( # from sklearn.base.BaseEstimator
+                X,
+                reset=reset_n_features,
+                accept_sparse="csr",
+                dtype=dtype,
+            )
         check_non_negative(X, whom)
 
         return X
@@ -478,10 +749,22 @@ class LDA(
             )
 
         n_jobs = effective_n_jobs(self.n_jobs)
+        n_batch = max(1, n_samples // batch_size)
         idx_randomize = np.arange(n_samples)
         self.random_state_.shuffle(idx_randomize)
+        if self.persistent_pool and n_jobs > 1:
+            # Share the shuffled documents once, minibatches are row ranges
+            self._share_docs(X[idx_randomize, :])
+            for idx_slice in gen_even_slices(n_samples, n_batch):
+                self._em_step(
+                    None,
+                    total_samples=self.total_samples,
+                    batch_update=False,
+                    rows=(idx_slice.start, idx_slice.stop),
+                )
+            return self
         with Parallel(n_jobs=n_jobs, verbose=max(0, self.verbose - 1)) as parallel:
-            for idx_slice in gen_even_slices_from_list(idx_randomize, n_samples // batch_size):
+            for idx_slice in gen_even_slices_from_list(idx_randomize, n_batch):
                 self._em_step(
                     X[idx_slice, :],
                     total_samples=self.total_samples,
@@ -16,7 +16,7 @@ class OnlineLDA:
     """
     Implements online VB for LDA as described in (Hoffman et al. 2010).
     """
-    def __init__(self, vocab, K, N, alpha = None, eta = None, tau0=9, kappa=.7, zeta = 0, iter_inner = 50, tol = 1e-4, iter_gamma = 10, verbose = 0, seed = None):
+    def __init__(self, vocab, K, N, alpha = None, eta = None, tau0=9, kappa=.7, zeta = 0, iter_inner = 50, tol = 1e-4, iter_gamma = 10, verbose = 0, seed = None, active_set = False, active_tol = None, active_patience = 3, max_factor = 0, dtype = np.float64, evaluate_every = -1, score_sample = 0, score_stream = None):
         """
         Arguments:
         K: Number of topics
@@ -30,6 +30,18 @@ class OnlineLDA:
         --- Experimental ---
         zeta:  Weight of the proximal contamination penalty
         iter_gamma: Maximum number of iterations when maximizing the "penalized ELBO" w.r.t. gamma (there is no analytical solution)
+        active_set: In the E-step, stop updating anchors (pixels) whose gamma (phi)
+               changes less than active_tol (default: tol) in active_patience
+               consecutive iterations
+        max_factor: If in (0, K), each anchor keeps its max_factor top factors
+               (from the initial gamma) and each pixel is only evaluated against
+               the union of its anchors' factors, phi is stored as a sparse matrix.
+               Takes precedence over active_set
+        dtype: Floating point type of the E-step (float32 halves memory traffic)
+        evaluate_every: Compute the approximate score every this many global updates,
+               0 to never score, -1 (default) to score every update only if verbose
+        score_sample: If positive, score on a random subset of this many pixels
+        score_stream: A writable text stream to record the scores (tsv)
         """
         self._vocab = vocab
         self._K = K
@@ -42,8 +54,18 @@ class OnlineLDA:
         self._max_iter_inner = iter_inner
         self._max_iter_gamma = iter_gamma
         self._tol = tol
+        self._active_set = active_set
+        self._active_tol = tol if active_tol is None else active_tol
+        self._active_patience = active_patience
+        self._max_factor = max_factor
+        self._dtype = np.dtype(dtype)
+        self._evaluate_every = evaluate_every
+        self._score_sample = score_sample
+        self._score_stream = score_stream
+        self._score_header = False
         self._verbose = verbose
         self._Elog_beta = None      # K x M
+        self._gather_block = 2**20  # Max elements in E-step gather buffers
         self._lambda = None         # K x M
         self.rng_ = check_random_state(seed)
 
@@ -71,61 +93,272 @@ class OnlineLDA:
             self._lambda = self.rng_.gamma(100., 1./100., (self._K, self._M))
         else:
             self._lambda = m_lambda
-        self._Elog_beta = _dirichlet_expectation_2d(self._lambda)
+        self._Elog_beta = _dirichlet_expectation_2d(self._lambda).astype(self._dtype, copy=False)
 
     def do_e_step(self, batch):
         """
         Update local parameters, compute sufficient stats for M step
+        psi is kept on the sparsity pattern of batch.psi (after summing
+        duplicates and dropping explicit zeros), ElogO is gathered onto it,
+        psi is updated in place on its data buffer, work arrays are
+        allocated once
         """
-        Xb = batch.mtx @ self._Elog_beta.T         # Dense, N x K
-        if issparse(Xb):
-            Xb = Xb.toarray()
-        c_indx, r_indx = batch.psi.nonzero()
+        sparse_factor = 0 < self._max_factor < self._K
+        if not sparse_factor:
+            Xb = batch.mtx @ self._Elog_beta.T     # Dense, N x K
+            if issparse(Xb):
+                Xb = Xb.toarray()
+            Xb = np.asarray(Xb, dtype=self._dtype)
         # Initialize the variational distribution q(theta|gamma)
         if batch.alpha is None:
             batch.alpha = np.broadcast_to(self._alpha, (batch.n, self._K))
         if batch.gamma is None:
             batch.gamma = copy.copy(batch.alpha)
-        gamma_old = copy.copy(batch.gamma)
+        batch.alpha = np.asarray(batch.alpha, dtype=self._dtype)
+        batch.gamma = np.asarray(batch.gamma, dtype=self._dtype)
+        gamma_old = batch.gamma
         Elog_theta = _dirichlet_expectation_2d(batch.gamma) # n x K
+
+        # Fix the sparse structure of psi (N x n)
+        psi = batch.psi.tocsr()
+        psi.sum_duplicates()
+        psi.eliminate_zeros()
+        indptr, c_indx = psi.indptr, psi.indices # c_indx: anchor
+        r_indx = np.repeat(np.arange(batch.N), np.diff(indptr)) # pixel
+        ElogO = np.asarray(batch.ElogO.tocsr()[r_indx, c_indx], dtype=self._dtype).reshape(-1)
+        psi = csr_array((psi.data.astype(self._dtype), c_indx, indptr), shape=psi.shape)
+        if not sparse_factor:
+            bsize = max(1, min(len(c_indx), self._gather_block // self._K))
+            buf = (np.empty((bsize, self._K), dtype=self._dtype), np.empty((bsize, self._K), dtype=self._dtype))
+            seg = self._row_segments(indptr)
+            phi = np.empty((batch.N, self._K), dtype=self._dtype)
+            if batch.phi is not None: # Returned as is if no iteration is run
+                phi[:] = batch.phi.toarray() if issparse(batch.phi) else batch.phi
+
+        if sparse_factor:
+            phi = self._e_step_sparse(batch, Elog_theta, psi, r_indx, c_indx, ElogO)
+        elif self._active_set:
+            phi = self._e_step_active(batch, Xb, Elog_theta, psi, r_indx, c_indx, ElogO, phi, buf)
+        else:
+            meanchange = self._tol + 1
+            it = 0
+            while it < self._max_iter_inner and meanchange > self._tol:
+
+                np.add(psi @ Elog_theta, Xb, out=phi)
+                phi -= phi.max(axis = 1).reshape((-1, 1))
+                np.exp(phi, out=phi)
+                phi /= phi.sum(axis = 1).reshape((-1, 1))
+                # psi_ij \propto \exp( \sum_k phi_ik Elog[theta_jk] + E[log O_ij] )
+                # (\sum_k phi_ik log P_ik is the same for all j and cancels)
+                self._gather_dot(phi, r_indx, Elog_theta, c_indx, psi.data, buf)
+                psi.data += ElogO
+                self._softmax_rows(psi.data, seg)
+                batch.gamma = batch.alpha + psi.T @ phi
+                Elog_theta = _dirichlet_expectation_2d(batch.gamma)
+
+                meanchange = np.abs(batch.gamma - gamma_old).max(axis=1).mean()
+                gamma_old = batch.gamma
+                it += 1
+                if self._verbose > 2 or (self._verbose > 1 and it % 10 == 0):
+                    logging.info(f"E-step, update phi, psi, gamma: {it}-th iteration, mean change {meanchange:.4f}")
+
+        batch.psi = psi
+        batch.phi = phi
+        sstats = batch.phi.T @ batch.mtx # K x M
+        if issparse(sstats):
+            sstats = sstats.toarray()
+        batch.ll = batch.psi.T @ batch.mtx @ self._Elog_beta.T
+        ll_norm = logsumexp(batch.ll, axis = 1)
+        batch.ll = (batch.ll - ll_norm.reshape((-1, 1))).sum() / batch.n
+        return sstats
+
+    def _gather_dot(self, a, a_indx, b, b_indx, out, buf):
+        """
+        out[i] = a[a_indx[i]] . b[b_indx[i]], in blocks using the buffers buf
+        """
+        nnz = len(a_indx)
+        buf_a, buf_b = buf
+        bsize = buf_a.shape[0]
+        for st in range(0, nnz, bsize):
+            ed = min(st + bsize, nnz)
+            u, v = buf_a[:ed-st], buf_b[:ed-st]
+            np.take(a, a_indx[st:ed], axis = 0, out = u, mode = 'clip')
+            np.take(b, b_indx[st:ed], axis = 0, out = v, mode = 'clip')
+            np.einsum('ij,ij->i', u, v, out = out[st:ed])
+
+    def _row_segments(self, indptr):
+        """Start and length of the non empty rows of a csr matrix"""
+        nnz = np.diff(indptr)
+        return indptr[:-1][nnz > 0], nnz[nnz > 0]
+
+    def _softmax_rows(self, data, seg):
+        """
+        Replace the values of a csr matrix (data, with non empty rows seg
+        from _row_segments) by exp normalized within each row, in place.
+        The max of each row is subtracted first, float32 would underflow
+        """
+        if len(data) == 0:
+            return
+        st, nnz = seg
+        data -= np.repeat(np.maximum.reduceat(data, st), nnz)
+        np.exp(data, out = data)
+        data /= np.repeat(np.add.reduceat(data, st), nnz)
+
+    def _e_step_active(self, batch, Xb, Elog_theta, psi, r_indx, c_indx, ElogO, phi, buf):
+        """
+        E-step iterations on an active set: an anchor is frozen once the
+        max change of its gamma is below active_tol for active_patience
+        consecutive iterations, and is put back while the phi of one of its
+        active pixels still moves. A pixel is frozen once the max change of
+        its phi stays below active_tol as long, or all its anchors are
+        frozen. Only the rows of psi and phi of active pixels are
+        updated, on a compacted copy rebuilt when the active pixels shrink
+        by more than 10%. Frozen pixels enter gamma through a fixed term
+        psi.data and phi are updated in place, batch.gamma is replaced
+        """
+        n, N, K = batch.n, batch.N, self._K
+        gamma = np.array(batch.gamma)
+        g_fixed = np.zeros((n, K), dtype=gamma.dtype) # Contribution of frozen pixels to gamma
+        active = np.ones(n, dtype=bool)
+        p_active = np.ones(N, dtype=bool)
+        a_calm = np.zeros(n, dtype=int) # Consecutive iterations below active_tol
+        p_calm = np.zeros(N, dtype=int)
+        rebuild = True
+        work_pixel, work_pair = 0, 0
         meanchange = self._tol + 1
         it = 0
-
         while it < self._max_iter_inner and meanchange > self._tol:
+            if rebuild:
+                if it > 0: # Write back the previous working set
+                    psi.data[e_idx] = sub.data
+                    phi[p_idx] = sub_phi
+                    e_drop = e_idx[~p_active[r_indx[e_idx]]]
+                    g_fixed += csr_array((psi.data[e_drop], (c_indx[e_drop], r_indx[e_drop])), shape=(n, N)) @ phi
+                p_idx = np.where(p_active)[0]
+                e_idx = np.where(p_active[r_indx])[0]
+                sub_indptr = np.concatenate([[0], np.cumsum(np.diff(psi.indptr)[p_idx])])
+                sub_r = np.repeat(np.arange(len(p_idx)), np.diff(sub_indptr))
+                sub_c = c_indx[e_idx]
+                sub = csr_array((psi.data[e_idx], sub_c, sub_indptr), shape=(len(p_idx), n))
+                sub_ElogO = ElogO[e_idx]
+                sub_Xb = Xb[p_idx]
+                sub_phi = np.empty((len(p_idx), K), dtype=self._dtype)
+                phi_old = phi[p_idx] if it > 0 else None
+                sub_seg = self._row_segments(sub_indptr)
+                rebuild = False
+            work_pixel += len(p_idx)
+            work_pair += len(e_idx)
+
+            np.add(sub @ Elog_theta, sub_Xb, out=sub_phi)
+            sub_phi -= sub_phi.max(axis = 1).reshape((-1, 1))
+            np.exp(sub_phi, out=sub_phi)
+            sub_phi /= sub_phi.sum(axis = 1).reshape((-1, 1))
+            self._gather_dot(sub_phi, sub_r, Elog_theta, sub_c, sub.data, buf)
+            sub.data += sub_ElogO
+            self._softmax_rows(sub.data, sub_seg)
+            a_idx = np.where(active)[0]
+            gamma_new = batch.alpha[a_idx] + g_fixed[a_idx] + (sub.T @ sub_phi)[a_idx]
+            change = np.abs(gamma_new - gamma[a_idx]).max(axis = 1)
+            gamma[a_idx] = gamma_new
+            Elog_theta[a_idx] = _dirichlet_expectation_2d(gamma_new)
+            meanchange = change.sum() / n
+            it += 1
+
+            a_calm[a_idx] = np.where(change < self._active_tol, a_calm[a_idx] + 1, 0)
+            if phi_old is not None:
+                calm = np.abs(sub_phi - phi_old).max(axis = 1) < self._active_tol
+                p_calm[p_idx] = np.where(calm, p_calm[p_idx] + 1, 0)
+                a_calm[sub_c[~calm[sub_r]]] = 0 # Anchors of moving pixels stay active
+            active = a_calm < self._active_patience
+            p_active = p_active & (p_calm < self._active_patience)
+            p_active &= np.bincount(r_indx, weights = active[c_indx], minlength = N) > 0
+            phi_old = sub_phi.copy()
+            if p_active.sum() < .9 * len(p_idx):
+                rebuild = True
+            if self._verbose > 2 or (self._verbose > 1 and it % 10 == 0):
+                logging.info(f"E-step, update phi, psi, gamma: {it}-th iteration, mean change {meanchange:.4f}, {active.sum()} active anchors, {p_active.sum()} active pixels")
+            if active.sum() == 0:
+                break
+        if it == 0: # inner_max_iter is 0
+            return phi
+        psi.data[e_idx] = sub.data
+        phi[p_idx] = sub_phi
+        batch.gamma = batch.alpha + psi.T @ phi
+        if self._verbose > 0:
+            logging.info(f"Active set E-step: {it} iterations, {(~active).sum()}/{n} anchors and {(~p_active).sum()}/{N} pixels converged early, computed {work_pixel/max(1, N*it)*100:.1f}% of pixel and {work_pair/max(1, len(r_indx)*it)*100:.1f}% of pixel-anchor updates")
+        return phi
 
-            batch.phi = batch.psi @ Elog_theta + Xb
-            batch.phi = np.exp(batch.phi -\
-                               logsumexp(batch.phi, axis = 1).reshape((-1, 1)) )
-            psi_hat = batch.phi[c_indx, 0] * Elog_theta[r_indx, 0] # \sum_k phi_ik Elog[theta_jk]
-            for k in range(1, self._K):
-                psi_hat += batch.phi[c_indx, k] * Elog_theta[r_indx, k]
-            psi_hat += np.multiply(Xb, batch.phi).sum(axis = 1).reshape(-1)[c_indx] # \sum_k phi_ik log Pik
-            batch.psi.data = psi_hat
-            batch.psi += batch.ElogO
-            batch.psi.data = np.exp(batch.psi.data)
-            batch.psi = normalize(batch.psi, norm='l1', axis=1)
-            batch.gamma = batch.alpha + batch.psi.T @ batch.phi
+    def _e_step_sparse(self, batch, Elog_theta, psi, r_indx, c_indx, ElogO):
+        """
+        E-step iterations on active factors: each anchor keeps the top
+        max_factor factors of its initial gamma, each pixel is evaluated
+        only against the union of its anchors' factors. phi and the data
+        term are kept on (pixel, factor) pairs, each pixel-anchor pair is
+        expanded to the factors of its pixel once (a sparse matrix whose
+        values are refreshed every iteration). gamma stays dense (n x K)
+        psi.data is updated in place, returns phi as an N x K csr_array
+        """
+        N, K = batch.N, self._K
+        m = self._max_factor
+        nnz = len(c_indx)
+        top = np.argpartition(-np.asarray(batch.gamma), m - 1, axis = 1)[:, :m]
+        mask = np.zeros((N, K), dtype=bool)
+        mask[r_indx.reshape((-1, 1)), top[c_indx]] = True
+        key = np.flatnonzero(mask)
+        p_r, p_k = key // K, key % K # (pixel, factor) pairs, sorted by pixel
+        indptr = np.searchsorted(p_r, np.arange(N + 1))
+        nk = np.diff(indptr)
+        P = len(key)
+        # Expand each pixel-anchor pair to the factors of its pixel: B is
+        # (pixel-anchor) x (pixel, factor), holding Elog_theta[anchor, factor]
+        cnt = nk[r_indx]
+        e_p = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt - indptr[r_indx], cnt)
+        e_k = np.repeat(c_indx, cnt) * K + p_k[e_p] # Index into Elog_theta (n x K)
+        B = csr_array((np.empty(len(e_p), dtype=self._dtype), e_p, np.concatenate([[0], np.cumsum(cnt)])), shape=(nnz, P))
+        phi = csr_array((np.empty(P, dtype=self._dtype), p_k, indptr), shape=(N, K))
+        # Data term, computed in blocks of pixels
+        Xb = np.empty(P, dtype=self._dtype)
+        bsize = max(1, self._gather_block // K)
+        for st in range(0, N, bsize):
+            ed = min(st + bsize, N)
+            x = batch.mtx[st:ed] @ self._Elog_beta.T
+            if issparse(x):
+                x = x.toarray()
+            Xb[indptr[st]:indptr[ed]] = x[p_r[indptr[st]:indptr[ed]] - st, p_k[indptr[st]:indptr[ed]]]
+        st = indptr[:-1]
+        seg = self._row_segments(psi.indptr)
+        gamma_old = batch.gamma
+        meanchange = self._tol + 1
+        it = 0
+        while it < self._max_iter_inner and meanchange > self._tol:
+            np.take(Elog_theta, e_k, out = B.data)
+            v = B.T @ psi.data
+            v += Xb
+            v -= np.repeat(np.maximum.reduceat(v, st), nk)
+            np.exp(v, out = v)
+            v /= np.repeat(np.add.reduceat(v, st), nk)
+            phi.data[:] = v
+            psi.data[:] = B @ v
+            psi.data += ElogO
+            self._softmax_rows(psi.data, seg)
+            batch.gamma = batch.alpha + (psi.T @ phi).toarray()
             Elog_theta = _dirichlet_expectation_2d(batch.gamma)
 
             meanchange = np.abs(batch.gamma - gamma_old).max(axis=1).mean()
-            gamma_old = copy.copy(batch.gamma)
+            gamma_old = batch.gamma
             it += 1
-            # if self._verbose > 2: # debug
-            #     print( np.around([batch.psi.sum(axis = 1).min(),\
-            #                       batch.phi.sum(axis = 1).min()], 2) )
             if self._verbose > 2 or (self._verbose > 1 and it % 10 == 0):
                 logging.info(f"E-step, update phi, psi, gamma: {it}-th iteration, mean change {meanchange:.4f}")
+        if self._verbose > 0:
+            logging.info(f"Sparse factor E-step: {it} iterations, {P/N:.1f} factors per pixel on average (max {nk.max()}) out of {K}")
+        return phi
 
-        sstats = batch.phi.T @ batch.mtx # K x M
-        batch.ll = batch.psi.T @ batch.mtx @ self._Elog_beta.T
-        ll_norm = logsumexp(batch.ll, axis = 1)
-        ll_tot = 0
-        for k in range(self._K):
-            ll_tot += (batch.ll[:, k] - ll_norm).sum()
-        batch.ll = ll_tot / batch.n
-        return sstats
-
-    def update_lambda_penalized(self, batch):
+    def penalized_sstats(self, batch):
+        """
+        E-step, then shrink the sufficient statistics of each factor away from
+        factors that are spatially proximal to it (proximal contamination penalty).
+        Return the penalized estimate of lambda from the minibatch (K x M)
+        """
         assert self._zeta > 0 and self._zeta < 1, "zeta must be in (0, 1) for penalized update"
         assert batch.anchor_adj is not None, "batch.anchor_adj must be provided for penalized update"
         if issparse(batch.anchor_adj):
@@ -135,67 +368,99 @@ class OnlineLDA:
         # E step to update gamma, phi | lambda for mini-batch
         lambda_org = self._eta + self.do_e_step(batch) # K X M
         theta = normalize(batch.gamma, norm='l1', axis=1) # n x K, E[theta]
-        ckl = theta.T @ normalize(batch.anchor_adj, norm='l1', axis=1) @ theta
+        # Row normalized adjacency times theta, without densifying the adjacency
+        adj_theta = np.asarray(batch.anchor_adj @ theta) / np.asarray(batch.anchor_adj.sum(axis = 1)).reshape((-1, 1))
+        ckl = theta.T @ adj_theta
         ckl /= theta.sum(axis = 0).reshape((-1, 1)) # K x K, factor spatial proximity
         np.fill_diagonal(ckl, 0)
-        lam_sum = lambda_org.sum(axis = 1)
+        lam_sum = lambda_org.sum(axis = 1).reshape((-1, 1))
         it = 0
         meanchange = self._tol + 1
         while it < self._max_iter_gamma and meanchange > self._tol:
-            lambda_new = np.zeros((self._K, self._M))
-            for k in range(self._K):
-                avg = ckl[[k], :] @ (normalize(lambda_org, norm='l1', axis=1)*lam_sum[k])
-                adj = np.clip(lambda_org[k, :] - self._zeta * avg, 0, None)
-                lambda_new[k, :] = adj / adj.sum() * lam_sum[k]
+            # Proximity weighted average of the other factors, scaled to the size of each factor
+            avg = ckl @ (lambda_org / lambda_org.sum(axis = 1).reshape((-1, 1))) * lam_sum
+            lambda_new = np.clip(lambda_org - self._zeta * avg, 0, None)
+            lambda_new *= lam_sum / lambda_new.sum(axis = 1).reshape((-1, 1))
             v = np.abs(lambda_new - lambda_org).max(axis = 1) / lambda_org.sum(axis = 1)
             meanchange = v.mean()
             if self._verbose > 2 or (self._verbose > 1 and it % 10 == 0) or (self._verbose > 1 and it == self._max_iter_gamma - 1):
                 logging.info(f"Penalized M-step, update lambda : {it}-th iteration, mean max change {meanchange:.4f}")
-            lambda_org = copy.copy(lambda_new)
+            lambda_org = lambda_new
             it += 1
+        return lambda_org
 
-        if self._verbose > 0:
-            # Estimate likelihood for current values of lambda.
-            scores = self.approx_score(batch)
-            logging.info(f"{self._updatect}-th global update. Scores: " + ", ".join(['%.2e'%x for x in scores]))
+    def update_lambda_penalized(self, batch):
+        lambda_hat = self.penalized_sstats(batch)
+        # Estimate likelihood for current values of lambda.
+        _ = self.monitor(batch)
+        self.update_global(lambda_hat, batch.N)
+        return 1
 
+    def update_global(self, lambda_hat, N):
+        """
+        Online update of lambda with an estimate lambda_hat from a minibatch of N pixels
+        """
+        # rhot will be between 0 and 1, and says how much to weight
+        # the information we got from this mini-batch.
         rhot = pow(self._tau0 + self._updatect, -self._kappa)
         self._lambda = (1-rhot) * self._lambda + \
-                       rhot * ((self._N / batch.N) * lambda_org)
-        self._Elog_beta = _dirichlet_expectation_2d(self._lambda)
+                       rhot * ((self._N / N) * lambda_hat)
+        self._Elog_beta = _dirichlet_expectation_2d(self._lambda).astype(self._dtype, copy=False)
         self._updatect += 1
-        return 1
 
     def update_lambda(self, batch):
         """
         Process one minibatch
         """
-        # rhot will be between 0 and 1, and says how much to weight
-        # the information we got from this mini-batch.
-
         # E step to update gamma, phi | lambda for mini-batch
         sstats = self.do_e_step(batch)
         # Estimate likelihood for current values of lambda.
-        scores = self.approx_score(batch)
+        scores = self.monitor(batch)
+        self.update_global(self._eta + sstats, batch.N)
+        return scores
+
+    def monitor(self, batch):
+        """
+        Score the minibatch if the current update is to be evaluated
+        (see evaluate_every), write the scores to the log and the score stream.
+        Return the scores or None
+        """
+        if self._evaluate_every == 0 or (self._evaluate_every < 0 and self._verbose <= 0):
+            return None
+        if self._evaluate_every > 0 and (self._updatect + 1) % self._evaluate_every != 0:
+            return None
+        pixel_index = None
+        if self._score_sample > 0 and self._score_sample < batch.N:
+            pixel_index = np.sort(self.rng_.choice(batch.N, self._score_sample, replace=False))
+        scores = self.approx_score(batch, pixel_index)
         if self._verbose > 0:
             logging.info(f"{self._updatect}-th global update. Scores: " + ", ".join(['%.2e'%x for x in scores]))
-
-        rhot = pow(self._tau0 + self._updatect, -self._kappa)
-        self._lambda = (1-rhot) * self._lambda + \
-                       rhot * ((self._N / batch.N) * (self._eta + sstats) )
-        self._Elog_beta = _dirichlet_expectation_2d(self._lambda)
-        self._updatect += 1
+        if self._score_stream is not None:
+            if not self._score_header:
+                self._score_stream.write("\t".join(["update", "n_pixel", "n_scored", "pixel", "patch", "gamma", "beta", "total"]) + "\n")
+                self._score_header = True
+            n = batch.N if pixel_index is None else len(pixel_index)
+            self._score_stream.write("\t".join([str(self._updatect), str(batch.N), str(n)] + ['%.6e'%x for x in scores]) + "\n")
         return scores
 
-    def approx_score(self, batch):
-
+    def approx_score(self, batch, pixel_index = None):
+        """
+        Approximate per pixel (anchor) ELBO terms, the pixel term is
+        estimated from the pixels in pixel_index if provided
+        """
         score_gamma = 0
         score_beta  = 0
         Elog_theta = _dirichlet_expectation_2d(batch.gamma)
 
         # E[log p(x | theta, phi, beta)]
-        score_pixel = batch.mtx @ self._Elog_beta.T
-        score_pixel = np.multiply(batch.phi, score_pixel/batch.N).sum()
+        mtx, phi, N = batch.mtx, batch.phi, batch.N
+        if pixel_index is not None:
+            mtx, phi, N = mtx[pixel_index, :], phi[pixel_index, :], len(pixel_index)
+        score_pixel = mtx @ self._Elog_beta.T
+        if issparse(phi):
+            score_pixel = phi.multiply(score_pixel/N).sum()
+        else:
+            score_pixel = np.multiply(phi, score_pixel/N).sum()
         score_patch = batch.ll
 
         # E[log p(theta | alpha) - log q(theta | gamma)]
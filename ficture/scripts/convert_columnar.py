@@ -0,0 +1,47 @@
+### Convert a (gzipped) tsv file, e.g. batched.matrix.tsv.gz or the hexagon DGE,
+### to the chunked binary columnar store read by slda_decode, transform, and fit_model
+
+import sys, os, argparse, gzip, logging
+import pandas as pd
+
+from ficture.loaders.columnar_store import ColumnarWriter
+
+def convert_columnar(_args):
+
+    parser = argparse.ArgumentParser(prog = "convert_columnar")
+    parser.add_argument('--input', type=str, help='')
+    parser.add_argument('--output', type=str, help='Output directory')
+    parser.add_argument('--code_columns', nargs='*', type=str, default=['random_index', 'gene'], help='Columns to store as dictionary coded integers (non-numeric columns are always coded)')
+    parser.add_argument('--float_columns', nargs='*', type=str, default=['X', 'Y', 'x', 'y'], help='Columns to store as float32')
+    parser.add_argument('--row_group_size', type=int, default=1000000, help='')
+    parser.add_argument('--chunksize', type=int, default=1000000, help='')
+    parser.add_argument('--compress', action='store_true', help='Compress each row group (smaller files, slower to read)')
+    args = parser.parse_args(_args)
+    if len(_args) == 0:
+        parser.print_help()
+        return
+
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+    if not os.path.exists(args.input):
+        sys.exit("ERROR: cannot find input file")
+
+    if args.input.endswith(".gz"):
+        with gzip.open(args.input, 'rt') as rf:
+            header = rf.readline().strip().split('\t')
+    else:
+        with open(args.input, 'r') as rf:
+            header = rf.readline().strip().split('\t')
+    dty = {x:str for x in args.code_columns if x in header}
+    writer = ColumnarWriter(args.output, row_group_size=args.row_group_size,\
+                            code_columns=args.code_columns,\
+                            float_columns=args.float_columns,\
+                            compress=args.compress)
+    n = 0
+    for chunk in pd.read_csv(args.input, sep='\t', chunksize=args.chunksize, dtype=dty):
+        writer.write(chunk)
+        n += chunk.shape[0]
+        logging.info(f"Read {n} lines")
+    writer.close()
+
+if __name__ == "__main__":
+    convert_columnar(sys.argv[1:])
@@ -3,20 +3,13 @@
 import sys, io, os, gzip, copy, re, time, argparse
 import numpy as np
 import pandas as pd
-import scipy.stats
-from mpmath import mp
 from scipy.sparse import *
-from joblib.parallel import Parallel, delayed
 
 from ficture.utils import utilt
 
-## calculate the log10 of the chi2 upper tail probability
+## calculate (minus) the log10 of the chi2 upper tail probability
 def log10_chi2_sf(x, df=1):
-    mp.dps = 8
-    log_gamma_a = mp.loggamma(df/2.0)
-    log_upper_gamma = mp.log(mp.gammainc(df/2.0, float(x)/2.0, mp.inf, regularized=False))
-    log_sf = log_upper_gamma - log_gamma_a
-    return 0-log_sf/np.log(10)
+    return 0-utilt.chi2_logsf(x, df)/np.log(10)
 
 def de_bulk(_args):
 
@@ -29,7 +22,7 @@ def de_bulk(_args):
     parser.add_argument('--max_pval_output', default=1e-3, type=float, help='')
     parser.add_argument('--min_fold_output', default=1.5, type=float, help='')
     parser.add_argument('--min_output_per_factor', default=10, type=int, help='Even when there are no significant DE genes, output top genes for each factor')
-    parser.add_argument('--thread', default=1, type=int, help='')
+    parser.add_argument('--thread', default=1, type=int, help='Not used, kept for compatibility')
     parser.add_argument('--use_input_header', action = 'store_true', help='')
     args = parser.parse_args(_args)
 
@@ -75,60 +68,15 @@ def de_bulk(_args):
 
     print(f"Testing {M} genes over {K} factors")
 
-    def chisq(k,info,total_k,total_umi):
-        res = []
-        if total_k <= 0:
-            return res
-        for name, v in info.iterrows():
-            if v[k] <= 0:
-                continue
-            tab=np.zeros((2,2))
-            tab[0,0]=v[str(k)]
-            tab[0,1]=v["gene_tot"]-tab[0,0]
-            tab[1,0]=total_k-tab[0,0]
-            tab[1,1]=total_umi-total_k-v["gene_tot"]+tab[0,0]
-            fd=tab[0,0]/total_k/tab[0,1]*(total_umi-total_k)
-            if fd < 1:
-                continue
-            tab = np.around(tab, 0).astype(int) + 1
-            chi2, p, dof, ex = scipy.stats.chi2_contingency(tab, correction=False)
-            res.append([name,k,chi2,p,fd,v["gene_tot"]])
-        return res
-
-    res = []
-    if args.thread > 1:
-        for k, kname in enumerate(header):
-            idx_slices = [idx for idx in utilt.gen_even_slices(M, args.thread)]
-            with Parallel(n_jobs=args.thread, verbose=0) as parallel:
-                result = parallel(delayed(chisq)(kname, \
-                            info.iloc[idx, :].loc[:, [kname, 'gene_tot']],\
-                            total_k[k], total_umi) for idx in idx_slices)
-            res += [item for sublist in result for item in sublist]
-    else:
-        for name, v in info.iterrows():
-            for k, kname in enumerate(header):
-                if total_k[k] <= 0 or v[str(k)] <= 0:
-                    continue
-                tab=np.zeros((2,2))
-                tab[0,0]=v[kname]
-                tab[0,1]=v["gene_tot"]-tab[0,0]
-                tab[1,0]=total_k[k]-tab[0,0]
-                tab[1,1]=total_umi-total_k[k]-v["gene_tot"]+tab[0,0]
-                fd=tab[0,0]/total_k[k]/tab[0,1]*(total_umi-total_k[k])
-                if fd < 1:
-                    continue
-                tab = np.around(tab, 0).astype(int) + 1
-                chi2, p, dof, ex = scipy.stats.chi2_contingency(tab, correction=False)
-                res.append([name,kname,chi2,p,fd,v["gene_tot"]])
-
-    chidf=pd.DataFrame(res,columns=['gene','factor','Chi2','pval','FoldChange','gene_total'])
+    chidf = utilt.chisq_de(info, header, total_k, total_umi)
     chidf["Rank"] = chidf.groupby(by = "factor")["Chi2"].rank(ascending=False)
     chidf = chidf.loc[((chidf.pval<pcut)&(chidf.FoldChange>fcut)) | (chidf.Rank < args.min_output_per_factor), :]
     chidf.sort_values(by=['factor','Chi2'],ascending=[True,False],inplace=True)
     chidf.Chi2 = chidf.Chi2.map(lambda x : "{:.1f}".format(x) )
     chidf.FoldChange = chidf.FoldChange.map(lambda x : "{:.2f}".format(x) )
     chidf.gene_total = chidf.gene_total.astype(int)
-    chidf["log10pval"] = [log10_chi2_sf(x) for x in chidf.Chi2]
+    chidf["log10pval"] = log10_chi2_sf(chidf.Chi2.astype(float).values)
+    chidf.log10pval = chidf.log10pval.map(lambda x : "{:.8g}".format(x) )
     chidf.drop(columns = 'Rank', inplace=True)
 
     outpath=os.path.dirname(args.output)
@@ -1,4 +1,6 @@
 import sys, io, os, gzip, glob, copy, re, time, warnings, pickle, argparse, logging
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict,Counter
 import numpy as np
 import pandas as pd
@@ -7,12 +9,85 @@ from datetime import datetime
 from scipy.sparse import *
 from sklearn.utils import check_random_state
 from sklearn.preprocessing import normalize
-from joblib import Parallel, delayed
-from sklearn.decomposition import LatentDirichletAllocation as LDA
+from sklearn.decomposition import LatentDirichletAllocation
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from ficture.utils.utilt import gen_even_slices, chisq, make_mtx_from_dge
+from ficture.utils.utilt import make_mtx_from_dge, chisq_de, coherence_score
+from ficture.models.online_lda import LDA
+from ficture.utils.shared_array import share_array, share_sparse, attach, attach_sparse
 from ficture.loaders.unit_loader import UnitLoader
+from ficture.loaders.unit_cache import UnitCache, cache_path, file_signature, save_csr, has_csr, load_csr
+from ficture.loaders.columnar_store import is_columnar, columnar_header, ColumnarReader
+
+def lda_score(model, X):
+    # ficture's LDA.score returns (bound, log likelihood)
+    score = model.score(X)
+    return score[0] if isinstance(score, tuple) else score
+
+### Restarts are trained and scored as tasks on shared (read only) inputs
+
+_candidate_data = {}
+
+def _set_candidate_data(data, ctx):
+    _candidate_data.update(data)
+    _candidate_data.update(ctx)
+
+def _init_candidate_worker(specs, ctx):
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+    data = {k:(attach_sparse(v) if v[0] in ["csr", "csc"] else attach(v)) for k, v in specs.items()}
+    _set_candidate_data(data, ctx)
+
+def _train_candidate(model, orders, score):
+    """Run partial_fit on the training units in each order, return the
+    model and (if score) its held-out score"""
+    d = _candidate_data
+    for idx in orders:
+        _ = model.partial_fit(d["mtx_log_norm"][idx, :])
+    if isinstance(model, LDA):
+        model.close_pool()
+    score_test = None
+    if score:
+        score_test = lda_score(model, d["mtx_test_norm"]) / d["mtx_test_norm"].shape[0]
+    return model, score_test
+
+def _evaluate_candidate(r, model, train_idx):
+    d = _candidate_data
+    K, topM, mtx, gene_f = d["K"], d["topM"], d["mtx"], d["gene_f"]
+    factor_header = list(np.arange(K).astype(str) )
+    t0 = time.time()
+    score_train = lda_score(model, d["mtx_log_norm"][train_idx, :])/len(train_idx)
+    score_test = lda_score(model, d["mtx_test_norm"])/d["mtx_test_norm"].shape[0]
+    logging.info(f"{r}: {score_train:.2f}, {score_test:.2f}")
+    # Transform the test set, statistics below are computed in float64
+    theta = model.transform(d["mtx_test_norm"]).astype(np.float64, copy=False)
+    topk = theta.argmax(axis = 1)
+    logging.info(f"{Counter(topk)}")
+    # Get DE genes from the test data
+    info = mtx.T @ theta
+    info = pd.DataFrame(info, columns = factor_header)
+    info.index = d["gene"]
+    info['gene_tot'] = info[factor_header].sum(axis = 1)
+    info.drop(index = info.index[info.gene_tot < d["score_feature_min"]], inplace = True)
+    logging.info(f"Computing naive DE for {len(info)} genes")
+    total_k = np.array(info[factor_header].sum(axis = 0) )
+    total_umi = info[factor_header].sum().sum()
+    chidf = chisq_de(info, factor_header, total_k, total_umi)
+    chidf["Rank"] = chidf.groupby(by = "factor")["Chi2"].rank(ascending=False)
+    chidf.gene_total = chidf.gene_total.astype(int)
+    chidf.sort_values(by=['factor','Chi2'],ascending=[True,False],inplace=True)
+    # Compute a "coherence" score using top DE gene co-occurrence
+    top_genes = []
+    for k in range(K):
+        topm = min(topM, chidf.factor.eq(str(k)).sum())
+        if topm < topM:
+            logging.info(f"Factor {k} has only {topm} over-expressed genes")
+        top_genes.append(chidf.loc[chidf.factor.eq(str(k))].gene.iloc[:topm].map(d["ft_dict"]).values)
+    coh_score = [[r] + x for x in coherence_score(mtx, theta, gene_f, top_genes)]
+    score = [x[-1] for x in coh_score]
+
+    t1 = time.time() - t0
+    logging.info(f"R={r}, {np.mean(score):.2f}, {np.median(score):.2f}, {t1:.2f}s")
+    return {'score_train':score_train, 'score_test':score_test, 'model':model, 'coherence':score}, coh_score
 
 def fit_model(_args):
 
@@ -27,6 +102,10 @@ def fit_model(_args):
     parser.add_argument('--epoch', type=int, default=1, help='')
     parser.add_argument('--test_split', type=float, default=.5, help='')
     parser.add_argument('--thread', type=int, default=1, help='')
+    parser.add_argument('--restart_thread', type=int, default=0, help='Number of restarts trained at the same time (each using thread/restart_thread threads), 0 for min(R, thread)')
+    parser.add_argument('--prune_eta', type=float, default=2, help='After each of the first epoch_init-1 epochs keep the best 1/prune_eta of the restarts by held-out score, 1 to keep all')
+    parser.add_argument('--prune_margin', type=float, default=0.001, help='Restarts with held-out score within this (relative) margin of the best are not pruned')
+    parser.add_argument('--persistent_pool', action='store_true', help='Train with ficture\'s LDA, which keeps one worker pool and the factor matrix in shared memory across all updates (faster with --thread > 1). Its minibatch order and E-step differ from the default scikit-learn LatentDirichletAllocation, so results differ')
     parser.add_argument('--seed', type=int, default=-1, help='')
 
     parser.add_argument('--log_norm', action='store_true', help='')
@@ -41,6 +120,8 @@ def fit_model(_args):
     parser.add_argument('--epoch_id_length', type=int, default=2, help='')
     parser.add_argument('--min_ct_per_unit', type=int, default=50, help='')
     parser.add_argument('--min_ct_per_feature', type=int, default=50, help='')
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32'], help='Floating point type of the count matrices and the model. float32 halves memory and memory traffic, posterior counts are accumulated in float64')
+    parser.add_argument('--cache', type=str, default='', help='Directory to keep the parsed input (memory-mapped) for later runs on the same input and parameters, e.g. with a different nFactor. If empty, the parsed units are kept in memory only when this run reads the input more than once')
     parser.add_argument('--debug', action='store_true', help='')
 
     args = parser.parse_args(_args)
@@ -54,6 +135,7 @@ def fit_model(_args):
     rng = check_random_state(seed)
 
     key = args.key
+    dtype = np.dtype(args.dtype)
     thread = args.thread
     R = args.R
     K = args.nFactor
@@ -70,12 +152,31 @@ def fit_model(_args):
         feature_list = pd.read_csv(args.feature, sep='\t', dtype={gene_key:str})[gene_key].tolist()
         feature_list = list(set(feature_list))
 
-    feature, brc, mtx_org, ft_dict, bc_dict = make_mtx_from_dge(args.input,\
-        min_ct_per_unit = args.min_ct_per_unit, \
-        min_ct_per_feature = args.min_ct_per_feature, \
-        feature_list = feature_list, \
-        unit = args.unit_label, key = key)
-    unit_sum = mtx_org.sum(axis = 1)
+    cache_dir = None
+    if args.cache != '':
+        signature = file_signature(args.input)
+        signature.update({"unit":unit_key, "feature":gene_key, "key":key, "dtype":dtype.name,\
+            "min_ct_per_unit":args.min_ct_per_unit, "min_ct_per_feature":args.min_ct_per_feature,\
+            "feature_list":None if feature_list is None else sorted(feature_list),\
+            "epoch_id_length":args.epoch_id_length})
+        cache_dir = cache_path(args.cache, signature)
+    if cache_dir is not None and has_csr(cache_dir, "dge"):
+        feature = pd.read_pickle(os.path.join(cache_dir, "feature.p"))
+        brc = pd.read_pickle(os.path.join(cache_dir, "brc.p"))
+        mtx_org = load_csr(cache_dir, "dge")
+        ft_dict = {x:i for i,x in enumerate(feature.gene)}
+        logging.info(f"Read parsed input from {cache_dir}")
+    else:
+        feature, brc, mtx_org, ft_dict, bc_dict = make_mtx_from_dge(args.input,\
+            min_ct_per_unit = args.min_ct_per_unit, \
+            min_ct_per_feature = args.min_ct_per_feature, \
+            feature_list = feature_list, \
+            unit = args.unit_label, key = key, dtype = dtype)
+        if cache_dir is not None:
+            feature.to_pickle(os.path.join(cache_dir, "feature.p"))
+            brc.to_pickle(os.path.join(cache_dir, "brc.p"))
+            save_csr(cache_dir, "dge", mtx_org)
+    unit_sum = mtx_org.sum(axis = 1, dtype = np.float64)
     unit_sum_mean = np.mean(unit_sum)
     size_factor = unit_sum / unit_sum_mean
     gene_f = feature.Weight.values
@@ -83,7 +184,6 @@ def fit_model(_args):
     N, M = mtx_org.shape
     logging.info(f"Read data with {N} units, {M} features")
     Ntrain = int(N*args.test_split)
-    Ntest = N - Ntrain
     train_idx = set(rng.choice(N, Ntrain, replace=False) )
     test_idx = set(range(N)) - train_idx
     train_idx = sorted(list(train_idx))
@@ -103,72 +203,88 @@ def fit_model(_args):
     else:
         mtx_log_norm = mtx_org
 
-    mtx_log_norm = mtx_log_norm.tocsr()
+    mtx_log_norm = mtx_log_norm.tocsr().astype(dtype, copy=False)
     results = {}
     coh_score = []
     mtx = mtx_org[test_idx, :].tocsc()
     factor_header = list(np.arange(K).astype(str) )
+
+    ### Random restarts, run concurrently with the cores split between
+    ### restarts and the threads of each model
+    n_proc = args.restart_thread if args.restart_thread > 0 else thread
+    n_proc = max(1, min(n_proc, R, thread))
+    model_thread = max(1, thread // n_proc)
+    logging.info(f"Train {R} restarts, {n_proc} at a time with {model_thread} thread(s) each")
+    # Shuffles are drawn as if the restarts ran one after another
+    orders = []
     for r in range(R):
-        t0 = time.time()
-        model = LDA(n_components=K, learning_method='online', batch_size=b_size, total_samples = N, learning_offset = args.tau, learning_decay = args.kappa, doc_topic_prior = args.alpha, n_jobs = thread, verbose = 0, random_state=seed)
+        orders.append([])
         for e in range(args.epoch_init):
             rng.shuffle(train_idx)
-            _ = model.partial_fit(mtx_log_norm[train_idx, :])
-        score_train = model.score(mtx_log_norm[train_idx, :])/Ntrain
-        score_test = model.score(mtx_log_norm[test_idx, :])/Ntest
-        logging.info(f"{r}: {score_train:.2f}, {score_test:.2f}")
-        # Transform the test set
-        theta = model.transform(mtx_log_norm[test_idx, :])
-        topk = theta.argmax(axis = 1)
-        logging.info(f"{Counter(topk)}")
-        # Get DE genes from the test data
-        info = mtx.T @ theta
-        info = pd.DataFrame(info, columns = factor_header)
-        info.index = feature.gene.values
-        info['gene_tot'] = info[factor_header].sum(axis = 1)
-        info.drop(index = info.index[info.gene_tot < score_feature_min], inplace = True)
-        logging.info(f"Computing naive DE for {len(info)} genes")
-        total_k = np.array(info[factor_header].sum(axis = 0) )
-        total_umi = info[factor_header].sum().sum()
-        res = []
-        for k, kname in enumerate(factor_header):
-            idx_slices = [idx for idx in gen_even_slices(len(info), thread)]
-            with Parallel(n_jobs=thread, verbose=0) as parallel:
-                result = parallel(delayed(chisq)(kname, \
-                            info.iloc[idx, :].loc[:, [kname, 'gene_tot']],\
-                            total_k[k], total_umi) for idx in idx_slices)
-            res += [item for sublist in result for item in sublist]
-        chidf=pd.DataFrame(res,columns=['gene','factor','Chi2','pval','FoldChange','gene_total'])
-        chidf["Rank"] = chidf.groupby(by = "factor")["Chi2"].rank(ascending=False)
-        chidf.gene_total = chidf.gene_total.astype(int)
-        chidf.sort_values(by=['factor','Chi2'],ascending=[True,False],inplace=True)
-        # Compute a "coherence" score using top DE gene co-occurrence
-        score = []
-        for k in range(K):
-            topm = min(topM, chidf.factor.eq(str(k)).sum())
-            if topm < topM:
-                logging.info(f"Factor {k} has only {topm} over-expressed genes")
-            if topm == 0:
-                continue
-            wd_idx = chidf.loc[chidf.factor.eq(str(k))].gene.iloc[:topm].map(ft_dict).values
-            wd_idx = sorted( list(wd_idx), key = lambda x : -gene_f[x])
-            s = 0
-            for ii in range(topm - 1):
-                for jj in range(ii+1, topm):
-                    i = wd_idx[ii]
-                    j = wd_idx[jj]
-                    idx = mtx.indices[mtx.indptr[i]:mtx.indptr[i+1]]
-                    denom = mtx[:, [i]].toarray()[idx] * gene_f[j] / gene_f[i]
-                    num = mtx[:, [j]].toarray()[idx]
-                    s += (theta[idx, k].reshape((-1, 1)) * np.log(num/denom + 1)).sum()
-            s0 = s / theta[:, k].sum()
-            coh_score.append([r, k, s, s0])
-            score.append(s0)
-
-        t1 = time.time() - t0
-        t0 = time.time()
-        logging.info(f"R={r}, {np.mean(score):.2f}, {np.median(score):.2f}, {t1:.2f}s")
-        results[r] = {'score_train':score_train, 'score_test':score_test, 'model':model, 'coherence':score}
+            orders[r].append(np.array(train_idx))
+    data = {"mtx_log_norm":mtx_log_norm, "mtx_test_norm":mtx_log_norm[test_idx, :], "mtx":mtx, "gene_f":gene_f}
+    ctx = {"K":K, "topM":topM, "score_feature_min":score_feature_min,\
+           "gene":feature.gene.values, "ft_dict":ft_dict}
+    buffers = []
+    if n_proc > 1:
+        specs = {}
+        for k, v in data.items():
+            if issparse(v):
+                b, specs[k] = share_sparse(v)
+                buffers += b
+            else:
+                b, specs[k] = share_array(v)
+                buffers.append(b)
+        executor = ProcessPoolExecutor(max_workers=n_proc, mp_context=mp.get_context("spawn"),\
+                                       initializer=_init_candidate_worker, initargs=(specs, ctx))
+        run = lambda fn, tasks: list(executor.map(fn, *zip(*tasks)))
+    else:
+        _set_candidate_data(data, ctx)
+        run = lambda fn, tasks: [fn(*x) for x in tasks]
+
+    models = {}
+    for r in range(R):
+        if args.persistent_pool:
+            # Keeps one worker pool for all partial_fit calls and restarts
+            models[r] = LDA(n_components=K, learning_method='online', batch_size=b_size, total_samples = N, learning_offset = args.tau, learning_decay = args.kappa, doc_topic_prior = args.alpha, n_jobs = model_thread, verbose = 0, random_state=seed)
+        else:
+            models[r] = LatentDirichletAllocation(n_components=K, learning_method='online', batch_size=b_size, total_samples = N, learning_offset = args.tau, learning_decay = args.kappa, doc_topic_prior = args.alpha, n_jobs = model_thread, verbose = 0, random_state=seed)
+    # Successive halving: after each epoch but the last, keep the best
+    # 1/prune_eta of the restarts by held-out score, and any restart
+    # within prune_margin (relative) of the best
+    alive = list(range(R))
+    t0 = time.time()
+    for e in range(args.epoch_init):
+        prune = e < args.epoch_init - 1 and args.prune_eta > 1 and len(alive) > 1
+        out = run(_train_candidate, [(models[r], orders[r][e:e+1], prune) for r in alive])
+        score_test = {}
+        for r, (model, s) in zip(alive, out):
+            models[r] = model
+            score_test[r] = s
+        if not prune:
+            continue
+        logging.info(f"Epoch {e}, held-out scores " + ", ".join([f"{r}: {score_test[r]:.2f}" for r in alive]))
+        best = max(score_test.values())
+        ranked = sorted(alive, key = lambda r : -score_test[r])
+        n_keep = int(np.ceil(len(alive) / args.prune_eta))
+        kept = ranked[:n_keep] + [r for r in ranked[n_keep:] if score_test[r] >= best - args.prune_margin * abs(best)]
+        dropped = sorted(set(alive) - set(kept))
+        if len(dropped) > 0:
+            logging.info(f"Epoch {e}, pruned restarts {dropped} (best held-out score {best:.2f})")
+        alive = sorted(kept)
+        for r in dropped:
+            del models[r]
+    logging.info(f"Trained {R} restarts in {time.time() - t0:.2f}s")
+
+    out = run(_evaluate_candidate, [(r, models[r], orders[r][-1]) for r in alive])
+    for r, (res, coh) in zip(alive, out):
+        results[r] = res
+        coh_score += coh
+    if n_proc > 1:
+        executor.shutdown()
+        for b in buffers:
+            b.close()
+    _candidate_data.clear()
 
     pickle.dump(results, open(args.output + ".model_selection_candidates.p", 'wb'))
     coh_score = pd.DataFrame(coh_score, columns = ["R","K","Score0","Score"])
@@ -180,22 +296,54 @@ def fit_model(_args):
     ### Further update the selected model
     best_r = v.index[0]
     model = results[best_r]['model']
+    model.n_jobs = thread
     epoch = args.epoch_init * (1 - args.test_split)
     n_unit = 0
     chunksize = 2000000
-    with gzip.open(args.input, 'rt') as rf:
-        header = rf.readline().strip().split('\t')
+    columnar = is_columnar(args.input)
+    if columnar:
+        header = columnar_header(args.input)
+    else:
+        with gzip.open(args.input, 'rt') as rf:
+            header = rf.readline().strip().split('\t')
     header = [x.lower() if x != key else x for x in header]
     adt = {unit_key:str, key:int}
     adt.update({x:str for x in unit_attr})
+    ### Passes over the input that will be followed by another one keep the
+    ### parsed units, later passes replay the same batches from the parsed
+    ### matrix (in memory, or memory-mapped from --cache)
+    units = None
+    n_label = None # Epoch labels in the input, known after one pass
+    if cache_dir is not None and UnitCache.exists(cache_dir):
+        units = UnitCache.load(cache_dir)
+        if not units.complete and units.n_epoch <= args.epoch:
+            units = None # Stopped reading before the epochs needed now
+        else:
+            logging.info(f"Read {units.shape[0]} parsed units from {cache_dir}")
     while epoch < args.epoch:
-        reader = pd.read_csv(gzip.open(args.input, 'rt'), \
-                sep='\t',chunksize=chunksize, skiprows=1, names = header,
-                usecols=[unit_key,gene_key,key], dtype=adt)
-        batch_obj =  UnitLoader(reader, ft_dict, key, \
-            batch_id_prefix=args.epoch_id_length, \
-            min_ct_per_unit=args.min_ct_per_unit,
-            unit_id=unit_key,unit_attr=[])
+        if units is None:
+            if columnar:
+                reader = ColumnarReader(args.input, chunksize=chunksize, \
+                    names = header, usecols=[unit_key,gene_key,key])
+            else:
+                reader = pd.read_csv(gzip.open(args.input, 'rt'), \
+                    sep='\t',chunksize=chunksize, skiprows=1, names = header,
+                    usecols=[unit_key,gene_key,key], dtype=adt)
+            batch_obj =  UnitLoader(reader, ft_dict, key, \
+                batch_id_prefix=args.epoch_id_length, \
+                min_ct_per_unit=args.min_ct_per_unit,
+                unit_id=unit_key,unit_attr=[], dtype=dtype)
+            if args.epoch_id_length > 0:
+                n_pass = 1 if n_label is None else np.ceil((args.epoch - epoch) / max(1, n_label))
+            else:
+                n_pass = np.ceil(args.epoch - epoch)
+            if cache_dir is not None or n_pass > 1:
+                # A saved cache covers the whole file, for runs with more epochs
+                units = UnitCache.from_loader(batch_obj, b_size, max_epoch = None if cache_dir is not None else args.epoch)
+                if cache_dir is not None:
+                    units.save(cache_dir)
+        if units is not None:
+            batch_obj = units.loader()
         while batch_obj.update_batch(b_size):
             N = batch_obj.mtx.shape[0]
             if args.log_norm_size_factor:
@@ -210,16 +358,20 @@ def fit_model(_args):
             _ = model.partial_fit(mtx_fit)
             n_unit += N
             if args.debug:
-                logl = model.score(mtx_fit) / N
+                logl = lda_score(model, mtx_fit) / N
                 e = len(batch_obj.batch_id_list)
                 logging.info(f"Epoch {e-1}, finished {n_unit} units. batch logl: {logl:.4f}")
             if len(batch_obj.batch_id_list) > args.epoch:
                 break
         if args.epoch_id_length > 0:
-            epoch += len(batch_obj.batch_id_list)
+            n_label = len(batch_obj.batch_id_list)
+            epoch += n_label
         else:
             epoch += 1
 
+    if args.persistent_pool:
+        model.close_pool(shutdown=True)
+
     # Relabel factors
     weight = model.components_.sum(axis=1)
     ordered_k = np.argsort(weight)[::-1]
@@ -233,7 +385,7 @@ def fit_model(_args):
     res_f = args.output+".fit_result.tsv.gz"
     logging.info(f"Result file {res_f}")
     theta = model.transform(mtx_log_norm)
-    post_count = np.array(theta.T @ mtx_org)
+    post_count = np.array(theta.T.astype(np.float64) @ mtx_org)
     brc.rename(columns = {'j':'unit', 'X':'x', 'Y':'y'}, inplace = True)
     brc['topK'] = np.argmax(theta, axis = 1).astype(int)
     brc['topP'] = np.max(theta, axis = 1)
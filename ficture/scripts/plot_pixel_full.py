@@ -9,6 +9,7 @@ from scipy.sparse import *
 import cv2
 
 from ficture.loaders.pixel_factor_loader import BlockIndexedLoader
+from ficture.utils.tile_pyramid import TilePyramidWriter
 
 def plot_pixel_full(_args):
 
@@ -31,6 +32,8 @@ def plot_pixel_full(_args):
     parser.add_argument('--plot_um_per_pixel', type=float, default=1, help="Actual size (um) corresponding to each pixel in the output image")
     parser.add_argument('--org_coord', action='store_true', help="If the input coordinates do not include the offset (if your coordinates are from an existing figure, the offset is already factored in)")
     parser.add_argument('--plot_top', action='store_true', help="Plot top factor only")
+    parser.add_argument('--tile_format', type=str, default='', choices=['', 'deepzoom', 'xyz'], help="Write a multi-resolution tile pyramid instead of a single png, --output is then the prefix of output.dzi and output_files/ (deepzoom) or the tile directory (xyz). Input is streamed block by block with bounded memory")
+    parser.add_argument('--tile_size', type=int, default=256, help="Tile size (pixels) of the pyramid")
     parser.add_argument('--debug', action='store_true')
 
     args = parser.parse_args(_args)
@@ -94,15 +97,30 @@ def plot_pixel_full(_args):
             print(category_list)
 
     # Read input file, fill the rgb matrix
-    img = np.zeros((height,width,3), dtype=np.uint8)
     bg = args.background
     bg = [ np.uint8(int(bg[i:i+2], 16) ) for i in [0,2,4] ]
-    for c in range(3):
-        img[:,:,c] = bg[c]
+    if args.tile_format != '':
+        # Input is sorted by block then by the index axis, tiles behind
+        # the current position are complete
+        if args.output.endswith(".png"):
+            args.output = args.output[:-4]
+        tiles = TilePyramidWriter(args.output, width, height, tile_size=args.tile_size, tile_format=args.tile_format, background=bg)
+        block_axis = loader.meta.get('BLOCK_AXIS', 'X')
+        index_axis = 'Y' if block_axis == 'X' else 'X'
+        block_size = loader.meta['BLOCK_SIZE']
+        axis_min = {'X':loader.xmin, 'Y':loader.ymin}
+        logging.info(f"Write {len(tiles.dims)} levels of {args.tile_size} x {args.tile_size} tiles")
+    else:
+        img = np.zeros((height,width,3), dtype=np.uint8)
+        for c in range(3):
+            img[:,:,c] = bg[c]
     keptcol = ['X','Y'] + rgb
     for df in loader:
         if df.shape[0] == 0:
             continue
+        if args.tile_format != '':
+            last_block = float(df.BLOCK.iloc[-1])
+            last_pos = df[index_axis].iloc[-1]
         df['X'] = np.clip(((df.X - loader.xmin) / args.plot_um_per_pixel).astype(int),0,width-1)
         df['Y'] = np.clip(((df.Y - loader.ymin) / args.plot_um_per_pixel).astype(int),0,height-1)
         if categorical:
@@ -135,10 +153,24 @@ def plot_pixel_full(_args):
         logging.info(f"Reading pixels... {df.X.iloc[-1]}, {df.Y.iloc[-1]}, {df.shape[0]}")
         for i,c in enumerate(rgb):
             df[c] = np.clip(np.around(df[c] * 255),0,255).astype(np.uint8)
-            img[df.Y.values, df.X.values, [i]*df.shape[0]] = df[c].values
+            if args.tile_format == '':
+                img[df.Y.values, df.X.values, [i]*df.shape[0]] = df[c].values
+        if args.tile_format != '':
+            tiles.write(df.X.values, df.Y.values, df[rgb].values)
+            done, current, pos = [int(np.floor((v - axis_min[a]) / args.plot_um_per_pixel)) for v, a in \
+                [(last_block, block_axis), (last_block + block_size, block_axis), (last_pos, index_axis)]]
+            if block_axis == 'X':
+                tiles.complete(done, current, pos)
+            else:
+                tiles.complete_rows(done, current, pos)
         if args.debug:
             break
 
+    if args.tile_format != '':
+        tiles.close()
+        logging.info(f"Finished\n{args.output}")
+        return
+
     if not args.output.endswith(".png"):
         args.output += ".png"
     cv2.imwrite(args.output,img)
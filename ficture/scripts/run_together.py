@@ -59,6 +59,7 @@ def run_together(_args):
     aux_params.add_argument('--de-min-fold', type=float, default=1.5, help='Fold-change cutoff for differential expression')
     aux_params.add_argument('--decode-block-size', type=int, default=100, help='Block size for pixel decoding output')
     aux_params.add_argument('--decode-scale', type=int, default=100, help='Scale parameters for pixel decoding output')
+    aux_params.add_argument('--decode-native-sort', action='store_true', default=False, help='Write the sorted and indexed pixel decoding output directly from slda_decode, without bgzip, tabix, and sort')
     aux_params.add_argument('--cmap-name', type=str, default="turbo", help='Name of color map')
     aux_params.add_argument('--dge-precision', type=float, default=2, help='Output precision of hexagon coordinates')
     aux_params.add_argument('--fit-precision', type=float, default=2, help='Output precision of model fitting')
@@ -186,11 +187,11 @@ gzip -cd ${input} | awk 'BEGIN{FS=OFS="\t"} NR==1{for(i=1;i<=NF;i++){if($i=="X")
                 mm.add_target(f"{model_prefix}.done", [args.in_tsv, hexagon], cmds)
 
     if args.decode:
-        if not shutil.which(args.bgzip.split(" ")[0]):
+        if not args.decode_native_sort and not shutil.which(args.bgzip.split(" ")[0]):
             logging.error(f"Cannot find {args.bgzip}. Please make sure that the path to --bgzip is correct")
             sys.exit(1)
 
-        if not shutil.which(args.tabix.split(" ")[0]):
+        if not args.decode_native_sort and not shutil.which(args.tabix.split(" ")[0]):
             logging.error(f"Cannot find {args.tabix}. Please make sure that the path to --tabix is correct")
             sys.exit(1)
 
@@ -262,12 +263,16 @@ rm ${input}
                     cmds.append(rf"$(info --------------------------------------------------------------)")
                     cmds.append(rf"$(info Performing pixel-level decoding..)")
                     cmds.append(rf"$(info --------------------------------------------------------------)")
-                    cmds.append(f"ficture slda_decode --input {batch_in} --output {decode_prefix} --model {model} --anchor {anchor} --anchor_in_um --neighbor_radius {radius} --mu_scale {args.mu_scale} --key {args.key_col} --precision {args.decode_precision} --lite_topk_output_pixel {args.decode_top_k} --lite_topk_output_anchor {args.decode_top_k} --thread {args.threads}")
-
-                    cmds.append(rf"$(info --------------------------------------------------------------)")
-                    cmds.append(rf"$(info Sorting and reformatting the pixel-level output..)")
-                    cmds.append(rf"$(info --------------------------------------------------------------)")
-                    cmds.append(f"bash {script_path} {decode_prefix}.pixel.tsv.gz {decode_prefix}.pixel.sorted.tsv.gz {minmax_out} {model_id} {args.decode_block_size} {args.decode_scale} {args.decode_top_k} {args.bgzip} {args.tabix}")
+                    if args.decode_native_sort:
+                        # Same block size and scale as in sort_decode.sh
+                        cmds.append(f"ficture slda_decode --input {batch_in} --output {decode_prefix} --model {model} --anchor {anchor} --anchor_in_um --neighbor_radius {radius} --mu_scale {args.mu_scale} --key {args.key_col} --precision {args.decode_precision} --lite_topk_output_pixel {args.decode_top_k} --lite_topk_output_anchor {args.decode_top_k} --thread {args.threads} --sorted_output --coor_minmax {minmax_out} --sort_block_size 2000 --sort_scale 100")
+                    else:
+                        cmds.append(f"ficture slda_decode --input {batch_in} --output {decode_prefix} --model {model} --anchor {anchor} --anchor_in_um --neighbor_radius {radius} --mu_scale {args.mu_scale} --key {args.key_col} --precision {args.decode_precision} --lite_topk_output_pixel {args.decode_top_k} --lite_topk_output_anchor {args.decode_top_k} --thread {args.threads}")
+
+                        cmds.append(rf"$(info --------------------------------------------------------------)")
+                        cmds.append(rf"$(info Sorting and reformatting the pixel-level output..)")
+                        cmds.append(rf"$(info --------------------------------------------------------------)")
+                        cmds.append(f"bash {script_path} {decode_prefix}.pixel.tsv.gz {decode_prefix}.pixel.sorted.tsv.gz {minmax_out} {model_id} {args.decode_block_size} {args.decode_scale} {args.decode_top_k} {args.bgzip} {args.tabix}")
 
                     de_input=f"{decode_prefix}.posterior.count.tsv.gz"
                     de_output=f"{decode_prefix}.bulk_chisq.tsv"
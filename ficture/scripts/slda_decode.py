@@ -1,4 +1,4 @@
-import sys, os, argparse, logging, gzip, copy, re, time, warnings, pickle
+import sys, os, argparse, logging, gzip, copy, re, time, warnings, pickle, queue, threading
 import numpy as np
 import pandas as pd
 from sklearn.preprocessing import normalize
@@ -6,12 +6,14 @@ from datetime import datetime
 
 from ficture.models.online_slda import OnlineLDA
 from ficture.loaders.pixel_loader import PixelMinibatch
+from ficture.loaders.columnar_store import is_columnar, columnar_header, ColumnarReader
+from ficture.utils.topk_writer import TopkWriter, BlockSortedWriter
 
 def slda_decode(_args):
 
     parser = argparse.ArgumentParser(prog="slda_decode")
     # Innput and output info
-    parser.add_argument('--input', type=str, help='')
+    parser.add_argument('--input', type=str, help='A gzipped tsv file or a columnar store created by convert_columnar')
     parser.add_argument('--model', type=str, help='')
     parser.add_argument('--output', type=str, help='')
     parser.add_argument('--anchor', type=str, help='')
@@ -26,16 +28,30 @@ def slda_decode(_args):
 
     # Learning related parameters
     parser.add_argument('--thread', type=int, default=1, help='')
+    parser.add_argument('--backend', type=str, default='threading', choices=['threading', 'process'], help='Parallel backend used when --thread > 1. process runs minibatches in separate processes and avoids contention on the GIL')
+    parser.add_argument('--queue_size', type=int, default=2, help='Maximum number of chunks waiting between the reading, decoding, and writing stages')
     parser.add_argument('--neighbor_radius', type=float, default=25, help='The radius (um) of each anchor point\'s territory')
     parser.add_argument('--halflife', type=float, default=0.7, help='Control the decay of distance-based weight')
     parser.add_argument('--theta_init_bound_multiplier', type=float, default=.2, help='')
     parser.add_argument('--inner_max_iter', type=int, default=30, help='')
+    parser.add_argument('--active_set', action='store_true', help='Stop updating anchors and pixels once they converge, instead of iterating the whole minibatch. Faster but approximate')
+    parser.add_argument('--active_tol', type=float, default=-1, help='An anchor (pixel) is converged when the max change of its gamma (phi) is below this value, default is the overall tolerance (1e-4)')
+    parser.add_argument('--active_patience', type=int, default=3, help='Number of consecutive iterations an anchor (pixel) has to stay below --active_tol before it stops being updated. Larger is closer to the full E-step')
+    parser.add_argument('--max_active_factor', type=int, default=-1, help='If positive (and less than K), each anchor only keeps this many top factors from its initial theta, each pixel is only evaluated against the factors of its anchors. Saves time and memory when K is large')
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32'], help='Floating point type of the count matrix and the E-step. float32 halves memory and memory traffic, posterior counts are accumulated in float64')
     parser.add_argument('--model_scale', type=float, default=-1, help='')
     parser.add_argument('--seed', type=int, default=-1, help='')
 
     # Other
     parser.add_argument('--lite_topk_output_pixel', type=int, default=-1)
     parser.add_argument('--lite_topk_output_anchor', type=int, default=-1)
+    parser.add_argument('--compress_level', type=int, default=9, help='gzip compression level of the pixel and anchor output (1-9), lower is faster')
+    parser.add_argument('--sorted_output', action='store_true', help='Write the pixel level output as a block sorted, bgzip compressed, and tabix indexed file (.pixel.sorted.tsv.gz) instead of .pixel.tsv.gz')
+    parser.add_argument('--coor_minmax', type=str, default='', help='File with xmin, xmax, ymin, ymax (um) defining the offsets of the sorted output. If absent, use the range of the anchors')
+    parser.add_argument('--sort_block_size', type=int, default=2000, help='Block size (um) along X of the sorted output')
+    parser.add_argument('--sort_scale', type=int, default=100, help='Scale (per um) of the integer coordinates in the sorted output')
+    parser.add_argument('--sort_buffer', type=int, default=1000000, help='Number of pixels to sort in memory before spilling to temporary files')
+    parser.add_argument('--tmpdir', type=str, default=None, help='Directory for temporary files of the sorted output (default: same as output)')
     parser.add_argument('--log', type=str, default = '', help='files to write log to')
     parser.add_argument('--debug', action='store_true')
 
@@ -101,13 +117,20 @@ def slda_decode(_args):
         model = normalize(model, norm='l1', axis=1) * args.model_scale
     logging.info(f"{M} genes and {K} factors are read from input model")
 
-    slda = OnlineLDA(vocab=feature_kept, K=K, N=1e6, iter_inner=args.inner_max_iter, verbose = 1, seed = seed)
+    slda = OnlineLDA(vocab=feature_kept, K=K, N=1e6, iter_inner=args.inner_max_iter, verbose = 1, seed = seed,\
+                     active_set=args.active_set, active_tol=args.active_tol if args.active_tol > 0 else None,\
+                     active_patience=args.active_patience,\
+                     max_factor=max(0, args.max_active_factor), dtype=args.dtype)
     slda.init_global_parameter(model)
     init_bound = 1./K * args.theta_init_bound_multiplier
 
     ### Input pixel info (input has to contain certain columns with correct header)
-    with gzip.open(args.input, 'rt') as rf:
-        oheader = rf.readline().strip().split('\t')
+    columnar = is_columnar(args.input)
+    if columnar:
+        oheader = columnar_header(args.input)
+    else:
+        with gzip.open(args.input, 'rt') as rf:
+            oheader = rf.readline().strip().split('\t')
     oheader = [x.lower() if len(x) > 1 else x.upper() for x in oheader]
     input_header = [batch_id,"X","Y","gene",key]
     dty = {x:float for x in ['X','Y']}
@@ -118,59 +141,137 @@ def slda_decode(_args):
         mheader = ", ".join(mheader)
         sys.exit(f"Input misses the following column: {mheader}.")
 
-    pixel_reader = pd.read_csv(args.input, sep='\t', chunksize=chunk_size, \
+    if columnar:
+        pixel_reader = ColumnarReader(args.input, chunksize=chunk_size, \
+                names=oheader, usecols=input_header)
+    else:
+        pixel_reader = pd.read_csv(args.input, sep='\t', chunksize=chunk_size, \
                 skiprows=1, names=oheader, usecols=input_header, dtype=dty)
 
     pixel_obj = PixelMinibatch(pixel_reader, ft_dict, \
                             batch_id, key, mu_scale, \
                             radius=radius, halflife=args.halflife,\
-                            precision=args.precision, thread=args.thread)
+                            precision=args.precision, thread=args.thread,\
+                            backend=args.backend, dtype=np.dtype(args.dtype))
     ### anchor info
     pixel_obj.load_anchor(args.anchor, args.anchor_in_um)
     logging.info(f"Read {pixel_obj.grid_info.shape[0]} grid points")
     factor_header = pixel_obj.factor_header
 
+    ### Three stage pipeline: parse the next chunk and write the previous
+    ### results in background threads while the current chunk is decoded
+    stage_time = {'parse':0, 'decode':0, 'write':0}
+    parse_queue = queue.Queue(maxsize=args.queue_size)
+    write_queue = queue.Queue(maxsize=args.queue_size)
+    stage_error = []
+    stop_parse = threading.Event() # Set when decoding ends, before the last chunk if it failed
+
+    def parser_stage():
+        try:
+            while not stop_parse.is_set():
+                t0 = time.time()
+                chunk = pixel_obj.parse_chunk(args.thread)
+                stage_time['parse'] += time.time() - t0
+                parse_queue.put(chunk)
+                if chunk['last_chunk']:
+                    break
+        except BaseException as e:
+            stage_error.append(e)
+        parse_queue.put(None)
+
+    if args.sorted_output:
+        if os.path.isfile(args.coor_minmax):
+            coor = {}
+            with open(args.coor_minmax, 'r') as rf:
+                for line in rf:
+                    wd = line.strip().split('\t')
+                    if len(wd) == 2:
+                        coor[wd[0].strip()] = wd[1].strip()
+            xmin, xmax, ymin, ymax = [coor[x] for x in ['xmin','xmax','ymin','ymax']]
+        else:
+            logging.warning("--coor_minmax is not provided, offsets of the sorted output are set by the range of the anchors")
+            xmin, xmax = [f"{x:.2f}" for x in pixel_obj.grid_info.x.agg(['min','max']) + [-radius, radius]]
+            ymin, ymax = [f"{x:.2f}" for x in pixel_obj.grid_info.y.agg(['min','max']) + [-radius, radius]]
+        pixel_writer = BlockSortedWriter(args.output+".pixel.sorted.tsv.gz", factor_header,\
+                              topk=args.lite_topk_output_pixel,\
+                              offset_x=xmin, offset_y=ymin,\
+                              size_x=int(float(xmax)-float(xmin)+.5)+1,\
+                              size_y=int(float(ymax)-float(ymin)+.5)+1,\
+                              block_size=args.sort_block_size, scale=args.sort_scale,\
+                              buffer_size=args.sort_buffer, tmpdir=args.tmpdir,\
+                              compresslevel=args.compress_level)
+    else:
+        pixel_writer = TopkWriter(args.output+".pixel.tsv.gz", 'j', factor_header,\
+                              topk=args.lite_topk_output_pixel, id_from_xy=True,\
+                              compresslevel=args.compress_level)
+    anchor_writer = TopkWriter(args.output+".anchor.tsv.gz", 'minibatch',\
+                              [str(k) for k in range(K)], extra_header=['avg_size'],\
+                              topk=args.lite_topk_output_anchor,\
+                              compresslevel=args.compress_level)
+
+    def writer_stage():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            if len(stage_error) > 0:
+                continue # Keep draining so the decoder is not blocked
+            try:
+                t0 = time.time()
+                n_pixel, n_anchor = 0, 0
+                for b, suffix, xy, (b_indx, phi, grid_pt, asum, expElog_theta) in item:
+                    if args.sorted_output:
+                        n_pixel += pixel_writer.write(xy, phi)
+                    else:
+                        n_pixel += pixel_writer.write(suffix, xy, phi)
+                    n_anchor += anchor_writer.write(b, grid_pt, expElog_theta, extra=[asum])
+                dt = time.time() - t0
+                stage_time['write'] += dt
+                logging.info(f"Output {n_pixel} pixels and {n_anchor} anchors ({dt:.2f}s)")
+            except BaseException as e:
+                stage_error.append(e)
+
+    parser_thread = threading.Thread(target=parser_stage, daemon=True)
+    writer_thread = threading.Thread(target=writer_stage, daemon=True)
+    parser_thread.start()
+    writer_thread.start()
+
     post_count = np.zeros((K, M))
     n_batch = 0
-    while True:
-        read_n_batch = pixel_obj.read_chunk(args.thread)
-        logging.info(f"Read {read_n_batch} batches ({pixel_obj.dge_mtx.shape})")
-        pcount, pixel, anchor  = pixel_obj.run_chunk(slda, init_bound)
-        pixel.X = pixel.X.map('{:.2f}'.format)
-        pixel.Y = pixel.Y.map('{:.2f}'.format)
-        if args.lite_topk_output_pixel > 0 and args.lite_topk_output_pixel <= K:
-            X = pixel[factor_header].values
-            partial_indices = np.argpartition(X, -args.lite_topk_output_pixel, axis=1)[:, -args.lite_topk_output_pixel:]
-            sorted_top_indices = np.argsort(X[np.arange(X.shape[0])[:, None], partial_indices], axis=1)[:, ::-1]
-            top_indices = partial_indices[np.arange(partial_indices.shape[0])[:, None], sorted_top_indices]
-            top_values = X[np.arange(X.shape[0])[:, None], top_indices]
-            for k in range(args.lite_topk_output_pixel):
-                pixel[f"K{k+1}"] = top_indices[:, k]
-            for k in range(args.lite_topk_output_pixel):
-                pixel[f"P{k+1}"] = np.clip(top_values[:, k], 0, 1)
-            pixel.drop(columns = factor_header, inplace=True)
-        write_mode = 'w' if n_batch == 0 else 'a'
-        header_include = True if n_batch == 0 else False
-        pixel.to_csv(args.output+".pixel.tsv.gz", sep='\t', index=False, header=header_include, mode=write_mode, float_format="%.2e", compression={"method":"gzip"})
-        logging.info(f"Output {pixel.shape[0]} pixels and {anchor.shape[0]} anchors")
-        anchor.X = anchor.X.map('{:.2f}'.format)
-        anchor.Y = anchor.Y.map('{:.2f}'.format)
-        if args.lite_topk_output_anchor > 0 and args.lite_topk_output_anchor <= K:
-            X = anchor[factor_header].values
-            partial_indices = np.argpartition(X, -args.lite_topk_output_anchor, axis=1)[:, -args.lite_topk_output_anchor:]
-            sorted_top_indices = np.argsort(X[np.arange(X.shape[0])[:, None], partial_indices], axis=1)[:, ::-1]
-            top_indices = partial_indices[np.arange(partial_indices.shape[0])[:, None], sorted_top_indices]
-            top_values = X[np.arange(X.shape[0])[:, None], top_indices]
-            for k in range(args.lite_topk_output_anchor):
-                anchor[f"K{k+1}"] = top_indices[:, k]
-            for k in range(args.lite_topk_output_anchor):
-                anchor[f"P{k+1}"] = np.clip(top_values[:, k], 0, 1)
-            anchor.drop(columns = factor_header, inplace=True)
-        anchor.to_csv(args.output+".anchor.tsv.gz", sep='\t', index=False, header=header_include, mode=write_mode, float_format="%.2e", compression={"method":"gzip"})
-        n_batch += read_n_batch
-        post_count += pcount
-        if not pixel_obj.file_is_open:
-            break
+    t_start = time.time()
+    try:
+        while True:
+            chunk = parse_queue.get()
+            if chunk is None or len(stage_error) > 0:
+                break
+            read_n_batch = pixel_obj.set_chunk(chunk)
+            logging.info(f"Read {read_n_batch} batches ({pixel_obj.dge_mtx.shape})")
+            t0 = time.time()
+            pcount, results = pixel_obj.decode_chunk(slda, init_bound)
+            # Pixel info is taken now as the chunk is replaced before it is written
+            results = [(b,) + pixel_obj.pixel_output(r[0]) + (r,) for b, r in results]
+            dt = time.time() - t0
+            stage_time['decode'] += dt
+            logging.info(f"Decoded {read_n_batch} batches ({dt:.2f}s)")
+            write_queue.put(results)
+            n_batch += read_n_batch
+            post_count += pcount
+    finally:
+        stop_parse.set()
+        write_queue.put(None)
+        writer_thread.join()
+        while parser_thread.is_alive():
+            try: # Unblock the parser if decoding stopped early
+                parse_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+        parser_thread.join()
+        pixel_obj.close()
+        pixel_writer.close()
+        anchor_writer.close()
+    if len(stage_error) > 0:
+        raise stage_error[0]
+    logging.info(f"Processed {n_batch} batches in {time.time() - t_start:.2f}s. Time spent in each stage: parse {stage_time['parse']:.2f}s, decode {stage_time['decode']:.2f}s, write {stage_time['write']:.2f}s")
 
     ### Output posterior summaries
     if len(factor_names) == K:
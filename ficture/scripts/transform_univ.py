@@ -13,6 +13,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from sklearn.decomposition._online_lda_fast import _dirichlet_expectation_2d
 
 from ficture.loaders.pixel_to_unit_loader import PixelToUnit
+from ficture.loaders.columnar_store import is_columnar, columnar_header, ColumnarReader
 from ficture.utils.utilt import init_latent_vars
 
 def transform(_args):
@@ -38,6 +39,7 @@ def transform(_args):
     parser.add_argument('--log_norm_size_factor', action='store_true', help='')
     parser.add_argument('--scale_const', type=float, default=-1, help='')
     parser.add_argument('--unit_sum_mean', type=float, default=-1, help='')
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32'], help='Floating point type of the count matrix and the model. float32 halves memory and memory traffic, posterior counts are accumulated in float64')
     parser.add_argument('--debug', type=int, default=0, help='')
 
     args = parser.parse_args(_args)
@@ -56,8 +58,12 @@ def transform(_args):
     logging.basicConfig(level= getattr(logging, "INFO", None))
 
     ### Input
-    with gzip.open(args.input, 'rt') as rf:
-        header=rf.readline().strip().split('\t')
+    columnar = is_columnar(args.input)
+    if columnar:
+        header = columnar_header(args.input)
+    else:
+        with gzip.open(args.input, 'rt') as rf:
+            header=rf.readline().strip().split('\t')
     key = args.key.lower()
     header=[x.upper() if len(x) == 1 else x.lower() for x in header]
     usecol = ['X','Y','gene',key]
@@ -68,7 +74,11 @@ def transform(_args):
     miss_header = [x for x in usecol if x not in header]
     if len(miss_header) > 0:
         sys.exit(f"ERROR: {miss_header} is not in the input file")
-    reader = pd.read_csv(gzip.open(args.input, 'rt'), sep='\t',\
+    if columnar:
+        reader = ColumnarReader(args.input, chunksize=args.chunksize,\
+                                names=header, usecols=usecol)
+    else:
+        reader = pd.read_csv(gzip.open(args.input, 'rt'), sep='\t',\
                         chunksize=args.chunksize, skiprows=1, names=header,\
                         usecols=usecol, dtype=adt)
 
@@ -100,6 +110,10 @@ def transform(_args):
             _dirichlet_expectation_2d(model.components_)
         )
         M = len(feature_kept)
+    # The E-step runs in the type of the model parameters
+    dtype = np.dtype(args.dtype)
+    model.components_ = model.components_.astype(dtype, copy=False)
+    model.exp_dirichlet_component_ = model.exp_dirichlet_component_.astype(dtype, copy=False)
 
     ft_dict = {x:i for i,x in enumerate(feature_kept)}
     logging.info(f"Model loaded with {M} features and {K} factors")
@@ -128,7 +142,7 @@ def transform(_args):
     batch_obj = PixelToUnit(reader, ft_dict, key, radius,\
                 scale=1./args.mu_scale, min_ct_per_unit=args.min_ct_per_unit,\
                 sliding_step=args.n_move, major_axis=args.major_axis,\
-                xy_lattice=(not args.xy_median))
+                xy_lattice=(not args.xy_median), dtype=dtype)
 
     # Transform
     post_count = np.zeros((K, M))
@@ -0,0 +1,436 @@
+import os, io, struct, zlib, threading
+from collections import OrderedDict
+import numpy as np
+
+### BGZF (blocked gzip) output, tabix (.tbi) index construction, and
+### region queries through .tbi/.csi indexes without the tabix binary
+### https://samtools.github.io/hts-specs/SAMv1.pdf (section 4.1, 5.2)
+### https://samtools.github.io/hts-specs/tabix.pdf
+
+BGZF_BLOCK_SIZE = 0xff00 # Uncompressed bytes per block, as in htslib
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+TBX_MIN_SHIFT = 14
+TBX_META_BIN = 37450
+
+class BgzfWriter:
+    """
+    Every block but the last holds exactly BGZF_BLOCK_SIZE uncompressed
+    bytes, so the virtual offset of an uncompressed position u is
+    block_offset[u // BGZF_BLOCK_SIZE] << 16 | u % BGZF_BLOCK_SIZE
+    """
+    def __init__(self, path, compresslevel=6) -> None:
+        self.fh = open(path, 'wb')
+        self.compresslevel = compresslevel
+        self.buff = bytearray()
+        self.block_offset = [0] # Compressed offset of each block
+        self.n = 0 # Uncompressed bytes written
+
+    def _write_block(self, data):
+        c = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        cdata = c.compress(data) + c.flush()
+        bsize = len(cdata) + 25
+        self.fh.write(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize))
+        self.fh.write(cdata)
+        self.fh.write(struct.pack('<II', zlib.crc32(data), len(data)))
+        self.block_offset.append(self.block_offset[-1] + bsize + 1)
+
+    def write(self, data):
+        self.buff += data
+        self.n += len(data)
+        st = 0
+        while len(self.buff) - st >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self.buff[st:st+BGZF_BLOCK_SIZE]))
+            st += BGZF_BLOCK_SIZE
+        if st > 0:
+            del self.buff[:st]
+
+    def virtual_offset(self, u):
+        u = np.asarray(u, dtype=np.uint64)
+        k = u // BGZF_BLOCK_SIZE
+        return (np.asarray(self.block_offset, dtype=np.uint64)[k] << np.uint64(16)) | (u % BGZF_BLOCK_SIZE)
+
+    def close(self):
+        if len(self.buff) > 0:
+            self._write_block(bytes(self.buff))
+            self.buff = bytearray()
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+
+def reg2bin(beg, end):
+    """
+    Smallest bin containing [beg, end) (0-based), vectorized
+    """
+    beg = np.asarray(beg, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64) - 1
+    bins = np.zeros(beg.shape, dtype=np.int64)
+    done = np.zeros(beg.shape, dtype=bool)
+    for shift, offset in [(14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)]:
+        indx = ~done & ((beg >> shift) == (end >> shift))
+        bins[indx] = offset + (beg[indx] >> shift)
+        done |= indx
+    return bins
+
+class TabixIndex:
+    """
+    Build a tabix index for a coordinate sorted generic text file from
+    records added in file order, one reference at a time
+    """
+    def __init__(self, col_seq, col_beg, col_end, meta_char='#', skip=0, zero_based=False) -> None:
+        self.conf = (0x10000 if zero_based else 0, col_seq, col_beg, col_end, ord(meta_char), skip)
+        self.names = []
+        self.refs = {} # name -> list of (beg, end, u_start, u_end) arrays
+
+    def add(self, name, pos_beg, pos_end, u_start, u_end):
+        """
+        pos_beg, pos_end: values in the begin/end columns
+        u_start, u_end: uncompressed offsets of the start and end of each record
+        """
+        if name not in self.refs:
+            self.names.append(name)
+            self.refs[name] = []
+        beg = np.asarray(pos_beg, dtype=np.int64)
+        end = np.asarray(pos_end, dtype=np.int64)
+        if not self.conf[0] & 0x10000:
+            beg = beg - 1
+        beg = np.clip(beg, 0, None)
+        end = np.clip(end, 1, None)
+        self.refs[name].append((beg, end, np.asarray(u_start), np.asarray(u_end)))
+
+    def _ref_index(self, name, bgzf):
+        beg, end, ust, ued = [np.concatenate(x) for x in zip(*self.refs[name])]
+        vst = bgzf.virtual_offset(ust)
+        ved = bgzf.virtual_offset(ued)
+        out = bytearray()
+        # Bins, each run of consecutive records in the same bin is one chunk
+        bins = reg2bin(beg, end)
+        brk = np.concatenate([[0], np.where(bins[1:] != bins[:-1])[0] + 1, [len(bins)]])
+        chunks = {}
+        for s, e in zip(brk[:-1], brk[1:]):
+            chunks.setdefault(int(bins[s]), []).append((int(vst[s]), int(ved[e-1])))
+        chunks[TBX_META_BIN] = [(int(vst[0]), int(ved[-1])), (len(beg), 0)]
+        out += struct.pack('<i', len(chunks))
+        for b, v in chunks.items():
+            out += struct.pack('<Ii', b, len(v))
+            for x in v:
+                out += struct.pack('<QQ', *x)
+        # Linear index, smallest offset of records overlapping each 16kb window
+        n_intv = int(((end - 1) >> TBX_MIN_SHIFT).max()) + 1
+        ioff = np.full(n_intv, -1, dtype=np.int64)
+        w_st = beg >> TBX_MIN_SHIFT
+        w_ed = (end - 1) >> TBX_MIN_SHIFT
+        for w in range(int((w_ed - w_st).max()) + 1):
+            w_i = w_st + w
+            indx = np.where(w_i <= w_ed)[0]
+            # Records are in file order, keep the first one for each window
+            u, first = np.unique(w_i[indx], return_index=True)
+            unset = ioff[u] < 0
+            ioff[u[unset]] = vst[indx[first[unset]]].astype(np.int64)
+        last = int(vst[0])
+        for i in range(n_intv):
+            if ioff[i] < 0:
+                ioff[i] = last
+            last = ioff[i]
+        out += struct.pack('<i', n_intv)
+        out += ioff.astype('<u8').tobytes()
+        return bytes(out)
+
+    def write(self, path, bgzf):
+        """
+        bgzf: the (closed) BgzfWriter the indexed file was written with
+        """
+        names = b''.join([x.encode() + b'\0' for x in self.names])
+        out = bytearray(b'TBI\1')
+        out += struct.pack('<i', len(self.names))
+        out += struct.pack('<6i', *self.conf)
+        out += struct.pack('<i', len(names)) + names
+        for name in self.names:
+            out += self._ref_index(name, bgzf)
+        wf = BgzfWriter(path)
+        wf.write(bytes(out))
+        wf.close()
+
+def reg2bins(beg, end, min_shift=TBX_MIN_SHIFT, depth=5):
+    """
+    All bins overlapping [beg, end) (0-based)
+    """
+    end -= 1
+    bins = []
+    s, t = min_shift + depth * 3, 0
+    for l in range(depth + 1):
+        bins.extend(range(t + (beg >> s), t + (end >> s) + 1))
+        s -= 3
+        t += 1 << (l * 3)
+    return bins
+
+class BgzfBlockCache:
+    """
+    LRU cache of decompressed BGZF blocks, keyed by file and block offset
+    """
+    def __init__(self, max_bytes=256 * 2**20) -> None:
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()
+        self.n_bytes = 0
+        self.hit = 0
+        self.miss = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            v = self.blocks.get(key)
+            if v is None:
+                self.miss += 1
+                return None
+            self.hit += 1
+            self.blocks.move_to_end(key)
+            return v
+
+    def put(self, key, v):
+        with self.lock:
+            if key in self.blocks:
+                return
+            self.blocks[key] = v
+            self.n_bytes += len(v[0])
+            while self.n_bytes > self.max_bytes and len(self.blocks) > 1:
+                _, u = self.blocks.popitem(last=False)
+                self.n_bytes -= len(u[0])
+
+block_cache = BgzfBlockCache() # Shared by all readers by default
+
+class BgzfReader:
+
+    def __init__(self, path, cache=None) -> None:
+        self.path = path
+        st = os.stat(path)
+        self.key = (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+        self.cache = block_cache if cache is None else cache
+        self.fh = None
+
+    def block(self, coffset):
+        """
+        Decompressed data of the block at coffset and the offset of the next block
+        """
+        v = self.cache.get(self.key + (coffset,))
+        if v is not None:
+            return v
+        if self.fh is None:
+            self.fh = open(self.path, 'rb')
+        self.fh.seek(coffset)
+        head = self.fh.read(12)
+        if len(head) < 12:
+            return b'', coffset
+        assert head[:4] == b'\x1f\x8b\x08\x04', f"{self.path} is not BGZF compressed"
+        xlen = struct.unpack('<H', head[10:12])[0]
+        extra = self.fh.read(xlen)
+        bsize = None
+        i = 0
+        while i < xlen:
+            si, slen = extra[i:i+2], struct.unpack('<H', extra[i+2:i+4])[0]
+            if si == b'BC':
+                bsize = struct.unpack('<H', extra[i+4:i+6])[0] + 1
+            i += 4 + slen
+        assert bsize is not None, f"{self.path} is not BGZF compressed"
+        cdata = self.fh.read(bsize - 12 - xlen)
+        v = (zlib.decompress(cdata[:-8], -15), coffset + bsize)
+        self.cache.put(self.key + (coffset,), v)
+        return v
+
+    def read(self, vstart, vend):
+        """
+        Uncompressed bytes between two virtual offsets
+        """
+        coffset, uoffset = vstart >> 16, vstart & 0xffff
+        cend, uend = vend >> 16, vend & 0xffff
+        out = []
+        while coffset <= cend:
+            data, nxt = self.block(coffset)
+            if nxt == coffset: # End of file
+                break
+            out.append(data[uoffset:(uend if coffset == cend else len(data))])
+            coffset, uoffset = nxt, 0
+        return b''.join(out)
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+_index_cache = {}
+
+class TabixReader:
+    """
+    Region queries on a BGZF compressed, tabix (.tbi or .csi) indexed file
+    """
+    def __init__(self, path, cache=None) -> None:
+        self.bgzf = BgzfReader(path, cache)
+        if os.path.isfile(path + ".tbi"):
+            index_file = path + ".tbi"
+        elif os.path.isfile(path + ".csi"):
+            index_file = path + ".csi"
+        else:
+            raise FileNotFoundError(f"Cannot find the index of {path}")
+        key = (os.path.realpath(index_file), os.stat(index_file).st_mtime_ns)
+        if key not in _index_cache:
+            _index_cache[key] = self._load_index(index_file)
+        self.min_shift, self.depth, self.conf, self.names, self.index = _index_cache[key]
+        self.zero_based = bool(self.conf[0] & 0x10000)
+
+    def _load_index(self, index_file):
+        data = BgzfReader(index_file, BgzfBlockCache(0))
+        buff = []
+        coffset = 0
+        while True:
+            v, nxt = data.block(coffset)
+            if nxt == coffset:
+                break
+            buff.append(v)
+            coffset = nxt
+        data.close()
+        buff = b''.join(buff)
+        magic = buff[:4]
+        if magic == b'TBI\1':
+            min_shift, depth = TBX_MIN_SHIFT, 5
+            p = 4
+            n_ref = struct.unpack('<i', buff[p:p+4])[0]
+            p += 4
+            aux = buff[p:]
+        elif magic == b'CSI\1':
+            min_shift, depth, l_aux = struct.unpack('<3i', buff[4:16])
+            aux = buff[16:16+l_aux]
+            p = 16 + l_aux
+            n_ref = struct.unpack('<i', buff[p:p+4])[0]
+            p += 4
+        else:
+            raise ValueError(f"{index_file} is not a tabix index")
+        conf = struct.unpack('<6i', aux[:24])
+        l_nm = struct.unpack('<i', aux[24:28])[0]
+        names = [x.decode() for x in aux[28:28+l_nm].split(b'\0')[:-1]]
+        if magic == b'TBI\1':
+            p += 28 + l_nm
+        index = {}
+        for name in names[:n_ref]:
+            n_bin = struct.unpack('<i', buff[p:p+4])[0]
+            p += 4
+            bins = {}
+            for _ in range(n_bin):
+                if magic == b'TBI\1':
+                    b, n_chunk = struct.unpack('<Ii', buff[p:p+8])
+                    p += 8
+                    loff = None
+                else:
+                    b, loff, n_chunk = struct.unpack('<IQi', buff[p:p+16])
+                    p += 16
+                chunks = np.frombuffer(buff[p:p+16*n_chunk], dtype='<u8').reshape((-1, 2))
+                p += 16 * n_chunk
+                bins[b] = (loff, chunks)
+            ioff = None
+            if magic == b'TBI\1':
+                n_intv = struct.unpack('<i', buff[p:p+4])[0]
+                p += 4
+                ioff = np.frombuffer(buff[p:p+8*n_intv], dtype='<u8')
+                p += 8 * n_intv
+            meta_bin = ((1 << (3 * (depth + 1))) - 1) // 7 + 1
+            bins.pop(meta_bin, None)
+            index[name] = (bins, ioff)
+        return min_shift, depth, conf, names, index
+
+    def _min_offset(self, name, beg):
+        bins, ioff = self.index[name]
+        if ioff is not None:
+            if len(ioff) == 0:
+                return 0
+            return int(ioff[min(beg >> self.min_shift, len(ioff) - 1)])
+        # CSI, the loffset of the deepest existing bin containing beg
+        b = ((1 << (3 * self.depth)) - 1) // 7 + (beg >> self.min_shift)
+        while b > 0 and b not in bins:
+            b = (b - 1) >> 3
+        return bins[b][0] if b in bins else 0
+
+    def query_bytes(self, name, beg, end):
+        """
+        Raw lines in the chunks that may overlap [beg, end) (0-based) on name
+        """
+        if name not in self.index:
+            return b''
+        bins = self.index[name][0]
+        min_off = self._min_offset(name, beg)
+        chunks = [bins[b][1] for b in reg2bins(beg, end, self.min_shift, self.depth) if b in bins]
+        if len(chunks) == 0:
+            return b''
+        chunks = np.vstack(chunks)
+        chunks = chunks[chunks[:, 1] > min_off]
+        if chunks.shape[0] == 0:
+            return b''
+        chunks = chunks[np.argsort(chunks[:, 0], kind='stable')]
+        out = []
+        st, ed = int(chunks[0, 0]), int(chunks[0, 1])
+        for s, e in chunks[1:].tolist():
+            if s <= ed: # Overlapping or adjacent chunks
+                ed = max(ed, e)
+                continue
+            out.append(self.bgzf.read(max(st, min_off), ed))
+            st, ed = s, e
+        out.append(self.bgzf.read(max(st, min_off), ed))
+        return b''.join(out)
+
+    def _trim(self, data, beg, end):
+        """
+        Records are sorted by their begin position, drop those starting
+        after the region and, for single position records, those before it
+        """
+        nl = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+        st = np.concatenate([[0], nl[:-1] + 1])
+        c = self.conf[2] - 1
+        def pos(i):
+            v = int(float(data[st[i]:nl[i]].split(b'\t')[c]))
+            return max(v if self.zero_based else v - 1, 0)
+        def search(v):
+            lo, hi = 0, len(st)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if pos(mid) < v:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        i1 = search(end)
+        i0 = search(max(beg - 1, 0)) if self.conf[2] == self.conf[3] else 0
+        if i0 >= i1:
+            return b''
+        return data[st[i0]:nl[i1-1]+1]
+
+    def fetch_array(self, name, beg, end, ncol):
+        """
+        Records overlapping the 1-based closed region [beg, end] as a
+        float array (n x ncol), all columns have to be numeric
+        Returns None if the records can not be parsed as numbers
+        """
+        data = self.query_bytes(name, max(beg - 1, 0), end)
+        if len(data) > 0:
+            try:
+                data = self._trim(data, beg, end)
+            except ValueError:
+                return None
+        if len(data) == 0:
+            return np.zeros((0, ncol))
+        try:
+            mtx = np.loadtxt(io.BytesIO(data), delimiter='\t', ndmin=2)
+        except ValueError:
+            return None
+        if mtx.shape[1] != ncol:
+            return None
+        return mtx[self.overlap(mtx[:, self.conf[2] - 1], mtx[:, self.conf[3] - 1], beg, end)]
+
+    def overlap(self, rec_beg, rec_end, beg, end):
+        """
+        Mask of records (values in the begin/end columns) overlapping the
+        1-based closed region [beg, end], as tabix filters them
+        """
+        rec_beg = np.asarray(rec_beg)
+        if not self.zero_based:
+            rec_beg = rec_beg - 1
+        rec_beg = np.clip(rec_beg, 0, None)
+        rec_end = np.clip(np.asarray(rec_end), 1, None)
+        return (rec_beg < end) & (rec_end > max(beg - 1, 0))
+
+    def close(self):
+        self.bgzf.close()
@@ -13,15 +13,14 @@ def pixel_to_hex(pts, size, offset_x = 0, offset_y = 0):
     hex_frac /= size
     hex_frac[0,] += offset_x
     hex_frac[1,] += offset_y
-    rx = np.round(hex_frac[0,])
-    ry = np.round(hex_frac[1,])
-    hex_frac[0,] -= rx
-    hex_frac[1,] -= ry
+    r = np.round(hex_frac)
+    hex_frac -= r
     indx = np.abs(hex_frac[0,]) < np.abs(hex_frac[1,])
-    x = rx+np.round(hex_frac[0,]+0.5*hex_frac[1,])
-    y = ry
-    x[indx] = rx[indx]
-    y[indx] = ry[indx]+np.round(hex_frac[1,indx]+0.5*hex_frac[0,indx])
+    # Round along the axis with the larger residual
+    d = np.where(indx, hex_frac[1,]+0.5*hex_frac[0,], hex_frac[0,]+0.5*hex_frac[1,])
+    np.round(d, out=d)
+    x = r[0,] + np.where(indx, 0, d)
+    y = r[1,] + np.where(indx, d, 0)
     return x.astype(int), y.astype(int)
 
 def hex_to_pixel(x,y,size,offset_x=0,offset_y=0):
@@ -0,0 +1,57 @@
+import numpy as np
+import scipy.sparse
+from multiprocessing import shared_memory
+
+### Numpy arrays in shared memory, for process pools.
+### The parent creates (and unlinks) the buffers and passes their specs,
+### workers attach by name. Views must be dropped before a buffer is closed
+
+class SharedBuffer:
+
+    def __init__(self, nbytes):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(nbytes)))
+
+    def view(self, shape, dtype):
+        """An array on the buffer and the spec to attach to it from a worker"""
+        dtype = np.dtype(dtype)
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf), (self.shm.name, tuple(shape), dtype.str)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+def share_array(x):
+    """Copy x to a new shared buffer, return the buffer and the spec"""
+    x = np.ascontiguousarray(x)
+    buff = SharedBuffer(x.nbytes)
+    arr, spec = buff.view(x.shape, x.dtype)
+    arr[...] = x
+    return buff, spec
+
+def share_sparse(x):
+    """Share a CSR or CSC matrix, return the buffers and the spec"""
+    fmt = "csc" if scipy.sparse.isspmatrix_csc(x) or x.format == "csc" else "csr"
+    x = x.asformat(fmt)
+    res = [share_array(v) for v in [x.data, x.indices, x.indptr]]
+    return [b for b, _ in res], (fmt, x.shape) + tuple(s for _, s in res)
+
+_attached = {}
+
+def attach(spec):
+    name, shape, dtype = spec
+    if name not in _attached:
+        # Workers share the parent's resource tracker, the parent unlinks
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+
+def attach_sparse(spec):
+    fmt, shape = spec[:2]
+    data, indices, indptr = [attach(x) for x in spec[2:]]
+    if fmt == "csc":
+        return scipy.sparse.csc_matrix((data, indices, indptr), shape=shape)
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape)
+
+def detach(keep):
+    """Close attached buffers whose names are not in keep"""
+    for name in [x for x in _attached if x not in keep]:
+        _attached.pop(name).close()
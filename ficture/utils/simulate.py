@@ -0,0 +1,65 @@
+import numpy as np
+import scipy.sparse
+import sklearn.neighbors
+import sklearn.preprocessing
+
+from ficture.models.slda_minibatch import minibatch
+
+### Simulated pixel level minibatches, for the benchmarks in misc and the tests
+### Pixels lie in patches of constant factor, anchors on a square lattice
+
+def simulate_pixels(rng, K, M, width, n_pixel, anchor_dist, radius, ct=(1, 3), n_center=10, beta=None):
+    """
+    n_pixel pixels uniform in a width x width square, the factor of a pixel
+    is that of its closest center (n_center * K random centers), with ct[0]
+    to ct[1] transcripts drawn from the factor's gene distribution beta
+    (K x M, Dirichlet(.1) if not given). Anchors every anchor_dist, the
+    weight of a pixel-anchor pair within radius is 1 - d/radius clipped
+    to [.05, .95]. Returns a dict with beta, xy, label, mtx (N x M),
+    grid_pt (n x 2) and wij (N x n)
+    """
+    if beta is None:
+        beta = rng.dirichlet(np.ones(M) * .1, K)
+    xy = rng.uniform(0, width, (n_pixel, 2))
+    centers = rng.uniform(0, width, (K * n_center, 2))
+    label = sklearn.neighbors.NearestNeighbors(n_neighbors=1).fit(centers).kneighbors(xy, return_distance=False).reshape(-1) % K
+    r_indx = np.repeat(np.arange(n_pixel), rng.integers(ct[0], ct[1] + 1, n_pixel))
+    c_indx = np.zeros(len(r_indx), dtype=int)
+    k_indx = label[r_indx]
+    for k in range(K):
+        v = np.where(k_indx == k)[0]
+        c_indx[v] = rng.choice(M, len(v), p=beta[k])
+    mtx = scipy.sparse.coo_array((np.ones(len(r_indx)), (r_indx, c_indx)), shape=(n_pixel, M)).tocsr()
+    grid = np.arange(0, width + anchor_dist, anchor_dist)
+    grid_pt = np.array([[x, y] for x in grid for y in grid])
+    dist, indx = sklearn.neighbors.NearestNeighbors(radius=radius).fit(grid_pt).radius_neighbors(xy)
+    r = np.concatenate([[i] * len(v) for i, v in enumerate(indx)]).astype(int)
+    c = np.concatenate(indx).astype(int)
+    w = np.clip(1 - np.concatenate(dist) / radius, .05, .95)
+    wij = scipy.sparse.csr_matrix((w, (r, c)), shape=(n_pixel, len(grid_pt)))
+    return {'beta':beta, 'xy':xy, 'label':label, 'mtx':mtx, 'grid_pt':grid_pt, 'wij':wij}
+
+def anchor_theta(sim, rng, noise=None):
+    """
+    Initial theta of the anchors: random (Dirichlet(1)) if noise is None,
+    otherwise as from transform, the factor composition of the pixels around
+    each anchor with weight 1 - noise plus a random part with weight noise
+    """
+    K = sim['beta'].shape[0]
+    n = sim['grid_pt'].shape[0]
+    if noise is None:
+        return rng.dirichlet(np.ones(K), n)
+    N = sim['mtx'].shape[0]
+    theta = np.asarray(sim['wij'].T @ scipy.sparse.csr_matrix((np.ones(N), (np.arange(N), sim['label'])), shape=(N, K)).toarray())
+    theta = sklearn.preprocessing.normalize(theta, norm='l1', axis=1) * (1 - noise)
+    theta += rng.dirichlet(np.ones(K), n) * noise
+    return theta
+
+def make_batch(sim, theta, dtype=np.float64, anchor_adj=None):
+    """A minibatch of the simulated pixels with psi initialized from the weights"""
+    wij = sim['wij'].astype(dtype)
+    batch = minibatch()
+    batch.init_from_matrix(sim['mtx'].astype(dtype), sim['grid_pt'], wij,\
+        psi = sklearn.preprocessing.normalize(wij, norm='l1', axis=1),\
+        m_gamma = np.array(theta, dtype=dtype), anchor_adj = anchor_adj)
+    return batch
@@ -0,0 +1,89 @@
+import numpy as np
+
+### Bucketed spatial index over 2D points
+### Points are sorted by (column, row) of square cells, so the points in
+### consecutive cells of one column form a contiguous range
+
+class GridIndex:
+
+    def __init__(self, xy, cell) -> None:
+        self.xy = np.asarray(xy, dtype=float).reshape((-1, 2))
+        self.cell = cell
+        self.n = self.xy.shape[0]
+        self.lo = self.xy.min(axis = 0) if self.n > 0 else np.zeros(2)
+        ij = ((self.xy - self.lo) // self.cell).astype(np.int64)
+        self.nx, self.ny = ij.max(axis = 0) + 1 if self.n > 0 else (0, 0)
+        cid = ij[:, 0] * self.ny + ij[:, 1]
+        self.order = np.argsort(cid, kind='stable')
+        self.cid = cid[self.order]
+        self.sxy = self.xy[self.order] # Points in cell order
+
+    def _cell_range(self, v_min, v_max, axis, n):
+        st = max(0, int((v_min - self.lo[axis]) // self.cell))
+        ed = min(n - 1, int((v_max - self.lo[axis]) // self.cell))
+        return st, ed
+
+    def query_box(self, x_min, x_max, y_min, y_max):
+        """
+        Indices (ascending) of points with x_min <= x <= x_max and y_min <= y <= y_max
+        """
+        ix0, ix1 = self._cell_range(x_min, x_max, 0, self.nx)
+        iy0, iy1 = self._cell_range(y_min, y_max, 1, self.ny)
+        if ix0 > ix1 or iy0 > iy1:
+            return np.array([], dtype=int)
+        ix = np.arange(ix0, ix1 + 1)
+        st = np.searchsorted(self.cid, ix * self.ny + iy0, side='left')
+        ed = np.searchsorted(self.cid, ix * self.ny + iy1, side='right')
+        indx = np.concatenate([self.order[s:e] for s, e in zip(st, ed)])
+        xy = self.xy[indx, :]
+        indx = indx[(xy[:, 0] >= x_min) & (xy[:, 0] <= x_max) &\
+                    (xy[:, 1] >= y_min) & (xy[:, 1] <= y_max)]
+        return np.sort(indx)
+
+    def query_radius(self, pts, r, block_size=4096):
+        """
+        All pairs (i, j, d) of query point pts[i] and indexed point j at
+        (euclidean) distance d <= r, ordered by j then i. Queries are
+        processed in blocks of block_size points
+        """
+        pts = np.asarray(pts, dtype=float).reshape((-1, 2))
+        res_i, res_j, res_d = [np.array([], dtype=int)], [np.array([], dtype=int)], [np.array([], dtype=float)]
+        if self.n > 0:
+            # A query scans at most span columns, in each the cells overlapped
+            # by the chord of the disc form a contiguous range
+            span = int(2 * r // self.cell) + 2
+            for st in range(0, pts.shape[0], block_size):
+                q = pts[st:st+block_size]
+                ix0 = (q[:, 0] - r - self.lo[0]) // self.cell
+                ix1 = np.minimum((q[:, 0] + r - self.lo[0]) // self.cell, self.nx - 1)
+                ix = ix0.astype(np.int64).reshape((-1, 1)) + np.arange(span)
+                qi, k = np.nonzero((ix >= 0) & (ix <= ix1.reshape((-1, 1))))
+                ix = ix[qi, k]
+                # Half chord at the nearest edge of the column, with a margin
+                # for rounding (candidates are checked by distance below)
+                tol = 1e-6 * self.cell
+                x0 = self.lo[0] + ix * self.cell
+                dx = np.maximum(np.maximum(x0 - q[qi, 0], q[qi, 0] - x0 - self.cell) - tol, 0)
+                h = np.sqrt(np.maximum(r * r - dx * dx, 0)) + tol
+                iy0 = np.maximum((q[qi, 1] - h - self.lo[1]) // self.cell, 0).astype(np.int64)
+                iy1 = np.minimum((q[qi, 1] + h - self.lo[1]) // self.cell, self.ny - 1).astype(np.int64)
+                s = np.searchsorted(self.cid, ix * self.ny + iy0, side='left')
+                e = np.searchsorted(self.cid, ix * self.ny + iy1, side='right')
+                e[iy0 > iy1] = s[iy0 > iy1]
+                cnt = e - s
+                tot = cnt.sum()
+                if tot == 0:
+                    continue
+                qi = np.repeat(qi, cnt)
+                pos = np.arange(tot) - np.repeat(np.cumsum(cnt) - cnt - s, cnt)
+                # Same arithmetic as sklearn's BallTree.query_radius
+                dx = q[qi, 0] - self.sxy[pos, 0]
+                dy = q[qi, 1] - self.sxy[pos, 1]
+                d = dx * dx + dy * dy
+                kept = d <= r * r
+                res_i.append(qi[kept] + st)
+                res_j.append(self.order[pos[kept]])
+                res_d.append(np.sqrt(d[kept]))
+        i, j, d = [np.concatenate(x) for x in [res_i, res_j, res_d]]
+        o = np.argsort(j * pts.shape[0] + i)
+        return i[o], j[o], d[o]
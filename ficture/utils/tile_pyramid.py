@@ -0,0 +1,170 @@
+import os, logging
+import numpy as np
+import cv2
+
+### Write a large image as a multi-resolution tile pyramid (DeepZoom or XYZ)
+### Pixels are streamed in, level 0 (full resolution) tiles are written
+### once the caller marks them complete, and each downsampled tile is built
+### from its (up to) four finer tiles as soon as they are all written, so
+### only tiles near the streaming front are held in memory
+
+def downsample(a):
+    """
+    Halve an image by averaging 2x2 pixels, an odd last row/column is averaged with itself
+    """
+    h, w = a.shape[:2]
+    a = np.pad(a, ((0, h % 2), (0, w % 2), (0, 0)), mode='edge').astype(np.uint16)
+    a = (a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2] + 2) // 4
+    return a.astype(np.uint8)
+
+class TilePyramidWriter:
+
+    def __init__(self, output, width, height, tile_size=256, tile_format='deepzoom', background=(0, 0, 0), ext='png') -> None:
+        """
+        output: prefix of the DeepZoom output (output.dzi, output_files/) or the XYZ directory
+        background: BGR
+        """
+        assert tile_size % 2 == 0, "Tile size has to be even"
+        self.output = output
+        self.tile_format = tile_format
+        self.ts = tile_size
+        self.ext = ext
+        self.background = np.array(background, dtype=np.uint8)
+        self.dims = [(width, height)] # Image size at each level, 0 is full resolution
+        while True:
+            w, h = self.dims[-1]
+            if (tile_format == 'xyz' and w <= tile_size and h <= tile_size) or (w == 1 and h == 1):
+                break
+            self.dims.append(((w + 1) // 2, (h + 1) // 2))
+        self.grid = [((w + tile_size - 1) // tile_size, (h + tile_size - 1) // tile_size) for w, h in self.dims]
+        self.tiles = {}  # (level, tx, ty) -> array, tiles being filled
+        self.n_child = {} # (level, tx, ty) -> number of finer tiles received
+        self.next_row = np.zeros(self.grid[0][0], dtype=int) # Per tile column, first tile not written
+        self.next_col = np.zeros(self.grid[0][1], dtype=int)
+        self.n_written = 0
+        self.n_late = 0
+        if tile_format == 'deepzoom':
+            os.makedirs(output + "_files", exist_ok=True)
+            with open(output + ".dzi", 'w') as wf:
+                wf.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{ext}" Overlap="0" TileSize="{tile_size}">\n<Size Width="{width}" Height="{height}"/>\n</Image>\n')
+        else:
+            os.makedirs(output, exist_ok=True)
+
+    def _tile_shape(self, level, tx, ty):
+        w, h = self.dims[level]
+        return min(self.ts, h - ty * self.ts), min(self.ts, w - tx * self.ts)
+
+    def _get(self, level, tx, ty):
+        key = (level, tx, ty)
+        if key not in self.tiles:
+            self.tiles[key] = np.empty(self._tile_shape(level, tx, ty) + (3,), dtype=np.uint8)
+            self.tiles[key][:, :] = self.background
+        return self.tiles[key]
+
+    def _is_written(self, tx, ty):
+        return ty < self.next_row[tx] or tx < self.next_col[ty]
+
+    def write(self, x, y, bgr):
+        """
+        x, y: pixel coordinates (column, row) at full resolution, bgr: n x 3 uint8
+        Later writes to the same pixel overwrite earlier ones
+        """
+        if len(x) == 0:
+            return
+        tx, ty = x // self.ts, y // self.ts
+        tid = tx * self.grid[0][1] + ty
+        order = np.argsort(tid, kind='stable')
+        tid = tid[order]
+        brk = np.concatenate([[0], np.where(tid[1:] != tid[:-1])[0] + 1, [len(tid)]])
+        for s, e in zip(brk[:-1], brk[1:]):
+            indx = order[s:e]
+            i, j = tx[indx[0]], ty[indx[0]]
+            if self._is_written(i, j):
+                self.n_late += e - s
+                continue
+            tile = self._get(0, i, j)
+            tile[y[indx] - j * self.ts, x[indx] - i * self.ts] = bgr[indx]
+
+    def _save(self, level, tx, ty, tile):
+        if self.tile_format == 'deepzoom':
+            path = os.path.join(self.output + "_files", str(len(self.dims) - 1 - level))
+            os.makedirs(path, exist_ok=True)
+            path = os.path.join(path, f"{tx}_{ty}.{self.ext}")
+        else:
+            if tile.shape[0] < self.ts or tile.shape[1] < self.ts:
+                pad = np.empty((self.ts, self.ts, 3), dtype=np.uint8)
+                pad[:, :] = self.background
+                pad[:tile.shape[0], :tile.shape[1]] = tile
+                tile = pad
+            path = os.path.join(self.output, str(len(self.dims) - 1 - level), str(tx))
+            os.makedirs(path, exist_ok=True)
+            path = os.path.join(path, f"{ty}.{self.ext}")
+        cv2.imwrite(path, tile)
+        self.n_written += 1
+
+    def _finish(self, level, tx, ty):
+        tile = self.tiles.pop((level, tx, ty), None)
+        if tile is None:
+            tile = self._get(level, tx, ty)
+            del self.tiles[(level, tx, ty)]
+        self._save(level, tx, ty, tile)
+        if level + 1 == len(self.dims):
+            return
+        # Pass the downsampled tile to its parent
+        px, py = tx // 2, ty // 2
+        parent = self._get(level + 1, px, py)
+        h = self.ts // 2
+        d = downsample(tile)
+        parent[(ty % 2) * h:(ty % 2) * h + d.shape[0], (tx % 2) * h:(tx % 2) * h + d.shape[1]] = d
+        key = (level + 1, px, py)
+        self.n_child[key] = self.n_child.get(key, 0) + 1
+        nx, ny = self.grid[level]
+        if self.n_child[key] == min(2, nx - 2 * px) * min(2, ny - 2 * py):
+            del self.n_child[key]
+            self._finish(level + 1, px, py)
+
+    def complete(self, col_done, col_current, row_done):
+        """
+        Mark pixels as final: all columns < col_done, and rows < row_done
+        of columns < col_current (swap the arguments as rows/columns for
+        input streamed along the other axis, see complete_rows)
+        """
+        nx, ny = self.grid[0]
+        for tx in range(nx):
+            c_end = min((tx + 1) * self.ts, self.dims[0][0])
+            if c_end <= col_done:
+                r = ny
+            elif c_end <= col_current:
+                r = min(row_done // self.ts, ny)
+                if row_done >= self.dims[0][1]:
+                    r = ny
+            else:
+                break
+            for ty in range(self.next_row[tx], r):
+                if tx >= self.next_col[ty]:
+                    self._finish(0, tx, ty)
+            self.next_row[tx] = max(self.next_row[tx], r)
+
+    def complete_rows(self, row_done, row_current, col_done):
+        ny, nx = self.grid[0][1], self.grid[0][0]
+        for ty in range(ny):
+            r_end = min((ty + 1) * self.ts, self.dims[0][1])
+            if r_end <= row_done:
+                c = nx
+            elif r_end <= row_current:
+                c = min(col_done // self.ts, nx)
+                if col_done >= self.dims[0][0]:
+                    c = nx
+            else:
+                break
+            for tx in range(self.next_col[ty], c):
+                if ty >= self.next_row[tx]:
+                    self._finish(0, tx, ty)
+            self.next_col[ty] = max(self.next_col[ty], c)
+
+    def close(self):
+        self.complete(self.dims[0][0], self.dims[0][0], self.dims[0][1])
+        assert len(self.tiles) == 0, "Not all tiles are written"
+        if self.n_late > 0:
+            logging.warning(f"{self.n_late} pixels arrived after their tile was written and are ignored, is the input sorted?")
+        logging.info(f"Wrote {self.n_written} tiles in {len(self.dims)} levels")
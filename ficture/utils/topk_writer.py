@@ -0,0 +1,206 @@
+import os, gzip, heapq, itertools, shutil, tempfile, logging
+import numpy as np
+from scipy.sparse import issparse
+
+from ficture.utils.bgzf import BgzfWriter, TabixIndex
+
+### Stream decoding results (pixel or anchor level) to a gzipped tsv
+### directly from numpy arrays, optionally keeping only the top k factors
+
+def topk_factor(prob, k):
+    """
+    Indices and values of the k largest entries in each row, in decreasing order
+    prob can be a sparse matrix (only rows with less than k stored entries are densified)
+    """
+    if issparse(prob):
+        return _topk_factor_sparse(prob.tocsr(), k)
+    partial_indices = np.argpartition(prob, -k, axis=1)[:, -k:]
+    sorted_top_indices = np.argsort(np.take_along_axis(prob, partial_indices, axis=1), axis=1)[:, ::-1]
+    top_indices = np.take_along_axis(partial_indices, sorted_top_indices, axis=1)
+    top_values = np.take_along_axis(prob, top_indices, axis=1)
+    return top_indices, top_values
+
+def _topk_factor_sparse(prob, k):
+    n = prob.shape[0]
+    nnz = np.diff(prob.indptr)
+    r = np.repeat(np.arange(n), nnz)
+    o = np.lexsort((-prob.data, r)) # By row, decreasing values within each row
+    rank = np.arange(len(o)) - prob.indptr[r]
+    keep = rank < k
+    top_indices = np.zeros((n, k), dtype=prob.indices.dtype)
+    top_values = np.zeros((n, k), dtype=prob.data.dtype)
+    top_indices[r[keep], rank[keep]] = prob.indices[o[keep]]
+    top_values[r[keep], rank[keep]] = prob.data[o[keep]]
+    short = np.where(nnz < k)[0]
+    if len(short) > 0:
+        top_indices[short], top_values[short] = topk_factor(prob[short].toarray(), k)
+    return top_indices, top_values
+
+class TopkWriter:
+
+    def __init__(self, path, id_header, factor_header, extra_header=[], topk=-1, id_from_xy=False, compresslevel=9) -> None:
+        """
+        id_from_xy: the identifier of each row is label_{int(X*100)}_{int(Y*100)}
+        """
+        self.K = len(factor_header)
+        self.topk = topk if topk > 0 and topk <= self.K else 0
+        self.id_from_xy = id_from_xy
+        self.n_extra = len(extra_header)
+        header = [id_header, 'X', 'Y'] + list(extra_header)
+        if self.topk > 0:
+            header += [f"K{k+1}" for k in range(self.topk)] + [f"P{k+1}" for k in range(self.topk)]
+        else:
+            header += list(factor_header)
+        self.fmt = '\t%.2f\t%.2f' + '\t%.2e' * self.n_extra
+        if self.topk > 0:
+            self.fmt += '\t%d' * self.topk + '\t%.2e' * self.topk + '\n'
+        else:
+            self.fmt += '\t%.2e' * self.K + '\n'
+        self.wf = gzip.open(path, 'wt', compresslevel=compresslevel)
+        self.wf.write('\t'.join(header) + '\n')
+        self.n = 0
+
+    def write(self, label, xy, prob, extra=[]):
+        """
+        label: a scalar or one label per row
+        xy: n x 2, prob: n x K (dense or sparse), extra: list of length n arrays
+        """
+        n = xy.shape[0]
+        if n == 0:
+            return 0
+        cols = [xy[:, 0].tolist(), xy[:, 1].tolist()] + [np.asarray(v).tolist() for v in extra]
+        if self.topk > 0:
+            top_indices, top_values = topk_factor(prob, self.topk)
+            cols += top_indices.T.tolist() + np.clip(top_values, 0, 1).T.tolist()
+        else:
+            cols += (prob.toarray() if issparse(prob) else prob).T.tolist()
+        fmt = self.fmt
+        if np.isscalar(label):
+            fmt = str(label).replace('%', '%%') + ('_%d_%d' if self.id_from_xy else '') + fmt
+        else:
+            cols = [np.asarray(label).tolist()] + cols
+            fmt = '%s' + ('_%d_%d' if self.id_from_xy else '') + fmt
+        if self.id_from_xy:
+            i = 0 if np.isscalar(label) else 1
+            cols = cols[:i] + [(xy[:, 0]*100).astype(int).tolist(), (xy[:, 1]*100).astype(int).tolist()] + cols[i:]
+        self.wf.write(''.join(map(fmt.__mod__, zip(*cols))))
+        self.n += n
+        return n
+
+    def close(self):
+        self.wf.close()
+
+class BlockSortedWriter:
+    """
+    Write pixel level results as the block indexed, sorted, BGZF compressed
+    file (with its tabix index) read by BlockIndexedLoader
+    Rows are bucketed into blocks along X, buffered rows are sorted by
+    (Y, line) and spilled as runs to per-block temporary files, at the end
+    the runs of each block are merged (external k-way merge)
+    The output is identical to sorting the plain output by -k1,1g -k3,3g
+    """
+    def __init__(self, path, factor_header, topk=-1, offset_x=0, offset_y=0, size_x=0, size_y=0, block_size=2000, scale=100, K=None, buffer_size=1000000, tmpdir=None, compresslevel=6) -> None:
+        self.path = path
+        self.K = len(factor_header)
+        self.topk = topk if topk > 0 and topk <= self.K else 0
+        self.offset_x = float(offset_x) # May be given as text, kept as is in the header
+        self.offset_y = float(offset_y)
+        self.block_size = block_size
+        self.scale = scale
+        self.buffer_size = buffer_size
+        self.compresslevel = compresslevel
+        self.meta = [f"##K={self.K if K is None else K};TOPK={self.topk}",\
+                     f"##BLOCK_SIZE={block_size};BLOCK_AXIS=X;INDEX_AXIS=Y",\
+                     f"##OFFSET_X={offset_x};OFFSET_Y={offset_y};SIZE_X={size_x};SIZE_Y={size_y};SCALE={scale}"]
+        header = ['BLOCK', 'X', 'Y']
+        # The sort key (zero padded Y) is prefixed to each line until output
+        self.fmt = '%010d\t%d\t%d\t%d'
+        if self.topk > 0:
+            header += [f"K{k+1}" for k in range(self.topk)] + [f"P{k+1}" for k in range(self.topk)]
+            self.fmt += '\t%d' * self.topk + '\t%.2e' * self.topk + '\n'
+        else:
+            header += list(factor_header)
+            self.fmt += '\t%.2e' * self.K + '\n'
+        self.meta.append('#' + '\t'.join(header))
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(path) + ".", dir=tmpdir if tmpdir is not None else os.path.dirname(os.path.abspath(path)))
+        self.buff = {}
+        self.n_buff = 0
+        self.runs = {} # Block -> list of (start, end) byte offsets in its temporary file
+        self.fh = {}
+        self.n = 0
+
+    def write(self, xy, prob):
+        """
+        xy: n x 2 (um), prob: n x K (dense or sparse)
+        """
+        n = xy.shape[0]
+        if n == 0:
+            return 0
+        # Start from the coordinates as they appear in the plain output
+        x = np.char.mod('%.2f', xy[:, 0]).astype(float) - self.offset_x
+        y = np.char.mod('%.2f', xy[:, 1]).astype(float) - self.offset_y
+        blocks = (x / self.block_size).astype(int) * self.block_size
+        xs = np.clip((x * self.scale).astype(int), 0, None)
+        ys = np.clip((y * self.scale).astype(int), 0, None)
+        cols = [ys.tolist(), blocks.tolist(), xs.tolist(), ys.tolist()]
+        if self.topk > 0:
+            top_indices, top_values = topk_factor(prob, self.topk)
+            cols += top_indices.T.tolist() + np.clip(top_values, 0, 1).T.tolist()
+        else:
+            cols += (prob.toarray() if issparse(prob) else prob).T.tolist()
+        lines = list(map(self.fmt.__mod__, zip(*cols)))
+        for b in np.unique(blocks):
+            indx = np.where(blocks == b)[0]
+            self.buff.setdefault(int(b), []).extend([lines[i] for i in indx])
+        self.n_buff += n
+        self.n += n
+        if self.n_buff >= self.buffer_size:
+            self._spill()
+        return n
+
+    def _spill(self):
+        for b, lines in self.buff.items():
+            if b not in self.fh:
+                self.fh[b] = open(os.path.join(self.tmpdir, f"block_{b}.tsv"), 'wb')
+                self.runs[b] = []
+            st = self.fh[b].tell()
+            lines.sort()
+            self.fh[b].write(''.join(lines).encode())
+            self.runs[b].append((st, self.fh[b].tell()))
+        self.buff = {}
+        self.n_buff = 0
+
+    def _read_run(self, b, st, ed):
+        with open(os.path.join(self.tmpdir, f"block_{b}.tsv"), 'rb') as rf:
+            rf.seek(st)
+            n = ed - st
+            while n > 0:
+                line = rf.readline()
+                n -= len(line)
+                yield line
+
+    def close(self, batch_size=65536):
+        self._spill()
+        for f in self.fh.values():
+            f.close()
+        bgzf = BgzfWriter(self.path, compresslevel=self.compresslevel)
+        index = TabixIndex(col_seq=1, col_beg=3, col_end=3, meta_char='#')
+        bgzf.write(('\n'.join(self.meta) + '\n').encode())
+        for b in sorted(self.runs.keys()):
+            runs = [self._read_run(b, st, ed) for st, ed in self.runs[b]]
+            lines = runs[0] if len(runs) == 1 else heapq.merge(*runs)
+            while True:
+                batch = list(itertools.islice(lines, batch_size))
+                if len(batch) == 0:
+                    break
+                pos = [int(x[:10]) for x in batch]
+                batch = [x[11:] for x in batch]
+                u_end = bgzf.n + np.cumsum(np.fromiter(map(len, batch), dtype=np.int64, count=len(batch)))
+                u_start = np.concatenate([[bgzf.n], u_end[:-1]])
+                bgzf.write(b''.join(batch))
+                index.add(str(b), pos, pos, u_start, u_end)
+        bgzf.close()
+        if len(index.names) > 0:
+            index.write(self.path + ".tbi", bgzf)
+        shutil.rmtree(self.tmpdir)
+        logging.info(f"Wrote {self.n} sorted rows in {len(self.runs)} blocks to {self.path}")
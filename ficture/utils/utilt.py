@@ -21,6 +21,8 @@ from sklearn.decomposition._online_lda_fast import (
     _dirichlet_expectation_1d, _dirichlet_expectation_2d,
 )
 
+from ficture.loaders.columnar_store import is_columnar, ColumnarReader
+
 def dirichlet_expectation(alpha):
     """
     For a vector theta ~ Dir(alpha), computes E[log(theta)] given alpha.
@@ -360,25 +362,100 @@ def read_ct_from_solo_barcodes_tsv(file, key, chunksize=500000, mu_scale=-1):
         chunk[key]=chunk[key].map(lambda x : x.split(',')[ct_idx]).astype(int)
         yield chunk
 
-def make_mtx_from_dge(file, min_ct_per_feature = 50, min_ct_per_unit = 100, feature_white_list = None, feature_list = None, unit = "random_index", key = "gn", epoch=1, epoch_id_length=2, return_df = False, feature_list_force = False):
-    df = pd.DataFrame()
+class GrowableArray:
+    """
+    Typed 1D array appended to chunk by chunk, the capacity doubles when full
+    """
+    def __init__(self, dtype, capacity=1<<16):
+        self.arr = np.empty(capacity, dtype=dtype)
+        self.n = 0
+
+    def append(self, x):
+        if self.n + len(x) > len(self.arr):
+            arr = np.empty(max(2 * len(self.arr), self.n + len(x)), dtype=self.arr.dtype)
+            arr[:self.n] = self.arr[:self.n]
+            self.arr = arr
+        self.arr[self.n:self.n+len(x)] = x
+        self.n += len(x)
+
+    def values(self):
+        return self.arr[:self.n]
+
+def _encode(values, code_dict):
+    """Integer code of each value, new values are added to code_dict"""
+    code, uniq = pd.factorize(values)
+    idx = np.array([code_dict.setdefault(x, len(code_dict)) for x in uniq], dtype=np.int64)
+    return idx[code]
+
+def make_mtx_from_dge(file, min_ct_per_feature = 50, min_ct_per_unit = 100, feature_white_list = None, feature_list = None, unit = "random_index", key = "gn", epoch=1, epoch_id_length=2, return_df = False, feature_list_force = False, dtype = None):
+    """
+    Read units of the first epoch(s) of a DGE into a unit x feature CSR matrix.
+    Chunks are encoded to integer (unit, gene, count) triplets as they are read,
+    the feature and unit thresholds are applied to the counts afterwards.
+    Coordinates of a unit are those of its first line (make_dge writes the
+    hexagon center on every line)
+    """
     epoch_id_list = set()
-    for chunk in pd.read_csv(file, sep='\t', usecols = [unit,'X','Y','gene',key], dtype={unit:str}, chunksize=500000):
-        unit_list = chunk[unit].str[:epoch_id_length].unique()
+    unit_dict, gene_dict, epoch_dict = {}, {}, {}
+    row, col = GrowableArray(np.int32), GrowableArray(np.int32)
+    val = None
+    unit_epoch, unit_x, unit_y = GrowableArray(np.int32), GrowableArray(np.float64), GrowableArray(np.float64)
+    if return_df:
+        line_x, line_y = GrowableArray(np.float64), GrowableArray(np.float64)
+    if is_columnar(file):
+        reader = ColumnarReader(file, chunksize=500000, usecols = [unit,'X','Y','gene',key], categorical=False)
+    else:
+        reader = pd.read_csv(file, sep='\t', usecols = [unit,'X','Y','gene',key], dtype={unit:str}, chunksize=500000)
+    for chunk in reader:
+        u_code, u_uniq = pd.factorize(chunk[unit].values)
+        lab = [x[:epoch_id_length] for x in u_uniq]
+        unit_list = list(dict.fromkeys(lab))
         i = 0
         while len(epoch_id_list) < epoch and i < len(unit_list):
             epoch_id_list.add(unit_list[i])
             i += 1
-        if len(epoch_id_list) >= epoch and unit_list[-1] not in epoch_id_list:
-            pat = '^' + '|'.join(list(epoch_id_list))
-            df = pd.concat([df, chunk[chunk[unit].str.contains(pat) & chunk[key].ge(1)] ])
+        done = len(epoch_id_list) >= epoch and unit_list[-1] not in epoch_id_list
+        kept = chunk[key].values >= 1
+        if done:
+            kept &= np.array([x in epoch_id_list for x in lab])[u_code]
+        if kept.any():
+            ct = chunk[key].values[kept]
+            if val is None:
+                val = GrowableArray(ct.dtype)
+                unit_dtype, gene_dtype = chunk[unit].dtype, chunk['gene'].dtype
+            n_unit = len(unit_dict)
+            j = _encode(chunk[unit].values[kept], unit_dict)
+            if len(unit_dict) > n_unit:
+                # First line of each new unit
+                first = np.unique(j, return_index=True)[1]
+                first = first[j[first] >= n_unit]
+                for x in chunk[unit].values[kept][first]:
+                    unit_epoch.append([epoch_dict.setdefault(x[:epoch_id_length], len(epoch_dict))])
+                unit_x.append(chunk.X.values[kept][first])
+                unit_y.append(chunk.Y.values[kept][first])
+            g = _encode(chunk.gene.values[kept], gene_dict)
+            row.append(j)
+            col.append(g)
+            val.append(ct)
+            if return_df:
+                line_x.append(chunk.X.values[kept])
+                line_y.append(chunk.Y.values[kept])
+        if done:
             break
-        df = pd.concat([df, chunk[chunk[key].ge(1)] ])
-    epoch0 = df[unit].iloc[0][:epoch_id_length]
-    one_pass = df[unit].str[:epoch_id_length].eq(epoch0)
+    row, col, val = row.values(), col.values(), val.values()
+    unit_epoch = unit_epoch.values()
+    gene_name = np.array(list(gene_dict.keys()), dtype=object)
+    unit_name = np.array(list(unit_dict.keys()), dtype=object)
+
+    # Feature counts in the first epoch
+    one_pass = unit_epoch[row] == unit_epoch[0]
+    gene_ct = np.bincount(col[one_pass], weights=val[one_pass], minlength=len(gene_name))
+    gene_ln = np.bincount(col[one_pass], minlength=len(gene_name))
+    indx = np.flatnonzero(gene_ln > 0)
+    indx = indx[np.argsort(gene_name[indx], kind='stable')]
+    ct = pd.DataFrame({"gene": pd.array(gene_name[indx], dtype=gene_dtype), key: gene_ct[indx].astype(val.dtype)})
     if feature_list is not None:
         feature = pd.DataFrame({"gene": feature_list})
-        ct = df[one_pass].groupby(by=['gene']).agg({key:"sum"}).reset_index()
         if feature_list_force is False:
             ct.drop(index = ct[ct[key].lt(min_ct_per_feature)].index, inplace=True)
             feature = feature.merge(right = ct, on = 'gene', how = 'inner')
@@ -386,32 +463,45 @@ def make_mtx_from_dge(file, min_ct_per_feature = 50, min_ct_per_unit = 100, feat
             feature = feature.merge(right = ct, on = 'gene', how = 'left')
             feature.fillna(0, inplace=True)
     else:
-        feature = df[one_pass].groupby(by=['gene']).agg({key:"sum"}).reset_index()
+        feature = ct
         feature_white_list = set() if feature_white_list is None else set(feature_white_list)
         feature = feature.loc[feature[key].ge(min_ct_per_feature ) | feature.gene.isin(feature_white_list), :]
     M = len(feature)
     feature.index = np.arange(M)
     ft_dict = {x:i for i,x in enumerate(feature.gene)}
-    df.drop(index = df.index[~df.gene.isin(ft_dict)], inplace=True)
-
-    brc = df.groupby(by = unit).agg({key:"sum"}).reset_index()
-    brc.drop(index = brc.index[brc[key].lt(min_ct_per_unit)], inplace=True)
-    N = brc.shape[0]
-    brc.index = np.arange(N)
+    gene_map = np.full(len(gene_name), -1, dtype=np.int32)
+    for x, i in ft_dict.items():
+        if x in gene_dict:
+            gene_map[gene_dict[x]] = i
+    col = gene_map[col]
+    kept = col >= 0
+
+    # Unit counts over the kept features, units are ordered by id
+    unit_ct = np.bincount(row[kept], weights=val[kept], minlength=len(unit_name))
+    unit_ln = np.bincount(row[kept], minlength=len(unit_name))
+    indx = np.flatnonzero((unit_ln > 0) & (unit_ct >= min_ct_per_unit))
+    indx = indx[np.argsort(unit_name[indx], kind='stable')]
+    N = len(indx)
+    brc = pd.DataFrame({unit: pd.array(unit_name[indx], dtype=unit_dtype), key: unit_ct[indx].astype(val.dtype)})
     bc_dict = {x:i for i,x in enumerate(brc[unit])}
-    brc['j'] = brc[unit].map(bc_dict)
-    df.drop(index = df.index[~df[unit].isin(bc_dict)], inplace=True)
-    df['j'] = df[unit].map(bc_dict)
+    brc['j'] = np.arange(N)
     brc["epoch"] = brc[unit].str[:epoch_id_length]
-    df.drop(columns = unit, inplace=True)
-    brc = brc.merge(right = df[['j','X','Y' ]].drop_duplicates(subset='j'), on = 'j', how = 'left')
+    brc['X'] = unit_x.values()[indx]
+    brc['Y'] = unit_y.values()[indx]
+    rank = np.full(len(unit_name), -1, dtype=np.int32)
+    rank[indx] = np.arange(N)
+    row = rank[row]
+    kept &= row >= 0
 
-    mtx = sparse.coo_array((df[key].values, (df.j.values, df.gene.map(ft_dict))), shape=(N, M)).tocsr()
+    mtx = sparse.coo_array((val[kept], (row[kept], col[kept])), shape=(N, M), dtype=dtype).tocsr()
 
     feature["Weight"] = mtx.sum(axis = 0)
     feature.Weight = feature.Weight * 1. / feature.Weight.sum()
 
     if return_df:
+        df = pd.DataFrame({'X':line_x.values()[kept], 'Y':line_y.values()[kept], \
+                           'gene':pd.array(feature.gene.values[col[kept]], dtype=gene_dtype), \
+                           key:val[kept], 'j':row[kept]})
         return df, feature, brc, mtx, ft_dict, bc_dict
     else:
         return feature, brc, mtx, ft_dict, bc_dict
@@ -436,3 +526,89 @@ def chisq(k,info,total_k,total_umi):
         chi2, p, dof, ex = scipy.stats.chi2_contingency(tab, correction=False)
         res.append([name,k,chi2,p,fd,v["gene_tot"]])
     return res
+
+def chi2_logsf(x, df=1):
+    """
+    log of the chi-square upper tail probability, for df=1 values beyond
+    the range of chi2.logsf use log(2 * Phi(-sqrt(x)))
+    """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore'):
+        res = np.asarray(scipy.stats.chi2.logsf(x, df), dtype=float)
+    if df == 1:
+        indx = np.isinf(res) & (x > 0)
+        res[indx] = np.log(2) + scipy.special.log_ndtr(-np.sqrt(x[indx]))
+    return res
+
+def chisq_de(info, factors, total_k, total_umi, min_fold=1):
+    """
+    Chi-square test (2x2, no continuity correction) of each gene in each
+    factor against the rest, all gene-factor pairs at once
+    info: genes x (factors + 'gene_tot') counts indexed by gene,
+    total_k: total count of each factor
+    Pairs with zero count or fold change below min_fold are skipped
+    Returns a DataFrame with columns gene, factor, Chi2, pval, FoldChange,
+    gene_total, ordered by factor then gene
+    """
+    total_k = np.asarray(total_k, dtype=float)
+    x = np.asarray(info.loc[:, factors], dtype=float).T # factors x genes
+    gene_tot = np.asarray(info.gene_tot, dtype=float)
+    valid = (total_k.reshape((-1, 1)) > 0) & (x > 0)
+    t00 = x
+    t01 = gene_tot - t00
+    t10 = total_k.reshape((-1, 1)) - t00
+    t11 = total_umi - total_k.reshape((-1, 1)) - gene_tot + t00
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fd = t00 / total_k.reshape((-1, 1)) / t01 * (total_umi - total_k.reshape((-1, 1)))
+    valid &= ~(fd < min_fold)
+    k, g = np.where(valid)
+    tab = [np.around(t[k, g], 0).astype(int) + 1 for t in [t00, t01, t10, t11]]
+    # Expected counts from the margins
+    r0, r1 = tab[0] + tab[1], tab[2] + tab[3]
+    c0, c1 = tab[0] + tab[2], tab[1] + tab[3]
+    n = r0 + r1
+    chi2 = np.zeros(len(k))
+    for o, r, c in zip(tab, [r0, r0, r1, r1], [c0, c1, c0, c1]):
+        e = r * c / n
+        chi2 += (o - e) ** 2 / e
+    pval = scipy.stats.chi2.sf(chi2, 1) # As chi2_contingency, underflows to 0 beyond ~1425
+    return pd.DataFrame({'gene':np.asarray(info.index)[g], 'factor':np.asarray(factors)[k],\
+        'Chi2':chi2, 'pval':pval, 'FoldChange':fd[k, g], 'gene_total':info.gene_tot.values[g]})
+
+def coherence_score(mtx, theta, gene_f, top_genes):
+    """
+    Co-occurrence coherence of each factor's top genes
+    mtx: units x genes counts (sparse), theta: units x K factor loadings,
+    gene_f: gene weights (overall frequency), top_genes: for each factor
+    a list of gene (column) indices, e.g. the top DE genes
+    For each pair of top genes i, j with gene_f[i] >= gene_f[j], sums
+    theta[u, k] * log(x_uj / (x_ui * f_j / f_i) + 1) over units u with x_ui > 0
+    Returns a list of [k, score, score / theta[:, k].sum()] for factors
+    with at least one top gene
+    """
+    mtx = sparse.csc_matrix(mtx)
+    res = []
+    for k, wd_idx in enumerate(top_genes):
+        if len(wd_idx) == 0:
+            continue
+        wd_idx = np.asarray(wd_idx)
+        wd_idx = wd_idx[np.argsort(-gene_f[wd_idx], kind='stable')]
+        # Units x top genes, only units with at least two of the genes
+        sub = mtx[:, wd_idx].tocsr()
+        multi = np.diff(sub.indptr) > 1
+        sub = sub[multi, :]
+        sub.sort_indices()
+        theta_k = theta[multi, k]
+        # All pairs of nonzero entries in the same unit
+        q = np.diff(sub.indptr)
+        row = np.repeat(np.arange(sub.shape[0]), q)
+        rep = q[row]
+        e1 = np.repeat(np.arange(sub.nnz), rep)
+        e2 = sub.indptr[row[e1]] + np.arange(len(e1)) - np.repeat(np.cumsum(rep) - rep, rep)
+        kept = sub.indices[e1] < sub.indices[e2]
+        e1, e2 = e1[kept], e2[kept]
+        i, j = wd_idx[sub.indices[e1]], wd_idx[sub.indices[e2]]
+        denom = sub.data[e1] * gene_f[j] / gene_f[i]
+        s = (theta_k[row[e1]] * np.log(sub.data[e2] / denom + 1)).sum() if len(e1) > 0 else 0
+        res.append([k, s, s / theta[:, k].sum()])
+    return res
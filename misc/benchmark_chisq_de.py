@@ -0,0 +1,50 @@
+### Compare the vectorized chi-square DE test (utilt.chisq_de, used by
+### de_bulk and fit_model) with per gene-factor chi2_contingency calls
+
+import sys, os, time, argparse, logging
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.utils.utilt import chisq, chisq_de
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default='', help='Posterior count table (gene x factor), if absent simulate one')
+    parser.add_argument('--M', type=int, default=2000, help='Number of genes to simulate')
+    parser.add_argument('--K', type=int, default=20, help='Number of factors to simulate')
+    parser.add_argument('--min_ct_per_feature', default=50, type=int, help='')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    if os.path.isfile(args.input):
+        info = pd.read_csv(args.input, sep='\t').set_index('gene')
+    else:
+        rng = np.random.default_rng(args.seed)
+        beta = rng.dirichlet(np.ones(args.M) * .1, args.K)
+        ct = rng.gamma(2, 1, (args.M, 1)) * beta.T * 1e5 * rng.dirichlet(np.ones(args.K))
+        info = pd.DataFrame(np.around(ct, 2), index = [f"g{i}" for i in range(args.M)])
+    header = [str(x) for x in info.columns]
+    info.columns = header
+    info["gene_tot"] = info.loc[:, header].sum(axis=1).astype(int)
+    info = info[info["gene_tot"] > args.min_ct_per_feature]
+    total_umi = info.gene_tot.sum()
+    total_k = np.array(info.loc[:, header].sum(axis = 0) )
+    logging.info(f"Testing {info.shape[0]} genes over {len(header)} factors")
+
+    t0 = time.time()
+    res = []
+    for k, kname in enumerate(header):
+        res += chisq(kname, info.loc[:, [kname, 'gene_tot']], total_k[k], total_umi)
+    ref = pd.DataFrame(res,columns=['gene','factor','Chi2','pval','FoldChange','gene_total'])
+    t1 = time.time()
+    new = chisq_de(info, header, total_k, total_umi)
+    t2 = time.time()
+    assert ref.shape == new.shape and np.array_equal(ref.gene.values, new.gene.values) and np.array_equal(ref.factor.values, new.factor.values)
+    d = {x : (np.abs(ref[x].values - new[x].values) / np.abs(ref[x].values)).max() for x in ['Chi2', 'FoldChange']}
+    p = ref.pval.values > 0
+    d['pval'] = (np.abs(ref.pval.values[p] - new.pval.values[p]) / ref.pval.values[p]).max()
+    logging.info(f"{ref.shape[0]} tests: per pair {t1-t0:.3f}s, vectorized {t2-t1:.3f}s, speedup {(t1-t0)/(t2-t1):.1f}x")
+    logging.info("Max rel diff " + ", ".join([f"{k} {v:.2e}" for k, v in d.items()]))
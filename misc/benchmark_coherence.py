@@ -0,0 +1,65 @@
+### Compare the coherence score used in fit_model (utilt.coherence_score)
+### with the previous loop over gene pairs, on a hexagon DGE
+
+import sys, os, time, argparse, logging
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.utils.utilt import make_mtx_from_dge, coherence_score
+
+def coherence_reference(mtx, theta, gene_f, top_genes):
+    """
+    The pairwise loop from fit_model, kept for comparison
+    """
+    res = []
+    for k, wd_idx in enumerate(top_genes):
+        topm = len(wd_idx)
+        if topm == 0:
+            continue
+        wd_idx = sorted( list(wd_idx), key = lambda x : -gene_f[x])
+        s = 0
+        for ii in range(topm - 1):
+            for jj in range(ii+1, topm):
+                i = wd_idx[ii]
+                j = wd_idx[jj]
+                idx = mtx.indices[mtx.indptr[i]:mtx.indptr[i+1]]
+                denom = mtx[:, [i]].toarray()[idx] * gene_f[j] / gene_f[i]
+                num = mtx[:, [j]].toarray()[idx]
+                s += (theta[idx, k].reshape((-1, 1)) * np.log(num/denom + 1)).sum()
+        res.append([k, s, s / theta[:, k].sum()])
+    return res
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, help='Hexagon DGE (output of make_dge)')
+    parser.add_argument('--key', type=str, default='Count', help='')
+    parser.add_argument('--min_ct_per_unit', type=int, default=20, help='')
+    parser.add_argument('--min_ct_per_feature', type=int, default=20, help='')
+    parser.add_argument('--K', type=int, default=30, help='')
+    parser.add_argument('--topM', type=int, default=50, help='')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    feature, brc, mtx, ft_dict, bc_dict = make_mtx_from_dge(args.input, min_ct_per_feature = args.min_ct_per_feature, min_ct_per_unit = args.min_ct_per_unit, unit = "random_index", key = args.key)
+    mtx = mtx.tocsc()
+    gene_f = feature.Weight.values
+    N, M = mtx.shape
+    rng = np.random.default_rng(args.seed)
+    theta = rng.dirichlet(np.ones(args.K) * .5, N)
+    # Genes most associated with each (random) factor
+    info = np.asarray(mtx.T @ theta) / np.asarray(mtx.sum(axis = 0)).reshape((-1, 1))
+    topM = min(args.topM, M)
+    top_genes = [np.argsort(-info[:, k])[:topM] for k in range(args.K)]
+    logging.info(f"{N} units, {M} genes, {args.K} factors, top {topM} genes per factor")
+
+    t0 = time.time()
+    r0 = coherence_reference(mtx, theta, gene_f, top_genes)
+    t1 = time.time()
+    r1 = coherence_score(mtx, theta, gene_f, top_genes)
+    t2 = time.time()
+    r0, r1 = np.array(r0), np.array(r1)
+    assert np.array_equal(r0[:, 0], r1[:, 0])
+    d = np.abs(r0[:, 1:] - r1[:, 1:]).max() / np.abs(r0[:, 1:]).max()
+    logging.info(f"Pairwise loop {t1-t0:.3f}s, vectorized {t2-t1:.3f}s, speedup {(t1-t0)/(t2-t1):.1f}x. Max rel diff {d:.2e}")
@@ -0,0 +1,58 @@
+### Compare the batched document update in online_lda with the
+### per-document loop, on a hexagon DGE (e.g. from examples/simulation)
+
+import sys, os, time, pickle, argparse, logging
+import numpy as np
+import pandas as pd
+from sklearn.decomposition._online_lda_fast import _dirichlet_expectation_2d
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.models.online_lda import _update_doc_distribution
+from ficture.utils.utilt import make_mtx_from_dge
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, help='Hexagon DGE (output of make_dge)')
+    parser.add_argument('--model', type=str, default='', help='A model pickled by fit_model or a tsv file with gene names and factor profiles. If absent, use a random model with --K factors')
+    parser.add_argument('--K', type=int, default=10, help='')
+    parser.add_argument('--key', type=str, default='Count', help='')
+    parser.add_argument('--min_ct_per_unit', type=int, default=20, help='')
+    parser.add_argument('--min_ct_per_feature', type=int, default=20, help='')
+    parser.add_argument('--max_doc_update_iter', type=int, default=100, help='')
+    parser.add_argument('--mean_change_tol', type=float, default=1e-3, help='')
+    parser.add_argument('--repeat', type=int, default=3, help='')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    feature, brc, mtx, ft_dict, bc_dict = make_mtx_from_dge(args.input, min_ct_per_feature = args.min_ct_per_feature, min_ct_per_unit = args.min_ct_per_unit, unit = "random_index", key = args.key)
+    mtx = mtx.astype(float)
+    rng = np.random.default_rng(args.seed)
+    if args.model.endswith(".tsv.gz") or args.model.endswith(".tsv"):
+        model = pd.read_csv(args.model, sep='\t').set_index('gene')
+        lam = model.reindex(feature.gene.values).fillna(0).values.T + .5
+    elif os.path.isfile(args.model):
+        model = pickle.load(open(args.model, "rb"))
+        lam = pd.DataFrame(model.components_.T, index=model.feature_names_in_).reindex(feature.gene.values).fillna(0).values.T + .5
+    else:
+        lam = rng.gamma(100, .01, (args.K, mtx.shape[1]))
+    exp_elog_beta = np.exp(_dirichlet_expectation_2d(lam))
+    K = exp_elog_beta.shape[0]
+    logging.info(f"{mtx.shape[0]} units, {mtx.shape[1]} genes, {mtx.nnz} nonzero entries, {K} factors")
+
+    for init in ["random", "ones"]:
+        t_ref, t_new = [], []
+        for r in range(args.repeat):
+            res = []
+            for batch_min_docs, t in [(np.inf, t_ref), (1, t_new)]:
+                random_state = np.random.RandomState(args.seed) if init == "random" else None
+                t0 = time.time()
+                res.append(_update_doc_distribution(mtx, exp_elog_beta, 1./K, args.max_doc_update_iter, args.mean_change_tol, True, random_state, batch_min_docs=batch_min_docs))
+                t.append(time.time() - t0)
+        (g0, s0), (g1, s1) = res
+        d_gamma = np.abs(g0 - g1).max() / np.abs(g0).max()
+        d_sstats = np.abs(s0 - s1).max() / np.abs(s0).max()
+        agree = (g0.argmax(axis = 1) == g1.argmax(axis = 1)).mean()
+        logging.info(f"Init {init}: per-document loop {np.median(t_ref):.3f}s, batched {np.median(t_new):.3f}s, speedup {np.median(t_ref)/np.median(t_new):.2f}x")
+        logging.info(f"Init {init}: max rel diff gamma {d_gamma:.2e}, sstats {d_sstats:.2e}, top factor agreement {agree:.4f}")
@@ -0,0 +1,47 @@
+### Compare LDA.partial_fit with a joblib Parallel context per call and
+### with the persistent worker pool, on a hexagon DGE (e.g. from examples/simulation)
+
+import sys, os, time, argparse, logging
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.models.online_lda import LDA, shutdown_pool
+from ficture.utils.utilt import make_mtx_from_dge
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, help='Hexagon DGE (output of make_dge)')
+    parser.add_argument('--K', type=int, default=10, help='')
+    parser.add_argument('--key', type=str, default='Count', help='')
+    parser.add_argument('--min_ct_per_unit', type=int, default=20, help='')
+    parser.add_argument('--min_ct_per_feature', type=int, default=20, help='')
+    parser.add_argument('--batch_size', type=int, default=256, help='Units per minibatch (within each partial_fit call)')
+    parser.add_argument('--chunk_size', type=int, default=512, help='Units per partial_fit call')
+    parser.add_argument('--epoch', type=int, default=3, help='')
+    parser.add_argument('--thread', type=int, nargs='+', default=[2, 4], help='')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    feature, brc, mtx, ft_dict, bc_dict = make_mtx_from_dge(args.input, min_ct_per_feature = args.min_ct_per_feature, min_ct_per_unit = args.min_ct_per_unit, unit = "random_index", key = args.key)
+    mtx = mtx.astype(float).tocsr()
+    N = mtx.shape[0]
+    logging.info(f"{N} units, {mtx.shape[1]} genes, {mtx.nnz} nonzero entries, {args.K} factors")
+
+    for thread in args.thread:
+        res, t = [], []
+        for persistent_pool in [False, True]:
+            model = LDA(n_components=args.K, learning_method='online', batch_size=args.batch_size, total_samples=N, n_jobs=thread, random_state=args.seed, persistent_pool=persistent_pool)
+            t0 = time.time()
+            n_call = 0
+            for e in range(args.epoch):
+                for st in range(0, N, args.chunk_size):
+                    model.partial_fit(mtx[st:(st + args.chunk_size), :])
+                    n_call += 1
+            t.append(time.time() - t0)
+            res.append(model.components_.copy())
+            model.close_pool()
+        shutdown_pool()
+        d = np.abs(res[0] - res[1]).max() / np.abs(res[0]).max()
+        logging.info(f"{thread} workers, {n_call} partial_fit calls: joblib {t[0]:.3f}s, persistent pool {t[1]:.3f}s (including pool start), speedup {t[0]/t[1]:.2f}x. Max rel diff in components {d:.2e}")
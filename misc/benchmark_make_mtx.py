@@ -0,0 +1,126 @@
+### Compare the streaming make_mtx_from_dge (integer triplets per chunk,
+### thresholds applied to the counts afterwards) with the previous version
+### that concatenates the chunks into one data frame. Reports time and
+### peak memory (tracemalloc) and checks that the outputs are identical
+
+import sys, os, time, tracemalloc, argparse, logging
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.utils.utilt import make_mtx_from_dge
+from ficture.loaders.columnar_store import is_columnar, ColumnarReader
+
+def make_mtx_from_dge_reference(file, min_ct_per_feature = 50, min_ct_per_unit = 100, feature_white_list = None, feature_list = None, unit = "random_index", key = "gn", epoch=1, epoch_id_length=2, return_df = False, feature_list_force = False, dtype = None):
+    """
+    The previous make_mtx_from_dge, kept for comparison
+    """
+    df = pd.DataFrame()
+    epoch_id_list = set()
+    if is_columnar(file):
+        reader = ColumnarReader(file, chunksize=500000, usecols = [unit,'X','Y','gene',key], categorical=False)
+    else:
+        reader = pd.read_csv(file, sep='\t', usecols = [unit,'X','Y','gene',key], dtype={unit:str}, chunksize=500000)
+    for chunk in reader:
+        unit_list = chunk[unit].str[:epoch_id_length].unique()
+        i = 0
+        while len(epoch_id_list) < epoch and i < len(unit_list):
+            epoch_id_list.add(unit_list[i])
+            i += 1
+        if len(epoch_id_list) >= epoch and unit_list[-1] not in epoch_id_list:
+            pat = '^' + '|'.join(list(epoch_id_list))
+            df = pd.concat([df, chunk[chunk[unit].str.contains(pat) & chunk[key].ge(1)] ])
+            break
+        df = pd.concat([df, chunk[chunk[key].ge(1)] ])
+    epoch0 = df[unit].iloc[0][:epoch_id_length]
+    one_pass = df[unit].str[:epoch_id_length].eq(epoch0)
+    if feature_list is not None:
+        feature = pd.DataFrame({"gene": feature_list})
+        ct = df[one_pass].groupby(by=['gene']).agg({key:"sum"}).reset_index()
+        if feature_list_force is False:
+            ct.drop(index = ct[ct[key].lt(min_ct_per_feature)].index, inplace=True)
+            feature = feature.merge(right = ct, on = 'gene', how = 'inner')
+        else:
+            feature = feature.merge(right = ct, on = 'gene', how = 'left')
+            feature.fillna(0, inplace=True)
+    else:
+        feature = df[one_pass].groupby(by=['gene']).agg({key:"sum"}).reset_index()
+        feature_white_list = set() if feature_white_list is None else set(feature_white_list)
+        feature = feature.loc[feature[key].ge(min_ct_per_feature ) | feature.gene.isin(feature_white_list), :]
+    M = len(feature)
+    feature.index = np.arange(M)
+    ft_dict = {x:i for i,x in enumerate(feature.gene)}
+    df.drop(index = df.index[~df.gene.isin(ft_dict)], inplace=True)
+
+    brc = df.groupby(by = unit).agg({key:"sum"}).reset_index()
+    brc.drop(index = brc.index[brc[key].lt(min_ct_per_unit)], inplace=True)
+    N = brc.shape[0]
+    brc.index = np.arange(N)
+    bc_dict = {x:i for i,x in enumerate(brc[unit])}
+    brc['j'] = brc[unit].map(bc_dict)
+    df.drop(index = df.index[~df[unit].isin(bc_dict)], inplace=True)
+    df['j'] = df[unit].map(bc_dict)
+    brc["epoch"] = brc[unit].str[:epoch_id_length]
+    df.drop(columns = unit, inplace=True)
+    brc = brc.merge(right = df[['j','X','Y' ]].drop_duplicates(subset='j'), on = 'j', how = 'left')
+
+    mtx = sparse.coo_array((df[key].values, (df.j.values, df.gene.map(ft_dict))), shape=(N, M), dtype=dtype).tocsr()
+
+    feature["Weight"] = mtx.sum(axis = 0)
+    feature.Weight = feature.Weight * 1. / feature.Weight.sum()
+
+    if return_df:
+        return df, feature, brc, mtx, ft_dict, bc_dict
+    else:
+        return feature, brc, mtx, ft_dict, bc_dict
+
+
+def run(fn, args, kwargs):
+    tracemalloc.start()
+    t0 = time.time()
+    res = fn(args.input, min_ct_per_feature = args.min_ct_per_feature, min_ct_per_unit = args.min_ct_per_unit, unit = args.unit, key = args.key, epoch_id_length = args.epoch_id_length, **kwargs)
+    t = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, t, peak
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, help='Hexagon DGE (output of make_dge)')
+    parser.add_argument('--unit', type=str, default='random_index', help='')
+    parser.add_argument('--key', type=str, default='Count', help='')
+    parser.add_argument('--epoch_id_length', type=int, default=2, help='')
+    parser.add_argument('--min_ct_per_unit', type=int, default=20, help='')
+    parser.add_argument('--min_ct_per_feature', type=int, default=20, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    gene = pd.read_csv(args.input, sep='\t', usecols=['gene']).gene.unique()
+    rng = np.random.default_rng(0)
+    feature_list = list(rng.choice(gene, len(gene) // 2, replace=False)) + ["not_a_gene"]
+    settings = {"default":{}, "epoch 2":{"epoch":2}, "float32":{"dtype":np.float32},\
+                "feature list":{"feature_list":feature_list},\
+                "feature list (force)":{"feature_list":feature_list, "feature_list_force":True},\
+                "white list":{"feature_white_list":feature_list[:20]}}
+    for name, kwargs in settings.items():
+        r0, t0, m0 = run(make_mtx_from_dge_reference, args, kwargs)
+        r1, t1, m1 = run(make_mtx_from_dge, args, kwargs)
+        feature, brc, mtx, ft_dict, bc_dict = r0
+        if kwargs.get("epoch", 1) > 1:
+            # The previous regex filter ('^00|01') also kept units of later
+            # epochs containing the other labels, compare the intended units
+            kept = brc.epoch.isin(r1[1].epoch.unique()).values
+            logging.info(f"{name}: previous version kept {(~kept).sum()} units from later epochs")
+            brc = brc[kept].reset_index(drop=True)
+            brc['j'] = np.arange(len(brc))
+            mtx = mtx[np.flatnonzero(kept)]
+            bc_dict = {x:i for i,x in enumerate(brc[args.unit])}
+            feature = feature.drop(columns = "Weight")
+            r1 = (r1[0].drop(columns = "Weight"), ) + r1[1:]
+        pd.testing.assert_frame_equal(feature, r1[0])
+        pd.testing.assert_frame_equal(brc, r1[1], check_index_type=False)
+        assert mtx.dtype == r1[2].dtype and mtx.shape == r1[2].shape and (mtx != r1[2]).nnz == 0
+        assert ft_dict == r1[3] and bc_dict == r1[4]
+        logging.info(f"{name}: {mtx.shape[0]} units, {mtx.shape[1]} features, {mtx.nnz} entries. Time {t0:.2f}s vs {t1:.2f}s ({t0/t1:.1f}x), peak memory {m0/2**20:.0f}MB vs {m1/2**20:.0f}MB ({m0/m1:.1f}x, CSR {(mtx.data.nbytes+mtx.indices.nbytes+mtx.indptr.nbytes)/2**20:.0f}MB). Identical")
@@ -0,0 +1,170 @@
+### Compare minibatch preparation in PixelMinibatch using the anchor grid
+### index, per-minibatch pixel ranges and the pixel grid radius search with
+### the previous full scans and BallTree queries
+
+import sys, os, time, argparse, logging, tempfile
+import numpy as np
+import pandas as pd
+import sklearn.neighbors
+import sklearn.preprocessing
+from scipy.sparse import coo_array
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.loaders.pixel_loader import PixelMinibatch
+from ficture.utils.spatial_index import GridIndex
+
+def prepare_batch_reference(obj, bt, b, init_bound):
+    """
+    _prepare_batch as implemented before the spatial indices, kept for
+    comparison. bt is a BallTree over the pixels of the chunk
+    """
+    indx = obj.brc[obj.batch_id].eq(b)
+    x_min, x_max = obj.brc.loc[indx, 'X'].min(), obj.brc.loc[indx, 'X'].max()
+    y_min, y_max = obj.brc.loc[indx, 'Y'].min(), obj.brc.loc[indx, 'Y'].max()
+    grid_indx = (obj.grid_info.x >= x_min - obj.radius) &\
+                (obj.grid_info.x <= x_max + obj.radius) &\
+                (obj.grid_info.y >= y_min - obj.radius) &\
+                (obj.grid_info.y <= y_max + obj.radius)
+    grid_pt = obj.grid_info.loc[grid_indx, ["x","y"]]
+    if grid_pt.shape[0] < 10:
+        return None, None, None, None
+    theta = np.array(obj.grid_info.loc[grid_indx, obj.factor_header])
+    theta = sklearn.preprocessing.normalize(np.clip(theta, init_bound, 1.-init_bound), norm='l1', axis=1)
+    n = theta.shape[0]
+    indx, dist = bt.query_radius(X = np.array(grid_pt), r = obj.radius, return_distance = True)
+    r_indx = [i for i,x in enumerate(indx) for y in range(len(x))]
+    c_indx = [x for y in indx for x in y]
+    wij = np.array([x for y in dist for x in y])
+    wij = 1-(wij / obj.radius)**obj.nu
+    wij = coo_array((wij, (r_indx,c_indx)),shape=(n,obj.N0)).tocsc().T
+    wij.eliminate_zeros()
+    nchoice=(wij != 0).sum(axis = 1)
+    b_indx = np.arange(obj.N0)[nchoice > 0]
+    wij = wij[b_indx, :]
+    wij.data = np.clip(wij.data, .05, .95)
+    return b_indx, grid_pt, wij, theta
+
+def pixel_weight_reference(obj, bt, grid_pt):
+    """
+    Pixel to anchor weights from BallTree.query_radius, as in the previous _prepare_batch
+    """
+    n = grid_pt.shape[0]
+    indx, dist = bt.query_radius(X = grid_pt, r = obj.radius, return_distance = True)
+    r_indx = [i for i,x in enumerate(indx) for y in range(len(x))]
+    c_indx = [x for y in indx for x in y]
+    wij = np.array([x for y in dist for x in y])
+    wij = 1-(wij / obj.radius)**obj.nu
+    wij = coo_array((wij, (r_indx,c_indx)),shape=(n,obj.N0)).tocsc().T
+    wij.eliminate_zeros()
+    nchoice=(wij != 0).sum(axis = 1)
+    b_indx = np.arange(obj.N0)[nchoice > 0]
+    wij = wij[b_indx, :]
+    wij.data = np.clip(wij.data, .05, .95)
+    return b_indx, wij
+
+def simulate_chunk(rng, n_anchor, anchor_dist, batch_size, pixel_per_batch, M, K):
+    """
+    Anchors on a regular grid, square minibatches tiling the same region
+    """
+    side = int(np.sqrt(n_anchor))
+    size = side * anchor_dist
+    g = np.arange(side) * anchor_dist + anchor_dist / 2
+    grid = pd.DataFrame(np.array(np.meshgrid(g, g)).reshape((2, -1)).T, columns = ['X','Y'])
+    theta = rng.dirichlet(np.ones(K), grid.shape[0])
+    for k in range(K):
+        grid[f"K_{k}"] = theta[:, k]
+    nb = int(np.ceil(size / batch_size))
+    df = []
+    for i in range(nb):
+        for j in range(nb):
+            b = str(rng.integers(10**15, 10**16))
+            xy = rng.uniform(0, batch_size, (pixel_per_batch, 2)) + np.array([i, j]) * batch_size
+            xy = np.clip(np.round(xy, 2), 0, size)
+            df.append(pd.DataFrame({'random_index':b, 'X':xy[:, 0], 'Y':xy[:, 1],\
+                    'gene':rng.integers(0, M, pixel_per_batch).astype(str), 'count':1}))
+    return grid, pd.concat(df), nb * nb
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_anchor', type=int, default=10000, help='Number of anchors in the chunk')
+    parser.add_argument('--anchor_dist', type=float, default=4, help='')
+    parser.add_argument('--radius', type=float, default=5, help='')
+    parser.add_argument('--batch_size', type=float, default=50, help='Side length (um) of each minibatch')
+    parser.add_argument('--pixel_per_batch', type=int, default=2000, help='')
+    parser.add_argument('--M', type=int, default=100, help='')
+    parser.add_argument('--K', type=int, default=12, help='')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    rng = np.random.default_rng(args.seed)
+    grid, df, nbatch = simulate_chunk(rng, args.n_anchor, args.anchor_dist, args.batch_size, args.pixel_per_batch, args.M, args.K)
+    ft_dict = {str(x):x for x in range(args.M)}
+    init_bound = 1./args.K * .2
+    with tempfile.NamedTemporaryFile(suffix=".tsv") as anchor_file:
+        grid.to_csv(anchor_file.name, sep='\t', index=False)
+        obj = PixelMinibatch(iter([df]), ft_dict, 'random_index', 'count', 1,\
+                             radius=args.radius, halflife=.7, precision=-1)
+        obj.load_anchor(anchor_file.name, True)
+        obj.read_chunk(nbatch)
+    logging.info(f"{obj.grid_info.shape[0]} anchors, {obj.N0} pixels, {len(obj.batch_index)} minibatches in the chunk")
+    t0 = time.time()
+    bt = sklearn.neighbors.BallTree(np.asarray(obj.brc[['X','Y']]))
+    t1 = time.time()
+    pixel_index = GridIndex(obj.brc[['X','Y']].values, obj.radius)
+    t2 = time.time()
+    logging.info(f"Pixel index (once per chunk): BallTree {t1-t0:.3f}s, grid {t2-t1:.3f}s")
+
+    t_ref, t_new = 0, 0
+    for b in obj.batch_index:
+        t0 = time.time()
+        r0 = prepare_batch_reference(obj, bt, b, init_bound)
+        t1 = time.time()
+        r1 = obj._prepare_batch(b, init_bound)
+        t2 = time.time()
+        t_ref += t1 - t0
+        t_new += t2 - t1
+        if r0[0] is None:
+            assert r1[0] is None
+            continue
+        assert np.array_equal(r0[0], r1[0]) and np.array_equal(r0[1].index, r1[1].index), f"Minibatch {b} differs"
+        assert np.array_equal(r0[2].indptr, r1[2].indptr) and np.array_equal(r0[2].indices, r1[2].indices) and np.array_equal(r0[2].data, r1[2].data) and np.array_equal(r0[3], r1[3])
+    logging.info(f"Prepare {len(obj.batch_index)} minibatches: full scan {t_ref:.3f}s, indexed {t_new:.3f}s, speedup {t_ref/t_new:.2f}x. Results are identical")
+
+    # Pixel to anchor weights only
+    t_ref, t_new = 0, 0
+    for b in obj.batch_index:
+        indx = obj._batch_pixel(b)
+        x, y = obj.brc.X.values[indx], obj.brc.Y.values[indx]
+        grid_indx = obj.anchor_index.query_box(x.min() - obj.radius, x.max() + obj.radius,\
+                                               y.min() - obj.radius, y.max() + obj.radius)
+        grid_pt = obj.grid_info[['x','y']].values[grid_indx]
+        t0 = time.time()
+        r0 = pixel_weight_reference(obj, bt, grid_pt)
+        t1 = time.time()
+        r1 = obj._pixel_weight(grid_pt)
+        t2 = time.time()
+        t_ref += t1 - t0
+        t_new += t2 - t1
+        assert np.array_equal(r0[0], r1[0]) and np.array_equal(r0[1].indptr, r1[1].indptr) and np.array_equal(r0[1].indices, r1[1].indices) and np.array_equal(r0[1].data, r1[1].data)
+    logging.info(f"Weights only: BallTree {t_ref:.3f}s, grid {t_new:.3f}s, speedup {t_ref/t_new:.2f}x")
+
+    # Selection only (anchors in the bounding box and pixels of the minibatch)
+    t0 = time.time()
+    for b in obj.batch_index:
+        indx = obj.brc[obj.batch_id].eq(b)
+        x_min, x_max = obj.brc.loc[indx, 'X'].min(), obj.brc.loc[indx, 'X'].max()
+        y_min, y_max = obj.brc.loc[indx, 'Y'].min(), obj.brc.loc[indx, 'Y'].max()
+        grid_indx = (obj.grid_info.x >= x_min - obj.radius) &\
+                    (obj.grid_info.x <= x_max + obj.radius) &\
+                    (obj.grid_info.y >= y_min - obj.radius) &\
+                    (obj.grid_info.y <= y_max + obj.radius)
+    t1 = time.time()
+    for b in obj.batch_index:
+        indx = obj._batch_pixel(b)
+        x, y = obj.brc.X.values[indx], obj.brc.Y.values[indx]
+        grid_indx = obj.anchor_index.query_box(x.min() - obj.radius, x.max() + obj.radius,\
+                                               y.min() - obj.radius, y.max() + obj.radius)
+    t2 = time.time()
+    logging.info(f"Selection only: full scan {t1-t0:.3f}s, indexed {t2-t1:.3f}s, speedup {(t1-t0)/(t2-t1):.2f}x")
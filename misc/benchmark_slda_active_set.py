@@ -0,0 +1,50 @@
+### Compare the full E-step in OnlineLDA.do_e_step (pixel level decoding)
+### with the active set E-step, on a simulated minibatch
+
+import sys, os, time, argparse, logging
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.models.online_slda import OnlineLDA
+from ficture.utils.simulate import simulate_pixels, anchor_theta, make_batch
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--K', type=int, default=12, help='')
+    parser.add_argument('--M', type=int, default=500, help='Number of genes')
+    parser.add_argument('--width', type=float, default=200, help='Side of the simulated square region')
+    parser.add_argument('--n_pixel', type=int, default=40000, help='')
+    parser.add_argument('--anchor_dist', type=float, default=4, help='Distance between anchors on a square lattice')
+    parser.add_argument('--radius', type=float, default=6, help='Max distance between a pixel and its anchors')
+    parser.add_argument('--iter_inner', type=int, default=30, help='')
+    parser.add_argument('--active_tol', type=float, nargs='+', default=[1e-4, 1e-3], help='')
+    parser.add_argument('--active_patience', type=int, default=3, help='')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    rng = np.random.default_rng(args.seed)
+    K, M = args.K, args.M
+    sim = simulate_pixels(rng, K, M, args.width, args.n_pixel, args.anchor_dist, args.radius)
+    theta = anchor_theta(sim, rng)
+    logging.info(f"{args.n_pixel} pixels, {len(sim['grid_pt'])} anchors, {sim['wij'].nnz} pixel-anchor pairs, {K} factors")
+
+    res, t = [], []
+    for active_tol in [None] + args.active_tol:
+        slda = OnlineLDA(vocab=np.arange(M), K=K, N=1e6, iter_inner=args.iter_inner, seed=args.seed,\
+                         active_set=active_tol is not None, active_tol=active_tol, active_patience=args.active_patience, verbose=int(active_tol is not None))
+        slda.init_global_parameter(sim['beta'] * 1e4 + .5)
+        batch = make_batch(sim, theta)
+        t0 = time.time()
+        slda.do_e_step(batch)
+        t.append(time.time() - t0)
+        res.append((batch.gamma, batch.phi))
+        if active_tol is None:
+            continue
+        d_gamma = np.abs(res[0][0] - batch.gamma).max() / np.abs(res[0][0]).max()
+        d_phi = np.abs(res[0][1] - batch.phi).max()
+        m_phi = np.abs(res[0][1] - batch.phi).mean()
+        agree = (res[0][1].argmax(axis = 1) == batch.phi.argmax(axis = 1)).mean()
+        logging.info(f"active_tol {active_tol:.1e}: full {t[0]:.3f}s, active set {t[-1]:.3f}s, speedup {t[0]/t[-1]:.2f}x")
+        logging.info(f"active_tol {active_tol:.1e}: max rel diff gamma {d_gamma:.2e}, max abs diff phi {d_phi:.2e}, mean abs diff phi {m_phi:.2e}, pixel top factor agreement {agree:.4f}")
@@ -0,0 +1,93 @@
+### Compare the E-step in OnlineLDA (online_slda) with the previous
+### per-factor implementation on synthetic minibatches
+
+import sys, os, copy, time, argparse, logging
+import numpy as np
+from scipy.sparse import issparse
+from scipy.special import logsumexp
+from sklearn.preprocessing import normalize
+from sklearn.decomposition._online_lda_fast import _dirichlet_expectation_2d
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.models.online_slda import OnlineLDA
+from ficture.utils.simulate import simulate_pixels, anchor_theta, make_batch
+
+def do_e_step_reference(slda, batch):
+    """
+    The E-step as implemented before the fused version, kept for comparison
+    """
+    Xb = batch.mtx @ slda._Elog_beta.T
+    if issparse(Xb):
+        Xb = Xb.toarray()
+    c_indx, r_indx = batch.psi.nonzero()
+    if batch.alpha is None:
+        batch.alpha = np.broadcast_to(slda._alpha, (batch.n, slda._K))
+    if batch.gamma is None:
+        batch.gamma = copy.copy(batch.alpha)
+    gamma_old = copy.copy(batch.gamma)
+    Elog_theta = _dirichlet_expectation_2d(batch.gamma)
+    meanchange = slda._tol + 1
+    it = 0
+    while it < slda._max_iter_inner and meanchange > slda._tol:
+        batch.phi = batch.psi @ Elog_theta + Xb
+        batch.phi = np.exp(batch.phi -\
+                           logsumexp(batch.phi, axis = 1).reshape((-1, 1)) )
+        psi_hat = batch.phi[c_indx, 0] * Elog_theta[r_indx, 0]
+        for k in range(1, slda._K):
+            psi_hat += batch.phi[c_indx, k] * Elog_theta[r_indx, k]
+        psi_hat += np.multiply(Xb, batch.phi).sum(axis = 1).reshape(-1)[c_indx]
+        batch.psi.data = psi_hat
+        batch.psi += batch.ElogO
+        batch.psi.data = np.exp(batch.psi.data)
+        batch.psi = normalize(batch.psi, norm='l1', axis=1)
+        batch.gamma = batch.alpha + batch.psi.T @ batch.phi
+        Elog_theta = _dirichlet_expectation_2d(batch.gamma)
+        meanchange = np.abs(batch.gamma - gamma_old).max(axis=1).mean()
+        gamma_old = copy.copy(batch.gamma)
+        it += 1
+    sstats = batch.phi.T @ batch.mtx
+    batch.ll = batch.psi.T @ batch.mtx @ slda._Elog_beta.T
+    ll_norm = logsumexp(batch.ll, axis = 1)
+    ll_tot = 0
+    for k in range(slda._K):
+        ll_tot += (batch.ll[:, k] - ll_norm).sum()
+    batch.ll = ll_tot / batch.n
+    return sstats
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--K', type=int, nargs='+', default=[12, 24, 48], help='')
+    parser.add_argument('--M', type=int, default=500, help='')
+    parser.add_argument('--N', type=int, default=40000, help='Number of pixels per minibatch')
+    parser.add_argument('--size', type=float, default=200, help='Side length (um) of the simulated minibatch')
+    parser.add_argument('--anchor_dist', type=float, default=4, help='')
+    parser.add_argument('--radius', type=float, default=5, help='')
+    parser.add_argument('--inner_max_iter', type=int, default=30, help='')
+    parser.add_argument('--repeat', type=int, default=3, help='')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    rng = np.random.default_rng(args.seed)
+    for K in args.K:
+        sim = simulate_pixels(rng, K, args.M, args.size, args.N, args.anchor_dist, args.radius)
+        theta = anchor_theta(sim, rng)
+        slda = OnlineLDA(vocab=np.arange(args.M), K=K, N=1e6, iter_inner=args.inner_max_iter, tol=-1)
+        slda.init_global_parameter(sim['beta'] * 1e4 + .5)
+        t_ref, t_new = [], []
+        for r in range(args.repeat):
+            b0 = make_batch(sim, theta)
+            t0 = time.time()
+            s0 = do_e_step_reference(slda, b0)
+            t_ref.append(time.time() - t0)
+            b1 = make_batch(sim, theta)
+            t0 = time.time()
+            s1 = slda.do_e_step(b1)
+            t_new.append(time.time() - t0)
+        d_phi = np.abs(b0.phi - b1.phi).max()
+        d_gamma = np.abs(b0.gamma - b1.gamma).max() / np.abs(b0.gamma).max()
+        d_sstats = np.abs(s0 - s1).max() / np.abs(s0).max()
+        logging.info(f"K={K}, {b1.N} pixels, {b1.n} anchors, {b1.psi.nnz} pixel-anchor pairs")
+        logging.info(f"K={K}, reference {np.median(t_ref):.3f}s, fused {np.median(t_new):.3f}s, speedup {np.median(t_ref)/np.median(t_new):.2f}x")
+        logging.info(f"K={K}, max abs diff phi {d_phi:.2e}, max rel diff gamma {d_gamma:.2e}, sstats {d_sstats:.2e}, ll {b0.ll:.6f} vs {b1.ll:.6f}")
@@ -0,0 +1,52 @@
+### Compare pixel level decoding (OnlineLDA.do_e_step) in float64 and float32
+### (--dtype in slda_decode), on a simulated minibatch with anchors initialized
+### as from transform. Fails if the pixel top factor agreement is below --min_agree
+
+import sys, os, time, argparse, logging
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.models.online_slda import OnlineLDA
+from ficture.utils.simulate import simulate_pixels, anchor_theta, make_batch
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--K', type=int, default=24, help='')
+    parser.add_argument('--M', type=int, default=500, help='Number of genes')
+    parser.add_argument('--width', type=float, default=200, help='Side of the simulated square region')
+    parser.add_argument('--n_pixel', type=int, default=40000, help='')
+    parser.add_argument('--anchor_dist', type=float, default=4, help='Distance between anchors on a square lattice')
+    parser.add_argument('--radius', type=float, default=6, help='Max distance between a pixel and its anchors')
+    parser.add_argument('--ct', type=int, nargs=2, default=[1, 60], help='Min and max number of transcripts per pixel')
+    parser.add_argument('--theta_noise', type=float, default=.2, help='Weight of the random part of the initial theta')
+    parser.add_argument('--iter_inner', type=int, default=30, help='')
+    parser.add_argument('--min_agree', type=float, default=.99, help='Minimum pixel top factor agreement between float32 and float64')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    rng = np.random.default_rng(args.seed)
+    K, M = args.K, args.M
+    sim = simulate_pixels(rng, K, M, args.width, args.n_pixel, args.anchor_dist, args.radius, ct=args.ct)
+    theta = anchor_theta(sim, rng, args.theta_noise)
+    logging.info(f"{args.n_pixel} pixels, {len(sim['grid_pt'])} anchors, {sim['wij'].nnz} pixel-anchor pairs, {K} factors")
+
+    res, t = {}, {}
+    for dtype in [np.float64, np.float32]:
+        slda = OnlineLDA(vocab=np.arange(M), K=K, N=1e6, iter_inner=args.iter_inner, seed=args.seed, dtype=dtype)
+        slda.init_global_parameter(sim['beta'] * 1e4 + .5)
+        batch = make_batch(sim, theta, dtype)
+        t0 = time.time()
+        sstats = slda.do_e_step(batch)
+        t[dtype] = time.time() - t0
+        res[dtype] = (batch.gamma, batch.phi, sstats)
+        logging.info(f"{np.dtype(dtype).name}: {t[dtype]:.3f}s, phi {batch.phi.dtype}, {batch.phi.nbytes/2**20:.1f}MB")
+
+    g0, p0, s0 = res[np.float64]
+    g1, p1, s1 = res[np.float32]
+    agree = (p0.argmax(axis = 1) == p1.argmax(axis = 1)).mean()
+    anchor_agree = (g0.argmax(axis = 1) == g1.argmax(axis = 1)).mean()
+    logging.info(f"speedup {t[np.float64]/t[np.float32]:.2f}x, max abs diff phi {np.abs(p0 - p1).max():.2e}, max rel diff gamma {(np.abs(g0 - g1).max() / np.abs(g0).max()):.2e}, max rel diff sstats {(np.abs(s0 - s1).max() / np.abs(s0).max()):.2e}")
+    logging.info(f"top factor agreement: pixel {agree:.4f}, anchor {anchor_agree:.4f}")
+    assert agree >= args.min_agree, f"Pixel top factor agreement {agree:.4f} below {args.min_agree}"
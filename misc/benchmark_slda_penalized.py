@@ -0,0 +1,74 @@
+### Compare the penalized M-step (OnlineLDA.penalized_sstats, used by
+### PixelMinibatch.run_chunk_penalized) with the previous per factor loop,
+### on a simulated minibatch
+
+import sys, os, time, copy, argparse, logging
+import numpy as np
+import sklearn.neighbors
+from sklearn.preprocessing import normalize
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.models.online_slda import OnlineLDA
+from ficture.utils.simulate import simulate_pixels, anchor_theta, make_batch
+
+def penalized_reference(slda, batch):
+    """
+    The loop from update_lambda_penalized, kept for comparison
+    """
+    lambda_org = slda._eta + slda.do_e_step(batch)
+    theta = normalize(batch.gamma, norm='l1', axis=1)
+    ckl = theta.T @ normalize(batch.anchor_adj, norm='l1', axis=1) @ theta
+    ckl /= theta.sum(axis = 0).reshape((-1, 1))
+    np.fill_diagonal(ckl, 0)
+    lam_sum = lambda_org.sum(axis = 1)
+    it = 0
+    meanchange = slda._tol + 1
+    while it < slda._max_iter_gamma and meanchange > slda._tol:
+        lambda_new = np.zeros((slda._K, slda._M))
+        for k in range(slda._K):
+            avg = ckl[[k], :] @ (normalize(lambda_org, norm='l1', axis=1)*lam_sum[k])
+            adj = np.clip(lambda_org[k, :] - slda._zeta * avg, 0, None)
+            lambda_new[k, :] = adj / adj.sum() * lam_sum[k]
+        meanchange = (np.abs(lambda_new - lambda_org).max(axis = 1) / lambda_org.sum(axis = 1)).mean()
+        lambda_org = copy.copy(lambda_new)
+        it += 1
+    return lambda_org
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--K', type=int, default=48, help='')
+    parser.add_argument('--M', type=int, default=5000, help='Number of genes')
+    parser.add_argument('--width', type=float, default=100, help='Side of the simulated square region')
+    parser.add_argument('--n_pixel', type=int, default=10000, help='')
+    parser.add_argument('--anchor_dist', type=float, default=4, help='Distance between anchors on a square lattice')
+    parser.add_argument('--radius', type=float, default=6, help='Max distance between a pixel and its anchors')
+    parser.add_argument('--zeta', type=float, default=.3, help='')
+    parser.add_argument('--iter_gamma', type=int, default=10, help='')
+    parser.add_argument('--iter_inner', type=int, default=30, help='')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    rng = np.random.default_rng(args.seed)
+    K, M = args.K, args.M
+    sim = simulate_pixels(rng, K, M, args.width, args.n_pixel, args.anchor_dist, args.radius)
+    theta = anchor_theta(sim, rng)
+    adj = sklearn.neighbors.radius_neighbors_graph(sim['grid_pt'], args.radius * 2, mode='connectivity', include_self=True)
+    logging.info(f"{args.n_pixel} pixels, {len(sim['grid_pt'])} anchors, {K} factors, {M} genes")
+
+    slda = OnlineLDA(vocab=np.arange(M), K=K, N=1e6, zeta=args.zeta, iter_gamma=args.iter_gamma, iter_inner=args.iter_inner, seed=args.seed)
+    slda.init_global_parameter(sim['beta'] * 1e4 + .5)
+    batch = make_batch(sim, theta, anchor_adj = adj)
+    t0 = time.time()
+    sstats = slda.do_e_step(batch)
+    logging.info(f"E-step {time.time() - t0:.3f}s")
+    # Time only the M-step, both start from the same E-step result
+    slda.do_e_step = lambda x : sstats
+    res, t = [], []
+    for f in [lambda x : penalized_reference(slda, x), slda.penalized_sstats]:
+        t0 = time.time()
+        res.append(f(batch))
+        t.append(time.time() - t0)
+    d = np.abs(res[0] - res[1]).max() / np.abs(res[0]).max()
+    logging.info(f"Penalized M-step: loop {t[0]:.3f}s, vectorized {t[1]:.3f}s, speedup {t[0]/t[1]:.1f}x. Max rel diff of the penalized lambda {d:.2e}")
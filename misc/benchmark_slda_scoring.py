@@ -0,0 +1,57 @@
+### Cost of scoring in OnlineLDA.update_lambda under different monitoring
+### policies (evaluate_every, score_sample), on simulated minibatches
+
+import sys, os, io, time, copy, argparse, logging
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.models.online_slda import OnlineLDA
+from ficture.utils.simulate import simulate_pixels, anchor_theta, make_batch
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--K', type=int, default=24, help='')
+    parser.add_argument('--M', type=int, default=5000, help='Number of genes')
+    parser.add_argument('--width', type=float, default=100, help='Side of each simulated minibatch')
+    parser.add_argument('--n_pixel', type=int, default=10000, help='Number of pixels per minibatch')
+    parser.add_argument('--n_batch', type=int, default=10, help='')
+    parser.add_argument('--anchor_dist', type=float, default=4, help='Distance between anchors on a square lattice')
+    parser.add_argument('--radius', type=float, default=6, help='Max distance between a pixel and its anchors')
+    parser.add_argument('--iter_inner', type=int, default=10, help='')
+    parser.add_argument('--score_sample', type=int, default=1000, help='')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    rng = np.random.default_rng(args.seed)
+    K, M = args.K, args.M
+    beta = rng.dirichlet(np.ones(M) * .1, K)
+    batches = []
+    for b in range(args.n_batch):
+        sim = simulate_pixels(rng, K, M, args.width, args.n_pixel, args.anchor_dist, args.radius, n_center=5, beta=beta)
+        batches.append((sim, anchor_theta(sim, rng)))
+    logging.info(f"{args.n_batch} minibatches of {args.n_pixel} pixels, {len(sim['grid_pt'])} anchors, {K} factors, {M} genes")
+
+    policy = {"every update": (1, 0), "off": (0, 0), "every 5": (5, 0), f"every update, {args.score_sample} pixels": (1, args.score_sample)}
+    res, t = {}, {}
+    for name, (evaluate_every, score_sample) in policy.items():
+        stream = io.StringIO()
+        slda = OnlineLDA(vocab=np.arange(M), K=K, N=1e6, iter_inner=args.iter_inner, seed=args.seed,\
+                         evaluate_every=evaluate_every, score_sample=score_sample, score_stream=stream)
+        slda.init_global_parameter(rng.gamma(100., 1./100., (K, M)) if len(res) == 0 else lam_init)
+        lam_init = copy.copy(slda._lambda)
+        t0 = time.time()
+        for sim, theta in batches:
+            _ = slda.update_lambda(make_batch(sim, theta))
+        t[name] = time.time() - t0
+        stream.seek(0)
+        res[name] = (slda._lambda, pd.read_csv(stream, sep='\t') if stream.getvalue() != '' else None)
+        logging.info(f"{name}: {t[name]:.3f}s, {t[name]/args.n_batch:.3f}s per update, {0 if res[name][1] is None else res[name][1].shape[0]} scored")
+
+    ref_lam, ref_score = res["every update"]
+    assert all([np.array_equal(ref_lam, v[0]) for v in res.values()]), "Scoring changed the model"
+    name = f"every update, {args.score_sample} pixels"
+    d = np.abs(res[name][1].pixel.values - ref_score.pixel.values) / np.abs(ref_score.pixel.values)
+    logging.info(f"Saving from not scoring: {(t['every update'] - t['off'])/t['every update']*100:.1f}% of the update time. Sampled pixel score, max rel diff {d.max():.2e}")
@@ -0,0 +1,56 @@
+### Compare the full E-step in OnlineLDA.do_e_step (pixel level decoding)
+### with the sparse factor E-step (--max_active_factor in slda_decode),
+### on a simulated minibatch with anchors initialized as from transform
+
+import sys, os, time, argparse, logging
+import numpy as np
+import scipy.sparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.models.online_slda import OnlineLDA
+from ficture.utils.simulate import simulate_pixels, anchor_theta, make_batch
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--K', type=int, default=48, help='')
+    parser.add_argument('--M', type=int, default=500, help='Number of genes')
+    parser.add_argument('--width', type=float, default=200, help='Side of the simulated square region')
+    parser.add_argument('--n_pixel', type=int, default=40000, help='')
+    parser.add_argument('--anchor_dist', type=float, default=4, help='Distance between anchors on a square lattice')
+    parser.add_argument('--radius', type=float, default=6, help='Max distance between a pixel and its anchors')
+    parser.add_argument('--theta_noise', type=float, default=.2, help='Weight of the random part of the initial theta, the rest is the composition of factors around each anchor')
+    parser.add_argument('--iter_inner', type=int, default=30, help='')
+    parser.add_argument('--max_factor', type=int, nargs='+', default=[2, 3, 4, 6], help='')
+    parser.add_argument('--seed', type=int, default=1984, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    rng = np.random.default_rng(args.seed)
+    K, M = args.K, args.M
+    sim = simulate_pixels(rng, K, M, args.width, args.n_pixel, args.anchor_dist, args.radius)
+    # Initial theta as from transform: factor composition around each anchor, plus noise
+    theta = anchor_theta(sim, rng, args.theta_noise)
+    label = sim['label']
+    logging.info(f"{args.n_pixel} pixels, {len(sim['grid_pt'])} anchors, {sim['wij'].nnz} pixel-anchor pairs, {K} factors")
+
+    res, t = [], []
+    for max_factor in [0] + args.max_factor:
+        slda = OnlineLDA(vocab=np.arange(M), K=K, N=1e6, iter_inner=args.iter_inner, seed=args.seed,\
+                         max_factor=max_factor, verbose=int(max_factor > 0))
+        slda.init_global_parameter(sim['beta'] * 1e4 + .5)
+        batch = make_batch(sim, theta)
+        t0 = time.time()
+        sstats = slda.do_e_step(batch)
+        t.append(time.time() - t0)
+        phi = batch.phi.toarray() if scipy.sparse.issparse(batch.phi) else batch.phi
+        res.append((batch.gamma, phi, sstats))
+        if max_factor == 0:
+            logging.info(f"Full: {t[0]:.3f}s, accuracy of the pixel top factor {(phi.argmax(axis = 1) == label).mean():.4f}")
+            continue
+        g0, p0, s0 = res[0]
+        d_phi = np.abs(p0 - phi).max()
+        d_sstats = np.abs(s0 - sstats).max() / np.abs(s0).max()
+        agree = (p0.argmax(axis = 1) == phi.argmax(axis = 1)).mean()
+        logging.info(f"max_factor {max_factor}: {t[-1]:.3f}s, speedup {t[0]/t[-1]:.2f}x, phi stores {batch.phi.nnz/phi.size*100:.1f}% of the entries")
+        logging.info(f"max_factor {max_factor}: max abs diff phi {d_phi:.2e}, max rel diff sstats {d_sstats:.2e}, pixel top factor agreement {agree:.4f}, accuracy {(phi.argmax(axis = 1) == label).mean():.4f}")
@@ -0,0 +1,72 @@
+### Compare the passes over a hexagon DGE in fit_model after model selection:
+### parsing the file with UnitLoader for every pass, or once into a
+### UnitCache (in memory or memory-mapped from a directory) and replaying it
+
+import sys, os, gzip, time, shutil, argparse, logging
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.loaders.unit_loader import UnitLoader
+from ficture.loaders.unit_cache import UnitCache
+
+def parse(args, ft_dict):
+    reader = pd.read_csv(gzip.open(args.input, 'rt'), sep='\t', chunksize=args.chunksize,\
+                         usecols=[args.unit_id, 'gene', args.key], dtype={args.unit_id:str, args.key:int})
+    return UnitLoader(reader, ft_dict, args.key, batch_id_prefix=args.epoch_id_length,\
+                      min_ct_per_unit=args.min_ct_per_unit, unit_id=args.unit_id, unit_attr=[])
+
+def one_pass(obj, bsize):
+    res = []
+    while obj.update_batch(bsize):
+        res.append((obj.mtx, len(obj.batch_id_list)))
+    return res
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, help='DGE sorted by unit, output of make_dge and sort')
+    parser.add_argument('--cache', type=str, default='', help='Directory for the memory-mapped cache, if empty only the in-memory cache is tested')
+    parser.add_argument('--unit_id', type=str, default='random_index', help='')
+    parser.add_argument('--key', type=str, default='Count', help='')
+    parser.add_argument('--epoch_id_length', type=int, default=2, help='')
+    parser.add_argument('--min_ct_per_unit', type=int, default=20, help='')
+    parser.add_argument('--chunksize', type=int, default=2000000, help='')
+    parser.add_argument('--bsize', type=int, default=512, help='')
+    parser.add_argument('--n_pass', type=int, default=3, help='')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    gene = pd.read_csv(args.input, sep='\t', usecols=['gene'], dtype=str).gene.unique()
+    ft_dict = {x:i for i,x in enumerate(sorted(gene))}
+
+    t0 = time.time()
+    for i in range(args.n_pass):
+        ref = one_pass(parse(args, ft_dict), args.bsize)
+    t_parse = (time.time() - t0) / args.n_pass
+    logging.info(f"Parse: {len(ref)} batches, {sum(x.shape[0] for x, _ in ref)} units, {t_parse:.3f}s per pass")
+
+    t0 = time.time()
+    units = UnitCache.from_loader(parse(args, ft_dict), args.bsize)
+    t_build = time.time() - t0
+    caches = [("memory", units)]
+    if args.cache != '':
+        os.makedirs(args.cache, exist_ok=True)
+        t0 = time.time()
+        units.save(args.cache)
+        caches.append(("mmap", UnitCache.load(args.cache)))
+        logging.info(f"Saved to {args.cache} in {time.time() - t0:.3f}s")
+    logging.info(f"Build cache: {t_build:.3f}s, {(units.data.nbytes + units.indices.nbytes + units.indptr.nbytes)/2**20:.1f}MB")
+
+    for name, cache in caches:
+        t0 = time.time()
+        for i in range(args.n_pass):
+            res = one_pass(cache.loader(), args.bsize)
+        t_replay = (time.time() - t0) / args.n_pass
+        assert len(res) == len(ref), f"{name}: {len(res)} batches, expected {len(ref)}"
+        for (x, e), (y, f) in zip(res, ref):
+            assert e == f and x.shape == y.shape and np.array_equal(x.indptr, y.indptr) and np.array_equal(x.indices, y.indices) and np.array_equal(x.data, y.data)
+        total = t_build + t_replay * (args.n_pass - 1)
+        logging.info(f"{name}: {t_replay:.3f}s per replayed pass ({t_parse/t_replay:.1f}x), {args.n_pass} passes {total:.3f}s vs {t_parse*args.n_pass:.3f}s parsing every pass. Batches identical")
+    if args.cache != '':
+        shutil.rmtree(args.cache)
@@ -0,0 +1,92 @@
+### Compare batch assembly in UnitLoader.update_batch (incremental unit
+### counting, CSR from unit boundaries) with the previous version that
+### concatenates and deduplicates data frames
+
+import sys, os, time, copy, argparse, logging
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_array
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ficture.loaders.unit_loader import UnitLoader
+
+class UnitLoaderReference(UnitLoader):
+    """
+    The previous update_batch and _make_matrix, kept for comparison
+    """
+    def _make_matrix(self):
+        self.brc = self.df[['unit']+self.unit_attr].drop_duplicates(subset=['unit'])
+        if self.prefix > 0:
+            lab = self.brc.unit.str[:self.prefix].unique()
+            self.batch_id_list += [x for x in lab if x not in self.batch_id_list]
+        self.brc = self.brc.merge(right = self.df.groupby(by='unit', observed=True).agg({self.train_key:"sum"}).reset_index(), on = 'unit', how = 'inner' )
+        self.brc = self.brc[self.brc[self.key] >= self.min_ct_per_unit]
+        bt_dict={x:i for i,x in enumerate(self.brc.unit)}
+        self.df = self.df[self.df.unit.isin(bt_dict)]
+        self.mtx = coo_array((self.df[self.train_key].values, \
+                            (self.df.unit.map(bt_dict).values.astype(int), \
+                             self.df.gene.map(self.ft_dict).values.astype(int)) ), \
+                            shape=(len(bt_dict), self.M), dtype=self.dtype).tocsr()
+        return len(bt_dict)
+
+    def update_batch(self, bsize):
+        n_unit = 0
+        if len(self.df) > 0:
+            n_unit = len(self.df.unit.unique())
+        if len(self.batch_id_list) > self.epoch or not self.file_is_open:
+            return 0
+        while n_unit <= bsize:
+            try:
+                chunk = next(self.reader)
+            except StopIteration:
+                self.file_is_open = False
+                break
+            chunk.rename(columns={self.unit_id:'unit'}, inplace=True)
+            chunk = chunk[chunk.gene.isin(self.ft_dict)]
+            if len(chunk) == 0:
+                continue
+            self.df = pd.concat([self.df, chunk])
+            n_unit = len(self.df.unit.unique())
+        left = pd.DataFrame()
+        if self.file_is_open:
+            last_indx = self.df.unit.iloc[-1]
+            left = self.df[self.df.unit == last_indx]
+            self.df = self.df[self.df.unit != last_indx]
+        N = self._make_matrix()
+        self.df = copy.copy(left)
+        return N
+
+def run(loader, args, ft_dict, chunks, bsize):
+    # Chunks are parsed beforehand, only the batch assembly is timed
+    reader = (x.copy() for x in chunks)
+    obj = loader(reader, ft_dict, args.key, batch_id_prefix=args.epoch_id_length, min_ct_per_unit=args.min_ct_per_unit, unit_id=args.unit_id, unit_attr=[])
+    res = []
+    t0 = time.time()
+    while obj.update_batch(bsize):
+        res.append((obj.brc.unit.values, obj.mtx))
+    return time.time() - t0, res
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, help='DGE sorted by unit, output of make_dge and sort')
+    parser.add_argument('--unit_id', type=str, default='random_index', help='')
+    parser.add_argument('--key', type=str, default='Count', help='')
+    parser.add_argument('--epoch_id_length', type=int, default=2, help='')
+    parser.add_argument('--min_ct_per_unit', type=int, default=20, help='')
+    parser.add_argument('--setting', type=str, nargs='+', default=['2000000,512', '50000,20000'], help='Pairs of (chunk size, minibatch size)')
+    args = parser.parse_args()
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+
+    genes = pd.read_csv(args.input, sep='\t', usecols=['gene']).gene.unique()
+    ft_dict = {x:i for i,x in enumerate(sorted(genes))}
+    for v in args.setting:
+        chunksize, bsize = [int(x) for x in v.split(',')]
+        chunks = list(pd.read_csv(args.input, sep='\t', chunksize=chunksize, usecols=[args.unit_id, 'gene', args.key], dtype={args.unit_id:str}))
+        t0, r0 = run(UnitLoaderReference, args, ft_dict, chunks, bsize)
+        t1, r1 = run(UnitLoader, args, ft_dict, chunks, bsize)
+        assert len(r0) == len(r1)
+        for (u0, m0), (u1, m1) in zip(r0, r1):
+            assert np.array_equal(u0, u1) and m0.shape == m1.shape and abs(m0 - m1).max() == 0
+        n = sum([len(x[0]) for x in r1])
+        logging.info(f"Chunk size {chunksize}, minibatch size {bsize}: {n} units in {len(r1)} batches. Previous {t0:.2f}s, incremental {t1:.2f}s, speedup {t0/t1:.1f}x")
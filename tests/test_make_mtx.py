@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from ficture.utils import utilt
+
+def make_mtx_from_dge_reference(file, min_ct_per_feature = 50, min_ct_per_unit = 100, feature_white_list = None, feature_list = None, unit = "random_index", key = "gn", epoch=1, epoch_id_length=2, feature_list_force = False, dtype = None):
+    """
+    The previous make_mtx_from_dge (concatenate the chunks into one data
+    frame), see misc/benchmark_make_mtx.py
+    """
+    df = pd.DataFrame()
+    epoch_id_list = set()
+    reader = pd.read_csv(file, sep='\t', usecols = [unit,'X','Y','gene',key], dtype={unit:str}, chunksize=500000)
+    for chunk in reader:
+        unit_list = chunk[unit].str[:epoch_id_length].unique()
+        i = 0
+        while len(epoch_id_list) < epoch and i < len(unit_list):
+            epoch_id_list.add(unit_list[i])
+            i += 1
+        if len(epoch_id_list) >= epoch and unit_list[-1] not in epoch_id_list:
+            pat = '^' + '|'.join(list(epoch_id_list))
+            df = pd.concat([df, chunk[chunk[unit].str.contains(pat) & chunk[key].ge(1)] ])
+            break
+        df = pd.concat([df, chunk[chunk[key].ge(1)] ])
+    epoch0 = df[unit].iloc[0][:epoch_id_length]
+    one_pass = df[unit].str[:epoch_id_length].eq(epoch0)
+    if feature_list is not None:
+        feature = pd.DataFrame({"gene": feature_list})
+        ct = df[one_pass].groupby(by=['gene']).agg({key:"sum"}).reset_index()
+        if feature_list_force is False:
+            ct.drop(index = ct[ct[key].lt(min_ct_per_feature)].index, inplace=True)
+            feature = feature.merge(right = ct, on = 'gene', how = 'inner')
+        else:
+            feature = feature.merge(right = ct, on = 'gene', how = 'left')
+            feature.fillna(0, inplace=True)
+    else:
+        feature = df[one_pass].groupby(by=['gene']).agg({key:"sum"}).reset_index()
+        feature_white_list = set() if feature_white_list is None else set(feature_white_list)
+        feature = feature.loc[feature[key].ge(min_ct_per_feature ) | feature.gene.isin(feature_white_list), :]
+    M = len(feature)
+    feature.index = np.arange(M)
+    ft_dict = {x:i for i,x in enumerate(feature.gene)}
+    df.drop(index = df.index[~df.gene.isin(ft_dict)], inplace=True)
+
+    brc = df.groupby(by = unit).agg({key:"sum"}).reset_index()
+    brc.drop(index = brc.index[brc[key].lt(min_ct_per_unit)], inplace=True)
+    N = brc.shape[0]
+    brc.index = np.arange(N)
+    bc_dict = {x:i for i,x in enumerate(brc[unit])}
+    brc['j'] = brc[unit].map(bc_dict)
+    df.drop(index = df.index[~df[unit].isin(bc_dict)], inplace=True)
+    df['j'] = df[unit].map(bc_dict)
+    brc["epoch"] = brc[unit].str[:epoch_id_length]
+    df.drop(columns = unit, inplace=True)
+    brc = brc.merge(right = df[['j','X','Y' ]].drop_duplicates(subset='j'), on = 'j', how = 'left')
+
+    mtx = sparse.coo_array((df[key].values, (df.j.values, df.gene.map(ft_dict))), shape=(N, M), dtype=dtype).tocsr()
+
+    feature["Weight"] = mtx.sum(axis = 0)
+    feature.Weight = feature.Weight * 1. / feature.Weight.sum()
+    return feature, brc, mtx, ft_dict, bc_dict
+
+@pytest.fixture(scope="module")
+def dge(tmp_path_factory):
+    """
+    A hexagon DGE as written by make_dge: three epochs of the same units,
+    ids are the epoch label followed by letters, sorted by unit
+    """
+    rng = np.random.default_rng(11)
+    n_unit = 400
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    genes = np.array([f"g{i:02d}" for i in range(60)])
+    p_gene = rng.dirichlet(np.ones(60) * .3)
+    df = []
+    for e in range(3):
+        sfx = ["".join(x) for x in letters[rng.integers(0, 26, (n_unit, 8))]]
+        xy = rng.uniform(0, 500, (n_unit, 2)).round(2)
+        nnz = rng.integers(1, 40, n_unit)
+        df.append(pd.DataFrame({'random_index':np.repeat([f"{e:02d}{x}" for x in sfx], nnz),
+                                'X':np.repeat(xy[:, 0], nnz), 'Y':np.repeat(xy[:, 1], nnz),
+                                'gene':rng.choice(genes, nnz.sum(), p=p_gene),
+                                'Count':rng.integers(0, 6, nnz.sum())})) # Includes zero counts
+    df = pd.concat(df).sort_values(by='random_index', kind='stable')
+    f = tmp_path_factory.mktemp("dge") / "hexagon.tsv.gz"
+    df.to_csv(f, sep='\t', index=False)
+    return f, genes
+
+@pytest.mark.parametrize("setting", ["default", "epoch 2", "float32", "feature list", "feature list (force)", "white list"])
+def test_make_mtx_from_dge(dge, setting, monkeypatch):
+    f, genes = dge
+    # Read in small chunks so units and epochs span chunk boundaries
+    read_csv = pd.read_csv
+    monkeypatch.setattr(pd, "read_csv", lambda *a, **k: read_csv(*a, **{**k, "chunksize":997}))
+    feature_list = list(genes[::2]) + ["not_a_gene"]
+    kwargs = {"default":{}, "epoch 2":{"epoch":2}, "float32":{"dtype":np.float32},\
+              "feature list":{"feature_list":feature_list},\
+              "feature list (force)":{"feature_list":feature_list, "feature_list_force":True},\
+              "white list":{"feature_white_list":feature_list[:5]}}[setting]
+    r0 = make_mtx_from_dge_reference(f, min_ct_per_feature = 50, min_ct_per_unit = 20, key = "Count", **kwargs)
+    r1 = utilt.make_mtx_from_dge(f, min_ct_per_feature = 50, min_ct_per_unit = 20, key = "Count", **kwargs)
+    feature, brc, mtx, ft_dict, bc_dict = r0
+    assert mtx.shape[0] > 0 and 0 < mtx.shape[1] < len(genes) # Thresholds leave some but not all
+    pd.testing.assert_frame_equal(feature, r1[0])
+    pd.testing.assert_frame_equal(brc, r1[1], check_index_type=False)
+    assert mtx.dtype == r1[2].dtype and mtx.shape == r1[2].shape and (mtx != r1[2]).nnz == 0
+    assert ft_dict == r1[3] and bc_dict == r1[4]
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from ficture.models.online_slda import OnlineLDA
+from ficture.utils.simulate import simulate_pixels, anchor_theta, make_batch
+
+@pytest.fixture(scope="module")
+def sim():
+    """Pixels with 20-60 transcripts each, where float32 psi used to underflow"""
+    rng = np.random.default_rng(1984)
+    sim = simulate_pixels(rng, 12, 300, 60, 3000, 4, 6, ct=(20, 60))
+    return sim, anchor_theta(sim, rng, .2)
+
+def e_step(sim, theta, dtype, **kwargs):
+    slda = OnlineLDA(vocab=np.arange(300), K=12, N=1e6, iter_inner=30, seed=1, dtype=dtype, **kwargs)
+    slda.init_global_parameter(sim['beta'] * 1e4 + .5)
+    batch = make_batch(sim, theta, dtype)
+    slda.do_e_step(batch)
+    return batch
+
+@pytest.mark.parametrize("mode", [{}, {"active_set":True}, {"max_factor":4}], ids=["full", "active_set", "sparse_factor"])
+def test_float32_e_step(sim, mode):
+    sim, theta = sim
+    b64 = e_step(sim, theta, np.float64, **mode)
+    b32 = e_step(sim, theta, np.float32, **mode)
+    assert b32.psi.dtype == np.float32
+    row_sum = np.add.reduceat(b32.psi.data, b32.psi.indptr[:-1])
+    assert np.all(row_sum > 0), f"{(row_sum == 0).sum()} pixels with all zero psi"
+    np.testing.assert_allclose(row_sum, 1, rtol=1e-5)
+    g64, g32 = np.asarray(b64.gamma), np.asarray(b32.gamma, dtype=float)
+    assert np.abs(g32 - g64).max() / np.abs(g64).max() < 1e-4
+    assert (g32.argmax(axis = 1) == g64.argmax(axis = 1)).mean() >= .99
+    p64 = b64.phi.toarray() if hasattr(b64.phi, "toarray") else b64.phi
+    p32 = b32.phi.toarray() if hasattr(b32.phi, "toarray") else b32.phi
+    assert (p32.argmax(axis = 1) == p64.argmax(axis = 1)).mean() >= .99
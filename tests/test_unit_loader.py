@@ -0,0 +1,88 @@
+import copy
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import coo_array
+
+from ficture.loaders.unit_loader import UnitLoader
+
+class UnitLoaderReference(UnitLoader):
+    """
+    The previous update_batch and _make_matrix (concatenate and deduplicate
+    data frames), see misc/benchmark_unit_loader.py
+    """
+    def _make_matrix(self):
+        self.brc = self.df[['unit']+self.unit_attr].drop_duplicates(subset=['unit'])
+        if self.prefix > 0:
+            lab = self.brc.unit.str[:self.prefix].unique()
+            self.batch_id_list += [x for x in lab if x not in self.batch_id_list]
+        self.brc = self.brc.merge(right = self.df.groupby(by='unit', observed=True).agg({self.train_key:"sum"}).reset_index(), on = 'unit', how = 'inner' )
+        self.brc = self.brc[self.brc[self.key] >= self.min_ct_per_unit]
+        bt_dict={x:i for i,x in enumerate(self.brc.unit)}
+        self.df = self.df[self.df.unit.isin(bt_dict)]
+        self.mtx = coo_array((self.df[self.train_key].values, \
+                            (self.df.unit.map(bt_dict).values.astype(int), \
+                             self.df.gene.map(self.ft_dict).values.astype(int)) ), \
+                            shape=(len(bt_dict), self.M), dtype=self.dtype).tocsr()
+        return len(bt_dict)
+
+    def update_batch(self, bsize):
+        n_unit = 0
+        if len(self.df) > 0:
+            n_unit = len(self.df.unit.unique())
+        if len(self.batch_id_list) > self.epoch or not self.file_is_open:
+            return 0
+        while n_unit <= bsize:
+            try:
+                chunk = next(self.reader)
+            except StopIteration:
+                self.file_is_open = False
+                break
+            chunk.rename(columns={self.unit_id:'unit'}, inplace=True)
+            chunk = chunk[chunk.gene.isin(self.ft_dict)]
+            if len(chunk) == 0:
+                continue
+            self.df = pd.concat([self.df, chunk])
+            n_unit = len(self.df.unit.unique())
+        left = pd.DataFrame()
+        if self.file_is_open:
+            last_indx = self.df.unit.iloc[-1]
+            left = self.df[self.df.unit == last_indx]
+            self.df = self.df[self.df.unit != last_indx]
+        N = self._make_matrix()
+        self.df = copy.copy(left)
+        return N
+
+@pytest.fixture(scope="module")
+def dge():
+    """Unit level DGE sorted by unit, ids prefixed by a 2 digit epoch label"""
+    rng = np.random.default_rng(7)
+    n_unit = 800
+    unit = np.sort([f"{e:02d}{x:08x}" for e, x in zip(rng.integers(0, 3, n_unit), rng.choice(2**32, n_unit, replace=False))])
+    nnz = rng.integers(1, 30, n_unit)
+    genes = np.array([f"g{i}" for i in range(50)])
+    df = pd.DataFrame({'random_index':np.repeat(unit, nnz),
+                       'gene':genes[rng.integers(0, 50, nnz.sum())], # Includes repeated (unit, gene) rows
+                       'Count':rng.integers(1, 6, nnz.sum())})
+    ft_dict = {x:i for i,x in enumerate(genes[5:45])} # Some genes are not in the model
+    return df, ft_dict
+
+def read_all(loader, df, ft_dict, chunksize, bsize):
+    reader = (df.iloc[i:i+chunksize].copy() for i in range(0, len(df), chunksize))
+    obj = loader(reader, ft_dict, 'Count', batch_id_prefix=2, min_ct_per_unit=20, unit_id='random_index', unit_attr=[])
+    res = []
+    while obj.update_batch(bsize):
+        res.append((obj.brc.unit.values, obj.brc.Count.values, obj.mtx))
+    return res, obj.batch_id_list
+
+@pytest.mark.parametrize("chunksize,bsize", [(97, 20), (1000, 50), (5000, 300), (20000, 2000)])
+def test_update_batch(dge, chunksize, bsize):
+    df, ft_dict = dge
+    r0, lab0 = read_all(UnitLoaderReference, df, ft_dict, chunksize, bsize)
+    r1, lab1 = read_all(UnitLoader, df, ft_dict, chunksize, bsize)
+    assert lab0 == lab1
+    assert len(r0) == len(r1)
+    for (u0, c0, m0), (u1, c1, m1) in zip(r0, r1):
+        assert np.array_equal(u0, u1)
+        assert np.array_equal(c0, c1)
+        assert m0.shape == m1.shape and abs(m0 - m1).max() == 0
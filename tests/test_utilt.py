@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from ficture.utils.utilt import coherence_score, chisq, chisq_de
+
+def coherence_reference(mtx, theta, gene_f, top_genes):
+    """
+    The previous pairwise loop from fit_model, see misc/benchmark_coherence.py
+    """
+    res = []
+    for k, wd_idx in enumerate(top_genes):
+        topm = len(wd_idx)
+        if topm == 0:
+            continue
+        wd_idx = sorted( list(wd_idx), key = lambda x : -gene_f[x])
+        s = 0
+        for ii in range(topm - 1):
+            for jj in range(ii+1, topm):
+                i = wd_idx[ii]
+                j = wd_idx[jj]
+                idx = mtx.indices[mtx.indptr[i]:mtx.indptr[i+1]]
+                denom = mtx[:, [i]].toarray()[idx] * gene_f[j] / gene_f[i]
+                num = mtx[:, [j]].toarray()[idx]
+                s += (theta[idx, k].reshape((-1, 1)) * np.log(num/denom + 1)).sum()
+        res.append([k, s, s / theta[:, k].sum()])
+    return res
+
+def test_coherence_score():
+    rng = np.random.default_rng(3)
+    N, M, K = 500, 80, 6
+    mtx = sparse.random(N, M, density=.1, random_state=3, data_rvs=lambda n : rng.integers(1, 10, n)).tocsc()
+    theta = rng.dirichlet(np.ones(K) * .5, N)
+    gene_f = np.asarray(mtx.sum(axis = 0)).reshape(-1).astype(float)
+    gene_f[:10] = gene_f[10] # Ties in gene weights
+    gene_f /= gene_f.sum()
+    top_genes = [rng.choice(M, 15, replace=False) for k in range(K)]
+    top_genes[1] = np.arange(12) # Including the tied genes
+    top_genes[2] = np.array([], dtype=int)
+    top_genes[3] = top_genes[3][:1]
+    r0 = np.array(coherence_reference(mtx, theta, gene_f, top_genes))
+    r1 = np.array(coherence_score(mtx, theta, gene_f, top_genes))
+    assert np.array_equal(r0[:, 0], r1[:, 0]) and 2 not in r1[:, 0]
+    np.testing.assert_allclose(r1[:, 1:], r0[:, 1:], rtol=1e-12, atol=0)
+
+def test_chisq_de():
+    rng = np.random.default_rng(5)
+    M, K = 400, 8
+    beta = rng.dirichlet(np.ones(M) * .1, K)
+    ct = rng.gamma(2, 1, (M, 1)) * beta.T * 1e5 * rng.dirichlet(np.ones(K))
+    header = [str(x) for x in range(K)]
+    info = pd.DataFrame(np.around(ct, 2), index = [f"g{i}" for i in range(M)], columns = header)
+    info.iloc[:20, 0] = 0 # Zero counts are skipped
+    info.iloc[0, 1] = 1e7 # Chi2 beyond the range where the p-value underflows
+    info["gene_tot"] = info.loc[:, header].sum(axis=1).astype(int)
+    info = info[info["gene_tot"] > 50]
+    total_umi = info.gene_tot.sum()
+    total_k = np.array(info.loc[:, header].sum(axis = 0) )
+    res = []
+    with np.errstate(divide='ignore'): # Genes only seen in one factor
+        for k, kname in enumerate(header):
+            res += chisq(kname, info.loc[:, [kname, 'gene_tot']], total_k[k], total_umi)
+    ref = pd.DataFrame(res,columns=['gene','factor','Chi2','pval','FoldChange','gene_total'])
+    new = chisq_de(info, header, total_k, total_umi)
+    assert ref.shape == new.shape and (ref.pval == 0).any()
+    for x in ['gene', 'factor', 'gene_total']:
+        assert np.array_equal(ref[x].values, new[x].values)
+    for x in ['Chi2', 'FoldChange', 'pval']:
+        np.testing.assert_allclose(new[x].values, ref[x].values, rtol=1e-10, atol=0)